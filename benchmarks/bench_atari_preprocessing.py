@@ -0,0 +1,61 @@
+'''
+Compares the fused Atari preprocessing (FusedPreprocessEnv) with the original
+wrapper chain (MaxAndSkipEnv, WarpFrame, ClipRewardEnv): checks that both
+produce identical frames and rewards and reports the time per frame.
+
+Usage:
+    python benchmarks/bench_atari_preprocessing.py [--steps 5000]
+'''
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_atari_env import FakeAtariEnv
+from gymmeforce.wrappers import AtariWrapper
+
+
+def run_env(fused, num_steps, seed=0):
+    ''' Returns the frames, rewards and the time per step (in seconds) '''
+    env = AtariWrapper(fused=fused).wrap_env(FakeAtariEnv(seed=seed))
+    actions = np.random.RandomState(seed).randint(4, size=num_steps)
+    env.unwrapped.np_random.seed(seed)
+    frames = np.zeros((num_steps + 1, 84, 84, 1), dtype=np.uint8)
+    rewards = np.zeros(num_steps)
+
+    start = time.perf_counter()
+    frames[0] = env.reset()
+    for i_step, action in enumerate(actions):
+        frame, rewards[i_step], done, _ = env.step(action)
+        frames[i_step + 1] = frame
+        if done:
+            frames[i_step + 1] = env.reset()
+    step_time = (time.perf_counter() - start) / num_steps
+
+    return frames, rewards, step_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Atari preprocessing benchmark')
+    parser.add_argument('--steps', type=int, default=5000)
+    args = parser.parse_args()
+
+    frames, rewards, chain_time = run_env(fused=False, num_steps=args.steps)
+    fused_frames, fused_rewards, fused_time = run_env(fused=True, num_steps=args.steps)
+
+    identical = np.array_equal(frames, fused_frames) and np.array_equal(
+        rewards, fused_rewards)
+    print('Identical output: {}'.format(identical))
+    print('Wrapper chain: {:.1f}us per step'.format(1e6 * chain_time))
+    print('Fused:         {:.1f}us per step ({:.2f}x)'.format(1e6 * fused_time,
+                                                            chain_time / fused_time))
+    if not identical:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
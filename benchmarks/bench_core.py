@@ -0,0 +1,232 @@
+'''
+Microbenchmarks of the core data structures.
+
+Usage:
+    python benchmarks/bench_core.py run [--output results.json] [--filter replay]
+    python benchmarks/bench_core.py compare base.json new.json [--threshold 0.1]
+
+compare exits with status 1 when a benchmark is slower than the base by more
+than <threshold> (relative to the base median time).
+'''
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gymmeforce.common.data_gen import DataGenerator
+from gymmeforce.common.utils import (ReplayBuffer, RingBuffer, Scaler,
+                                     calculate_n_step_return, discounted_sum_rewards)
+
+# Maps the name of each benchmark to a function returning the function to time
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name):
+    def register(setup_fn):
+        BENCHMARKS[name] = setup_fn
+        return setup_fn
+
+    return register
+
+
+def _filled_replay_buffer(maxlen, history_length, frame_shape=(84, 84)):
+    replay_buffer = ReplayBuffer(maxlen, history_length=history_length, n_step=3)
+    frame = np.random.randint(0, 256, size=frame_shape, dtype=np.uint8)
+    for i in range(maxlen):
+        replay_buffer.add(frame, 0, 1., i % 500 == 499)
+
+    return replay_buffer, frame
+
+
+for maxlen in [10000, 100000]:
+    for history_length in [1, 4]:
+
+        @benchmark('replay_buffer.add[maxlen={},history={}]'.format(
+            maxlen, history_length))
+        def replay_add(maxlen=maxlen, history_length=history_length):
+            replay_buffer, frame = _filled_replay_buffer(maxlen, history_length)
+            return lambda: replay_buffer.add(frame, 0, 1., False)
+
+        @benchmark('replay_buffer.sample[maxlen={},history={}]'.format(
+            maxlen, history_length))
+        def replay_sample(maxlen=maxlen, history_length=history_length):
+            replay_buffer, _ = _filled_replay_buffer(maxlen, history_length)
+            return replay_buffer.sample
+
+
+@benchmark('ring_buffer.append')
+def ring_append():
+    ring_buffer = RingBuffer((84, 84), 4, dtype=np.uint8)
+    frame = np.zeros((84, 84), dtype=np.uint8)
+    return lambda: ring_buffer.append(frame)
+
+
+@benchmark('ring_buffer.get_data')
+def ring_get_data():
+    ring_buffer = RingBuffer((84, 84), 4, dtype=np.uint8)
+    return ring_buffer.get_data
+
+
+@benchmark('data_generator.fetch_batch_dict[2048x64]')
+def data_generator():
+    data = {
+        'states': np.random.randn(2048, 64).astype(np.float32),
+        'actions': np.random.randint(4, size=2048),
+        'advantages': np.random.randn(2048).astype(np.float32),
+        'learning_rate': 1e-3
+    }
+    generator = DataGenerator(data)
+    # Consume the whole epoch
+    return lambda: sum(1 for _ in generator.fetch_batch_dict(64))
+
+
+@benchmark('discounted_sum_rewards[1000]')
+def discounted_sum():
+    rewards = np.random.randn(1000)
+    return lambda: discounted_sum_rewards(rewards, 0.99)
+
+
+@benchmark('calculate_n_step_return[5]')
+def n_step_return():
+    rewards = np.random.randn(5)
+    dones = np.array([0, 0, 0, 1, 0])
+    return lambda: calculate_n_step_return(rewards, dones, 0.99)
+
+
+@benchmark('scaler.update[2048x64]')
+def scaler_update():
+    scaler = Scaler(64)
+    states = np.random.randn(2048, 64)
+    return lambda: scaler.update(states)
+
+
+for fused in [False, True]:
+
+    @benchmark('atari_wrapper.step[fake_env,fused={}]'.format(fused))
+    def atari_step(fused=fused):
+        from benchmarks.fake_atari_env import FakeAtariEnv
+        from gymmeforce.wrappers import AtariWrapper
+        env = AtariWrapper(fused=fused).wrap_env(FakeAtariEnv())
+        env.reset()
+
+        def step():
+            _, _, done, _ = env.step(0)
+            if done:
+                env.reset()
+
+        return step
+
+
+def time_benchmark(setup_fn, min_time=0.5, repeat=5):
+    ''' Returns the median and minimum time per call, in seconds '''
+    fn = setup_fn()
+    # Find how many calls take about min_time / repeat
+    number, elapsed = 1, 0
+    while elapsed < min_time / repeat:
+        number *= 2
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number)
+
+    return np.median(times), np.min(times)
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(output=None, filter=None, min_time=0.5):
+    results = OrderedDict()
+    for name, setup_fn in BENCHMARKS.items():
+        if filter is not None and filter not in name:
+            continue
+        try:
+            median, best = time_benchmark(setup_fn, min_time=min_time)
+        except ImportError as e:
+            print('{:<55} skipped ({})'.format(name, e))
+            continue
+        results[name] = {'median': median, 'min': best}
+        print('{:<55} {:10.2f}us'.format(name, 1e6 * median))
+
+    if output is not None:
+        info = {
+            'revision': _git_revision(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S')
+        }
+        with open(output, 'w') as f:
+            json.dump({'info': info, 'results': results}, f, indent=2)
+        print('Results written to {}'.format(output))
+
+
+def compare(base_path, new_path, threshold=0.1):
+    ''' Returns the names of the benchmarks that regressed '''
+    with open(base_path) as f:
+        base = json.load(f)['results']
+    with open(new_path) as f:
+        new = json.load(f)['results']
+
+    regressions = []
+    for name in new:
+        if name not in base:
+            continue
+        ratio = new[name]['median'] / base[name]['median']
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = 'REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            flag = 'faster'
+        print('{:<55} {:10.2f}us {:10.2f}us {:6.2f}x {}'.format(
+            name, 1e6 * base[name]['median'], 1e6 * new[name]['median'], ratio, flag))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Core data structures benchmarks')
+    subparsers = parser.add_subparsers(dest='command')
+    run_parser = subparsers.add_parser('run')
+    run_parser.add_argument('--output', help='JSON file to write the results')
+    run_parser.add_argument('--filter', help='Only run benchmarks containing this')
+    run_parser.add_argument('--min_time', type=float, default=0.5)
+    compare_parser = subparsers.add_parser('compare')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.1)
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        run(args.output, args.filter, args.min_time)
+    elif args.command == 'compare':
+        if len(compare(args.base, args.new, args.threshold)) > 0:
+            sys.exit(1)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+'''
+Measures the startup time of common entry points, each statement runs on
+a fresh interpreter so the import caches of one run do not affect the others.
+
+Usage:
+    python benchmarks/bench_startup.py [--repeat 5] [--env CartPole-v0]
+'''
+import argparse
+import subprocess
+import sys
+
+import numpy as np
+
+STATEMENTS = {
+    'import gymmeforce.agents': 'import gymmeforce.agents',
+    'import ReplayBuffer': 'from gymmeforce.common.utils import ReplayBuffer',
+    'import schedules': 'import gymmeforce.common.schedules',
+    'import DQNAgent': 'from gymmeforce.agents import DQNAgent',
+}
+
+AGENT_STATEMENT = ("from gymmeforce.agents import VanillaPGAgent; "
+                   "VanillaPGAgent('{env}', cache_env_config={cache}, log_dir='/tmp/bench')")
+
+TIMEIT = '''
+import time
+start = time.perf_counter()
+{statement}
+print(time.perf_counter() - start)
+'''
+
+
+def measure(statement, repeat):
+    ''' Returns the median time, or None if the statement fails '''
+    times = []
+    for _ in range(repeat):
+        try:
+            output = subprocess.check_output(
+                [sys.executable, '-c', TIMEIT.format(statement=statement)],
+                stderr=subprocess.DEVNULL)
+        except subprocess.CalledProcessError:
+            return None
+        times.append(float(output.split()[-1]))
+    return np.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup time benchmark')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument(
+        '--env', default=None, help='Also measure creating an agent for this env')
+    args = parser.parse_args()
+
+    statements = dict(STATEMENTS)
+    if args.env is not None:
+        for cache in [False, True]:
+            name = 'VanillaPGAgent (cache_env_config={})'.format(cache)
+            statements[name] = AGENT_STATEMENT.format(env=args.env, cache=cache)
+
+    for name, statement in statements.items():
+        time = measure(statement, args.repeat)
+        print('{:<45} {}'.format(name, 'failed' if time is None else '{:.3f}s'.format(time)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+import gym
+import numpy as np
+from gym import spaces
+
+
+class FakeAtariEnv(gym.Env):
+    '''
+    Produces random 210x160 RGB frames with the same interface used by the
+    Atari wrappers (lives, action meanings), so they can be benchmarked
+    without the ALE. Frames are drawn from a pool generated only once.
+
+    Args:
+        episode_length: Number of steps before the episode ends
+        lives: Number of lives, one is lost every episode_length / lives steps
+        num_frames: Number of distinct frames generated
+    '''
+
+    def __init__(self, episode_length=1000, lives=5, num_frames=64, seed=0):
+        self.episode_length = episode_length
+        self.num_lives = lives
+        rng = np.random.RandomState(seed)
+        self.frames = rng.randint(0, 256, size=(num_frames, 210, 160, 3), dtype=np.uint8)
+        self.observation_space = spaces.Box(low=0, high=255, shape=(210, 160, 3))
+        self.action_space = spaces.Discrete(4)
+        # Read by gym.Env.spec
+        self._spec = _Spec('FakeNoFrameskip-v4')
+        self.ale = self
+        self.np_random = rng
+        self.i_step = 0
+
+    def lives(self):
+        steps_per_life = self.episode_length // self.num_lives
+        return self.num_lives - self.i_step // steps_per_life
+
+    def get_action_meanings(self):
+        return ['NOOP', 'FIRE', 'RIGHT', 'LEFT']
+
+    def _frame(self):
+        return self.frames[self.i_step % len(self.frames)]
+
+    def _reset(self):
+        self.i_step = 0
+        return self._frame()
+
+    def _step(self, action):
+        self.i_step += 1
+        done = self.i_step >= self.episode_length
+        return self._frame(), float(self.i_step % 7 == 0), done, {}
+
+
+class _Spec:
+    def __init__(self, id):
+        self.id = id
@@ -0,0 +1,26 @@
+from gymmeforce.agents import ApeXAgent
+from gymmeforce.wrappers import AtariWrapper
+
+if __name__ == '__main__':
+    # Create gym enviroment
+    env_name = 'SpaceInvadersNoFrameskip-v4'
+
+    # Define wrapper
+    frame_skip = 4
+    env_wrapper = AtariWrapper(frame_skip=frame_skip)
+
+    # Create agent
+    agent = ApeXAgent(
+        env_name=env_name,
+        log_dir='logs/space_invaders/apex_3n_step_dueling_ddqn_v0',
+        double=True,
+        dueling=True,
+        target_update_freq=2500,
+        env_wrapper=env_wrapper)
+    # Train, one actor for each cpu (except the one used by the learner)
+    agent.train(
+        max_steps=40e6 * frame_skip,
+        n_step=3,
+        learning_rate=1e-4,
+        replay_buffer_size=1e6,
+        log_steps=4e4)
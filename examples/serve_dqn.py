@@ -0,0 +1,50 @@
+import threading
+
+import numpy as np
+
+from gymmeforce.agents import DQNAgent
+from gymmeforce.common.inference_server import InferenceServer
+from gymmeforce.wrappers import AtariWrapper
+
+env_name = 'SpaceInvadersNoFrameskip-v4'
+num_episodes = 32
+
+# Only used for building the model with the same config as the training
+agent = DQNAgent(
+    env_name=env_name,
+    log_dir='logs/space_invaders/40M_random_4n_step_dueling_ddqn_30ktarget_v0',
+    double=True,
+    dueling=True,
+    target_update_freq=30000,
+    env_wrapper=AtariWrapper(frame_skip=4))
+# Loads the latest checkpoint from log_dir
+server = InferenceServer(agent.model, method='predict', max_batch_size=32)
+
+
+def evaluate(i_episode, rewards):
+    # The episodes run concurrently, their states are batched by the server
+    _, env = agent._create_env(monitor_dir='videos/eval_{}'.format(i_episode))
+    state_stack = np.zeros(agent.env_config['state_shape'], dtype=np.uint8)
+    state, done, ep_reward = env.reset(), False, 0
+    while not done:
+        state_stack = np.roll(state_stack, -1, axis=-1)
+        state_stack[..., -1] = np.squeeze(state)
+        action = np.argmax(server.predict(state_stack))
+        state, reward, done, _ = env.step(action)
+        ep_reward += reward
+    rewards[i_episode] = ep_reward
+
+
+rewards = np.zeros(num_episodes)
+threads = [
+    threading.Thread(target=evaluate, args=(i_episode, rewards))
+    for i_episode in range(num_episodes)
+]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+
+print('Mean reward: {:.2f}'.format(np.mean(rewards)))
+print(server.get_stats())
+server.close()
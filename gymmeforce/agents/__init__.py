@@ -1,7 +1,29 @@
-from gymmeforce.agents.base_agent import BaseAgent
-from gymmeforce.agents.batch_agent import BatchAgent
-from gymmeforce.agents.replay_agent import ReplayAgent
-from gymmeforce.agents.vanilla_pg_agent import VanillaPGAgent
-from gymmeforce.agents.actor_critic_agent import ActorCriticAgent
-from gymmeforce.agents.ppo_agent import PPOAgent
-from gymmeforce.agents.dqn_agent import DQNAgent
+import importlib
+
+# The agents are only imported when first accessed (PEP 562), importing
+# an agent module imports tensorflow and gym
+_AGENT_MODULES = {
+    'BaseAgent': 'gymmeforce.agents.base_agent',
+    'BatchAgent': 'gymmeforce.agents.batch_agent',
+    'ReplayAgent': 'gymmeforce.agents.replay_agent',
+    'VanillaPGAgent': 'gymmeforce.agents.vanilla_pg_agent',
+    'ActorCriticAgent': 'gymmeforce.agents.actor_critic_agent',
+    'PPOAgent': 'gymmeforce.agents.ppo_agent',
+    'DQNAgent': 'gymmeforce.agents.dqn_agent',
+    'ApeXAgent': 'gymmeforce.agents.apex_agent',
+}
+
+__all__ = list(_AGENT_MODULES)
+
+
+def __getattr__(name):
+    if name not in _AGENT_MODULES:
+        raise AttributeError('module {} has no attribute {}'.format(__name__, name))
+    value = getattr(importlib.import_module(_AGENT_MODULES[name]), name)
+    # Cache it, __getattr__ is only called for missing attributes
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
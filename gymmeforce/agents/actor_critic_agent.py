@@ -1,26 +1,28 @@
 import numpy as np
 
 from gymmeforce.agents import VanillaPGAgent
-from gymmeforce.common.utils import discounted_sum_rewards
+from gymmeforce.common.utils import discounted_sum_episodes
 
 
 class ActorCriticAgent(VanillaPGAgent):
     def __init__(self, env_name, **kwargs):
         super().__init__(env_name, use_baseline=True, **kwargs)
 
-    def _add_advantages_and_vtarget(self, trajectory):
-        trajectory['baseline'] = self.model.compute_baseline(self.sess,
-                                                             trajectory['states'])
-        td_target = trajectory['rewards'] + self.gamma * np.append(
-            trajectory['baseline'][1:], 0)
+    def _add_advantages_and_vtarget(self, batch, episode_lengths):
+        batch['baseline'] = self._compute_baseline(batch['states'])
+        # The value after the last state of each episode is zero
+        next_baseline = np.append(batch['baseline'][1:], 0)
+        next_baseline[np.cumsum(episode_lengths) - 1] = 0
+        td_target = batch['rewards'] + self.gamma * next_baseline
         if self.use_gae:
-            td_residual = td_target - trajectory['baseline']
-            gae = discounted_sum_rewards(td_residual, self.gamma * self.gae_lambda)
-            trajectory['advantages'] = gae
-            trajectory['baseline_target'] = gae + trajectory['baseline']
+            td_residual = td_target - batch['baseline']
+            gae = discounted_sum_episodes(td_residual, episode_lengths,
+                                          self.gamma * self.gae_lambda)
+            batch['advantages'] = gae
+            batch['baseline_targets'] = gae + batch['baseline']
         else:
-            trajectory['advantages'] = trajectory['returns'] - trajectory['baseline']
-            trajectory['baseline_target'] = td_target
+            batch['advantages'] = batch['returns'] - batch['baseline']
+            batch['baseline_targets'] = td_target
 
     def train(self, learning_rate, use_gae=True, gae_lambda=0.95, **kwargs):
         self.use_gae = use_gae
@@ -0,0 +1,296 @@
+import multiprocessing as mp
+import os
+import queue
+
+import numpy as np
+
+from gymmeforce.agents import DQNAgent
+from gymmeforce.common.utils import ReplayBuffer
+
+
+class ApeXAgent(DQNAgent):
+    '''
+    Distributed DQN (https://arxiv.org/pdf/1803.00933.pdf) running on a single host.
+    Many actor processes (each with its own copy of the online network) generate
+    transitions and send them to the learner (this process), which stores them on
+    a replay buffer per actor, trains the network and periodically broadcasts
+    the new weights to the actors.
+
+    The actors are started with the 'spawn' method by default, so scripts
+    using this agent must be protected by an if __name__ == '__main__'
+
+    Args:
+        target_update_freq: Number of steps (summed over all actors) between each
+                            target update, like DQNAgent
+        Others are the same as DQNAgent
+    '''
+
+    def __init__(self, env_name, target_update_freq, **kwargs):
+        super().__init__(env_name, target_update_freq=target_update_freq, **kwargs)
+        # Used for creating the agents on the actor processes
+        self.agent_kwargs = dict(kwargs, target_update_freq=target_update_freq)
+        self.replay_buffers = None
+
+    def _start_actors(self, num_actors, actor_epsilon, actor_epsilon_alpha, send_freq,
+                      start_method):
+        ctx = mp.get_context(start_method)
+        self.stop_event = ctx.Event()
+        self.transitions_queue = ctx.Queue(maxsize=4 * num_actors)
+        self.weights_queues = [ctx.Queue(maxsize=1) for _ in range(num_actors)]
+        self.actors = []
+        epsilons = actor_exploration_rates(num_actors, actor_epsilon, actor_epsilon_alpha)
+        for i_actor, (weights_queue, epsilon) in enumerate(
+                zip(self.weights_queues, epsilons)):
+            actor = ctx.Process(
+                target=_actor,
+                args=(i_actor, self.env_name, self.agent_kwargs, epsilon, send_freq,
+                      self.transitions_queue, weights_queue, self.stop_event),
+                daemon=True)
+            actor.start()
+            self.actors.append(actor)
+
+    def _stop_actors(self):
+        self.stop_event.set()
+        # Actors may be blocked sending transitions
+        self._receive_transitions()
+        for actor in self.actors:
+            actor.join(timeout=10)
+            if actor.is_alive():
+                actor.terminate()
+
+    def _check_actors(self):
+        if not all(actor.is_alive() for actor in self.actors):
+            raise RuntimeError('An actor process exited unexpectedly')
+
+    def _broadcast_weights(self):
+        self._check_actors()
+        weights = self.model.get_weights(self.sess)
+        for weights_queue in self.weights_queues:
+            # Actors only need the newest weights, replace the ones not used yet
+            try:
+                weights_queue.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                weights_queue.put_nowait(weights)
+            except queue.Full:
+                pass
+
+    def _receive_transitions(self, block=False):
+        ''' Adds all transitions sent by the actors, returns the number received '''
+        num_received = 0
+        while True:
+            try:
+                # Only block for the first chunk
+                message = self.transitions_queue.get(block=block and num_received == 0,
+                                                     timeout=1)
+            except queue.Empty:
+                if block and num_received == 0:
+                    self._check_actors()
+                return num_received
+
+            i_actor, transitions, actor_steps, ep_rewards = message
+            self.replay_buffers[i_actor].add_sequence(
+                transitions['states'], transitions['actions'], transitions['rewards'],
+                transitions['dones'])
+            self.actors_steps[i_actor] = actor_steps
+            self.ep_rewards.extend(ep_rewards)
+            num_received += len(transitions['dones'])
+
+    def _sample_batch(self):
+        ''' Samples from each actor buffer proportionally to its size '''
+        lengths = np.array([buffer.current_len for buffer in self.replay_buffers])
+        batch_sizes = np.random.multinomial(self.batch_size, lengths / np.sum(lengths))
+        batches = [
+            buffer.sample(randomize_n_step=self.randomize_n_step, batch_size=batch_size)
+            for buffer, batch_size in zip(self.replay_buffers, batch_sizes)
+            if batch_size > 0
+        ]
+
+        return {
+            key: np.concatenate([batch[key] for batch in batches])
+            for key in batches[0]
+        }
+
+    def write_logs(self, batch):
+        if len(self.ep_rewards) > 0:
+            self.logger.add_log('Reward/Episode', np.mean(self.ep_rewards))
+        self.ep_rewards = []
+        self.model.write_logs(self.sess, self.logger)
+        self.logger.add_log(
+            'Learning Rate', self._calculate_schedule(self.learning_rate), precision=5)
+        self.logger.add_log('Learner Updates', self.i_update)
+        self.logger.timeit(self.i_step, max_steps=self.max_steps)
+        self.logger.log('Step {}/{} ({:.2f}%)'.format(self.i_step,
+                                                      int(self.max_steps),
+                                                      100 * self.i_step / self.max_steps))
+
+    def train(self,
+              n_step,
+              learning_rate,
+              replay_buffer_size,
+              max_steps,
+              num_actors=None,
+              actor_epsilon=0.4,
+              actor_epsilon_alpha=7,
+              randomize_n_step=False,
+              learning_freq=None,
+              weights_update_freq=400,
+              send_freq=50,
+              init_buffer_size=0.05,
+              batch_size=32,
+              log_steps=2e4,
+              start_method='spawn'):
+        '''
+        Trains the agent following these steps:
+            0. Start the actors, each actor steps its own env with an
+               epsilon-greedy policy and sends its transitions to the learner
+            1. Wait until the replay buffers are populated (init_buffer_size)
+            2. Sample the replay buffers and perform gradient descent
+            3. Every <weights_update_freq> updates send the new weights to the actors
+
+        Args:
+            n_step: Number of steps to use reward before bootstraping
+            learning_rate: Float or a function that returns a float
+                           when called with the current time step as input
+            replay_buffer_size: Maximum number of transitions stored (split
+                                between the actors)
+            max_steps: Number of steps (summed over all actors) to train the agent
+            num_actors: Number of actor processes (default number of cpus - 1)
+            actor_epsilon: Exploration rate of each actor is
+                           actor_epsilon ** (1 + i_actor / (num_actors - 1) * alpha)
+            actor_epsilon_alpha: See actor_epsilon
+            randomize_n_step: Choose a random n_step (from 1 to n_step) for each sample
+            learning_freq: If defined, limit the gradient descent updates to one
+                           for each <learning_freq> steps (like DQNAgent)
+            weights_update_freq: Number of updates between each weights broadcast
+            send_freq: Number of transitions the actors send at once
+            init_buffer_size: Percentage of buffer filled before the training starts
+            batch_size: Number of samples to use when creating mini-batch
+            log_steps: Number of steps between each log status
+            start_method: Multiprocessing start method used for the actors
+        '''
+        if num_actors is None:
+            num_actors = max(mp.cpu_count() - 1, 1)
+        self._maybe_create_tf_sess()
+        self._maybe_add_tensorboard_sink()
+        self.n_step = n_step
+        self.randomize_n_step = randomize_n_step
+        self.learning_rate = learning_rate
+        self.batch_size = batch_size
+        self.max_steps = max_steps
+        self.i_step = self.model.get_global_step(self.sess)
+        self.i_update = 0
+        self.actors_steps = np.zeros(num_actors, dtype=np.int64)
+        self.ep_rewards = []
+
+        # Each actor adds to its own buffer (the transitions must be sequential)
+        buffer_size = int(replay_buffer_size) // num_actors
+        self.replay_buffers = [
+            ReplayBuffer(
+                buffer_size,
+                history_length=self.history_length,
+                batch_size=batch_size,
+                n_step=n_step,
+                gamma=self.model.gamma) for _ in range(num_actors)
+        ]
+
+        self._start_actors(num_actors, actor_epsilon, actor_epsilon_alpha, send_freq,
+                           start_method)
+        self._broadcast_weights()
+        try:
+            # Populate replay buffers
+            init_len = max(buffer_size * init_buffer_size, batch_size)
+            while min(buffer.current_len for buffer in self.replay_buffers) < init_len:
+                self._receive_transitions(block=True)
+                print(
+                    '\rPopulating replay buffers: {:.1f}%'.format(
+                        100 * np.sum(self.actors_steps) / (init_len * num_actors)),
+                    end='',
+                    flush=True)
+            print('\rPopulating replay buffers: DONE!')
+
+            print('Started training')
+            self.model.update_target_net(self.sess)
+            start_step = self.i_step
+            first_step = np.sum(self.actors_steps)
+            last_log_step = self.i_step
+            while self.i_step < max_steps:
+                # Don't update more than once every <learning_freq> steps
+                block = (learning_freq is not None and
+                         self.i_update >= (self.i_step - first_step) / learning_freq)
+                self.last_i_step = self.i_step
+                if self._receive_transitions(block=block) > 0:
+                    self.i_step = start_step + np.sum(self.actors_steps) - first_step
+                if self._crossed_interval(self.target_update_freq):
+                    self.model.update_target_net(self.sess)
+                if block:
+                    continue
+
+                batch = self._get_batch()
+                lr = self._calculate_schedule(self.learning_rate)
+                self.model.fit(self.sess, batch, lr)
+                self.i_update += 1
+
+                if self.i_update % weights_update_freq == 0:
+                    self._broadcast_weights()
+
+                # Write logs
+                if self.i_step // log_steps > last_log_step // log_steps:
+                    self.model.increase_global_step(self.sess,
+                                                    self.i_step - last_log_step)
+                    last_log_step = self.i_step
+                    self.write_logs(batch)
+                    self.save()
+        finally:
+            self._stop_actors()
+            self.logger.flush()
+
+
+def actor_exploration_rates(num_actors, actor_epsilon, actor_epsilon_alpha):
+    ''' Each actor explores with a different epsilon (see ApeXAgent.train) '''
+    return actor_epsilon**(
+        1 + np.arange(num_actors) / max(num_actors - 1, 1) * actor_epsilon_alpha)
+
+
+def _set_newest_weights(agent, weights_queue):
+    ''' Uses the newest weights sent by the learner (if any) '''
+    try:
+        agent.model.set_weights(agent.sess, weights_queue.get_nowait())
+    except queue.Empty:
+        pass
+
+
+def _actor(i_actor, env_name, agent_kwargs, epsilon, send_freq, transitions_queue,
+           weights_queue, stop_event):
+    # Actors run on cpu, with a single thread each
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    import tensorflow as tf
+    # Exit without waiting for the learner to receive the last transitions
+    transitions_queue.cancel_join_thread()
+
+    agent = DQNAgent(env_name, **agent_kwargs)
+    agent.sess = tf.Session(config=tf.ConfigProto(
+        intra_op_parallelism_threads=1, inter_op_parallelism_threads=1))
+    agent.model.initialize(agent.sess)
+    agent.exploration_rate = epsilon
+    ep_runner = agent._create_ep_runner(monitor_dir='videos/actor_{}'.format(i_actor))
+    chunks = ep_runner.run_chunks(send_freq, agent._select_action_fn(ep_runner))
+    num_episodes = 0
+
+    while not stop_event.is_set():
+        _set_newest_weights(agent, weights_queue)
+
+        chunk = next(chunks)
+        transitions = {key: chunk[key] for key in ['states', 'actions', 'rewards', 'dones']}
+        ep_rewards = ep_runner.get_episode_rewards()[num_episodes:]
+        num_episodes += len(ep_rewards)
+        message = (i_actor, transitions, ep_runner.get_number_steps(), ep_rewards)
+
+        # The learner may be too busy to receive new transitions
+        while not stop_event.is_set():
+            try:
+                transitions_queue.put(message, timeout=1)
+                break
+            except queue.Full:
+                pass
@@ -1,41 +1,77 @@
+import hashlib
 import os
+import pickle
+from functools import partial
 
-import gym
 import numpy as np
 import tensorflow as tf
-from gym import wrappers
 
-from gymmeforce.common.runner import EpisodeRunner
+from gymmeforce.common.inference_graph import freeze_inference_graph
+from gymmeforce.common.log_sinks import TensorBoardSink
+from gymmeforce.common.runner import EpisodeRunner, VecEpisodeRunner
 from gymmeforce.common.print_utils import Logger
 from gymmeforce.common.utils import Scaler
+from gymmeforce.common.vec_env import SubprocVecEnv, VecEnv
+
+
+# Env configs are cached here, set GYMMEFORCE_CACHE_DIR to change it
+ENV_CONFIG_CACHE_DIR = os.environ.get(
+    'GYMMEFORCE_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache',
+                                         'gymmeforce'))
 
 
 # TODO: Maybe wrap env outside of class??
 class BaseAgent:
+    '''
+    Args:
+        cache_env_config: Cache the env config (state shape and type, action space)
+            on disk, so the env is only created for reading it the first time the
+            env is used with the same wrapper config. Only wrappers declaring their
+            config with get_config() are cached (default True)
+        profile: Time the phases of the training loop (env step, action selection,
+            fit, ...) and add their total time and p50/p99 latency to the logs
+            (default False)
+        trace_path: If profiling, also write the phases as Chrome trace events
+            to this file (default None)
+        log_sinks: List of LogSink (e.g. JSONLSink, CSVSink) also receiving the logs,
+            besides TensorBoard (default None)
+    '''
+
     def __init__(self,
                  env_name,
                  log_dir='data/examples',
                  env_wrapper=None,
                  scale_states=False,
                  debug=False,
+                 cache_env_config=True,
+                 profile=False,
+                 trace_path=None,
+                 log_sinks=None,
                  **kwargs):
         self.env_name = env_name
         self.log_dir = log_dir
         self.env_wrapper = env_wrapper
-        self.logger = Logger(debug)
+        self.logger = Logger(
+            debug, profile=profile, trace_path=trace_path, sinks=log_sinks)
+        self.tensorboard_sink = None
         self.model = None
         self.sess = None
         self.env_config = {'env_name': env_name, 'env_wrapper': env_wrapper}
         self.play_ep_runner = None
         self.train_ep_runner = None
+        self.num_envs = 1
 
-        self._create_env_config()
+        if cache_env_config:
+            self._load_or_create_env_config()
+        else:
+            self._create_env_config()
 
-        scaler_path = os.path.join(self.log_dir, 'scaler.pkl')
+        scaler_path = os.path.join(self.log_dir, 'scaler.npz')
         self.scaler = Scaler.initialize_or_load(self.env_config['state_shape'],
                                                 scaler_path) if scale_states else None
 
     def _create_env_config(self):
+        import gym
         env = gym.make(self.env_name)
         # Adds additional wrappers
         if self.env_wrapper is not None:
@@ -43,6 +79,8 @@ class BaseAgent:
         # Get env information
         state = env.reset()
         self.env_config['state_shape'] = np.squeeze(state).shape
+        # Subclasses can modify state_shape (e.g. stacking states)
+        self.env_config['env_state_shape'] = self.env_config['state_shape']
         if state.dtype == np.uint8:
             self.env_config['input_type'] = tf.uint8
         else:
@@ -58,8 +96,54 @@ class BaseAgent:
             self.env_config['action_low_bound'] = env.action_space.low
             self.env_config['action_high_bound'] = env.action_space.high
 
+    def _env_config_cache_path(self):
+        ''' Returns None if the wrapper does not declare its config '''
+        # The wrapper config is part of the key, it can change the states
+        wrapper_config = None
+        if self.env_wrapper is not None:
+            if not hasattr(self.env_wrapper, 'get_config'):
+                return None
+            wrapper_config = (type(self.env_wrapper).__name__,
+                              sorted(self.env_wrapper.get_config().items()))
+        key = repr((self.env_name, wrapper_config)).encode()
+        return os.path.join(ENV_CONFIG_CACHE_DIR, 'env_configs',
+                            hashlib.sha1(key).hexdigest() + '.pkl')
+
+    def _load_or_create_env_config(self):
+        path = self._env_config_cache_path()
+        if path is None:
+            self._create_env_config()
+            return
+
+        try:
+            with open(path, 'rb') as f:
+                config = pickle.load(f)
+            config['input_type'] = tf.as_dtype(config['input_type'])
+            self.env_config.update(config)
+            return
+        # Unreadable or stale (e.g. pickled by another version), rebuilt below
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError,
+                ValueError, KeyError, TypeError):
+            pass
+
+        self._create_env_config()
+        config = {
+            key: value
+            for key, value in self.env_config.items()
+            if key not in ['env_name', 'env_wrapper']
+        }
+        config['input_type'] = config['input_type'].name
+        # Write to a temporary file first, concurrent jobs may be reading it
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(config, f)
+        os.replace(tmp_path, path)
+
     def _create_env(self, monitor_dir, record_freq=None, max_episode_steps=None,
                     **kwargs):
+        import gym
+        from gym import wrappers
         monitor_path = os.path.join(self.log_dir, monitor_dir)
         env = gym.make(self.env_name)
         if max_episode_steps is not None:
@@ -76,6 +160,45 @@ class BaseAgent:
 
         return monitored_env, env
 
+    def _create_vec_env(self,
+                        monitor_dir,
+                        num_envs,
+                        record_freq=None,
+                        subproc_envs=False,
+                        **kwargs):
+        # Only the first env is recorded
+        env_fns = [
+            partial(
+                self._create_env,
+                monitor_dir=os.path.join(monitor_dir, 'env_{}'.format(i_env)),
+                record_freq=record_freq if i_env == 0 else None,
+                **kwargs) for i_env in range(num_envs)
+        ]
+
+        if subproc_envs:
+            state_dtype = self.env_config['input_type'].as_numpy_dtype
+            return SubprocVecEnv(env_fns, self.env_config['env_state_shape'], state_dtype)
+
+        monitored_envs, envs = zip(*[env_fn() for env_fn in env_fns])
+        return VecEnv(list(envs), list(monitored_envs))
+
+    def _create_vec_ep_runner(self, vec_env):
+        return VecEpisodeRunner(vec_env, self.scaler, phase_fn=self.logger.phase)
+
+    def _create_ep_runner(self, monitor_dir, num_envs=1, **kwargs):
+        if num_envs > 1:
+            vec_env = self._create_vec_env(monitor_dir, num_envs, **kwargs)
+            return self._create_vec_ep_runner(vec_env)
+
+        monitored_env, env = self._create_env(monitor_dir=monitor_dir, **kwargs)
+        return EpisodeRunner(env, monitored_env, self.scaler, phase_fn=self.logger.phase)
+
+    def _select_action_fn(self, ep_runner):
+        ''' VecEpisodeRunner selects the actions of all envs with a single call '''
+        if isinstance(ep_runner, VecEpisodeRunner):
+            return self.select_actions
+        return self.select_action
+
     def _calculate_schedule(self, schedule):
         if callable(schedule):
             value = schedule(self.i_step)
@@ -94,8 +217,22 @@ class BaseAgent:
             self.sess = tf.Session(config=config)
             self.model.load_or_initialize(self.sess)
 
+    def _maybe_add_tensorboard_sink(self):
+        ''' The logs are written to TensorBoard on a background thread '''
+        if self.tensorboard_sink is None:
+            # Same event files and steps as the model summaries
+            self.tensorboard_sink = TensorBoardSink(
+                writer=self.model.get_summary_writer())
+            self.logger.add_sink(self.tensorboard_sink)
+            self.logger.step_fn = lambda: self.model.get_global_step(self.sess)
+
+    def _crossed_interval(self, interval):
+        ''' Number of multiples of <interval> passed by the last environment steps '''
+        return int(self.i_step // interval - self.last_i_step // interval)
+
     def _step_and_check_termination(self):
         self.i_iter += 1
+        self.last_i_step = self.i_step
         self.i_episode = self.train_ep_runner.get_number_episodes()
         self.i_step = self.train_ep_runner.get_number_steps()
 
@@ -109,6 +246,10 @@ class BaseAgent:
     def select_action(self, state):
         raise NotImplementedError
 
+    def select_actions(self, states):
+        ''' Selects one action for each state of a batch (used by VecEpisodeRunner) '''
+        raise NotImplementedError
+
     def play(self, render=True, record_freq=1, **kwargs):
         self._maybe_create_tf_sess()
 
@@ -119,17 +260,25 @@ class BaseAgent:
             self.play_ep_runner = EpisodeRunner(env, monitored_env, self.scaler)
 
         self.play_ep_runner.run_one_episode(
-            render=render, select_action_fn=self.select_action)
+            render=render, select_action_fn=self._select_action_fn(self.play_ep_runner))
 
-    def train(self, max_iters=-1, max_episodes=-1, max_steps=-1, **kwargs):
+    def train(self, max_iters=-1, max_episodes=-1, max_steps=-1, num_envs=1, **kwargs):
+        '''
+        Kwargs:
+            num_envs: Number of envs stepped in lockstep, the actions of all envs
+                      are selected with a single batched call (default 1)
+            subproc_envs: Run each env on its own process when num_envs > 1
+                          (default False)
+        '''
         # Create Session
         self._maybe_create_tf_sess()
-        self.logger.add_tf_writer(self.sess, self.model.summary_scalar)
+        self._maybe_add_tensorboard_sink()
 
         # Create environment
         if self.train_ep_runner is None:
-            monitored_env, env = self._create_env(monitor_dir='videos/train', **kwargs)
-            self.train_ep_runner = EpisodeRunner(env, monitored_env, self.scaler)
+            self.num_envs = num_envs
+            self.train_ep_runner = self._create_ep_runner(
+                monitor_dir='videos/train', num_envs=num_envs, **kwargs)
 
         self.max_iters = max_iters
         self.max_episodes = max_episodes
@@ -137,10 +286,11 @@ class BaseAgent:
         self.i_iter = 0
         self.i_episode = self.train_ep_runner.get_number_episodes()
         self.i_step = self.model.get_global_step(self.sess)
+        self.last_i_step = self.i_step - 1
         self.last_logged_ep = self.i_episode
 
     def write_logs(self, batch):
-        ep_rewards = self.train_ep_runner.monitored_env.get_episode_rewards()
+        ep_rewards = self.train_ep_runner.get_episode_rewards()
         new_eps = abs(self.last_logged_ep - self.i_episode)
         self.last_logged_ep = self.i_episode
 
@@ -153,6 +303,11 @@ class BaseAgent:
     def update_scaler(self, states):
         self.scaler.update(states)
 
+    def export_inference_graph(self, path):
+        ''' Exports the model as a frozen graph (see common/inference_graph.py) '''
+        self._maybe_create_tf_sess()
+        freeze_inference_graph(self.sess, path)
+
     def save(self):
         self.model.save(self.sess)
         if self.scaler is not None:
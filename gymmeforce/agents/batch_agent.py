@@ -47,19 +47,21 @@ class BatchAgent(BaseAgent):
         trajectories = []
 
         while True:
-            trajectory = ep_runner.run_one_episode(select_action_fn=self.select_action)
+            trajectory = ep_runner.run_one_episode(
+                select_action_fn=self._select_action_fn(ep_runner))
             trajectories.append(trajectory)
             total_steps += trajectory['rewards'].shape[0]
 
+            # Only the new states are needed for updating the statistics
             if self.scaler is not None:
-                unscaled = np.concatenate(
-                    [traj['unscaled_states'] for traj in trajectories])
-                self.update_scaler(unscaled)
+                self.update_scaler(trajectory['unscaled_states'])
 
             if (total_steps // timesteps_per_batch >= 1
                     or len(trajectories) // episodes_per_batch >= 1):
                 break
 
+        # The next batch is generated by the updated policy
+        ep_runner.discard_unfinished()
         # Update global step
         self.model.increase_global_step(self.sess, total_steps)
         return trajectories
@@ -1,7 +1,7 @@
 import numpy as np
 
 from gymmeforce.agents import ReplayAgent
-from gymmeforce.common.utils import calculate_n_step_return
+from gymmeforce.common.utils import BatchPrefetcher
 from gymmeforce.models import DQNModel
 
 
@@ -10,15 +10,24 @@ class DQNAgent(ReplayAgent):
         super().__init__(env_name, **kwargs)
         self._create_model(**kwargs)
         self.target_update_freq = target_update_freq
+        self.prefetcher = None
 
     def _create_model(self, **kwargs):
         self.model = DQNModel(self.env_config, **kwargs)
 
-    def _calculate_n_step_return(self, batch):
-        batch['rewards'], batch['dones'] = zip(*[
-            calculate_n_step_return(r, d)
-            for r, d in zip(batch['rewards'], batch['dones'])
-        ])
+    def _create_replay_buffer(self, maxlen, history_length, **kwargs):
+        if self.model.replay_buffer is None:
+            return super()._create_replay_buffer(
+                maxlen, history_length=history_length, **kwargs)
+
+        unsupported = ['prioritized_replay', 'memmap_replay_buffer', 'compression',
+                       'storage_dtype']
+        for name in unsupported:
+            assert not kwargs.pop(name, None), \
+                'The graph replay buffer does not support {}'.format(name)
+        kwargs.pop('replay_buffer_dir', None)
+        self.model.replay_buffer.allocate(self.sess, maxlen, **kwargs)
+        return self.model.replay_buffer
 
     def _calculate_epsilon(self):
         if callable(self.exploration_rate):
@@ -29,16 +38,16 @@ class DQNAgent(ReplayAgent):
         return epsilon
 
     def _get_batch(self):
-        if self.randomize_n_step == True:
-            random_n_step = np.random.randint(1, self.n_step + 1)
-        else:
-            random_n_step = self.n_step
+        if self.prefetcher is not None:
+            return self.prefetcher.get()
+        return self._sample_batch()
 
-        batch = self.replay_buffer.sample(random_n_step)
-        self._calculate_n_step_return(batch)
-        batch['n_step'] = random_n_step
-
-        return batch
+    def _sample_batch(self):
+        if self.prioritized_replay:
+            return self.replay_buffer.sample(
+                randomize_n_step=self.randomize_n_step,
+                beta=self._calculate_schedule(self.prioritized_beta))
+        return self.replay_buffer.sample(randomize_n_step=self.randomize_n_step)
 
     def select_action(self, state):
         # Concatenates <history_length> states
@@ -50,15 +59,30 @@ class DQNAgent(ReplayAgent):
         if np.random.random() <= self.epsilon:
             action = np.random.choice(self.env_config['num_actions'])
         else:
-            Q_values = self.model.predict(self.sess, state_hist[np.newaxis])
+            with self.logger.phase('select_action'):
+                Q_values = self.model.predict(self.sess, state_hist[np.newaxis])
             action = np.argmax(Q_values)
 
         return action
 
+    def select_actions(self, states):
+        # <states> are already stacked by the VecEpisodeRunner
+        self.epsilon = self._calculate_epsilon()
+        explore = np.random.random(len(states)) <= self.epsilon
+        actions = np.random.choice(self.env_config['num_actions'], size=len(states))
+        if not np.all(explore):
+            with self.logger.phase('select_action'):
+                Q_values = self.model.predict(self.sess, states)
+            actions = np.where(explore, actions, np.argmax(Q_values, axis=1))
+
+        return actions
+
     def write_logs(self, batch):
         super().write_logs(batch)
 
         self.logger.add_log('Exploration Rate', self.epsilon, precision=3)
+        for name, value in self.replay_buffer.get_stats().items():
+            self.logger.add_log('Replay Buffer/{}'.format(name), value, precision=4)
 
         self.logger.log('Step {}/{} ({:.2f}%)'.format(self.i_step,
                                                       int(self.max_steps),
@@ -70,6 +94,14 @@ class DQNAgent(ReplayAgent):
               exploration_rate,
               replay_buffer_size,
               randomize_n_step=False,
+              prioritized_replay=False,
+              prioritized_alpha=0.6,
+              prioritized_beta=0.4,
+              memmap_replay_buffer=False,
+              replay_buffer_dir=None,
+              replay_buffer_compression=None,
+              replay_buffer_dtype=None,
+              prefetch_batches=0,
               learning_freq=4,
               init_buffer_size=0.05,
               batch_size=32,
@@ -93,7 +125,23 @@ class DQNAgent(ReplayAgent):
                                   (see utils.linear_decay as an example)
             replay_buffer_size: Maximum number of transitions stored on replay buffer
             target_update_freq: Number of steps between each target update
-            randomize_n_step: Choose a random n_step (from 1 to n_step) each batch
+            randomize_n_step: Choose a random n_step (from 1 to n_step) for each sample
+            prioritized_replay: Sample transitions proportionally to their td error
+            prioritized_alpha: How much prioritization is used (0 is uniform sampling)
+            prioritized_beta: Float or function of the time step, amount of importance
+                              sampling correction (1 fully compensates the
+                              non-uniform probabilities)
+            memmap_replay_buffer: Store the replay buffer on memory-mapped files,
+                                  which are reopened when training is resumed
+            replay_buffer_dir: Directory of the memory-mapped files
+                               (default <log_dir>/replay_buffer)
+            replay_buffer_compression: Store each state compressed on the replay
+                                       buffer, 'lz4' or 'zlib' (default None)
+            replay_buffer_dtype: Store the states on the replay buffer as 'float16',
+                                 'uint8' or 'uint16' (quantized), for the float
+                                 states of non-image envs (default None)
+            prefetch_batches: Number of mini-batches sampled ahead on a background
+                              thread (default 0, samples on the training loop)
             target_soft_update: Percentage of online weigth value to copy to target on
                                 each update, (e.g. 1 makes target weights = online weights)
             gamma: Discount factor on sum of rewards
@@ -112,43 +160,119 @@ class DQNAgent(ReplayAgent):
         super().train(**kwargs)
         self.n_step = n_step
         self.randomize_n_step = randomize_n_step
+        self.prioritized_replay = prioritized_replay
+        self.prioritized_beta = prioritized_beta
         self.learning_rate = learning_rate
         self.exploration_rate = exploration_rate
         self.i_step = self.model.get_global_step(self.sess)
 
-        self._populate_replay_buffer(self.train_ep_runner, replay_buffer_size,
-                                     init_buffer_size, batch_size, n_step)
+        graph_replay = self.model.replay_buffer is not None
+        # Checked before populating, which already stacks the states
+        if graph_replay:
+            assert prefetch_batches == 0 and not self.share_replay_frames, \
+                'The graph replay buffer is only sampled in-graph, it does not ' \
+                'support prefetch_batches or share_replay_frames'
+
+        buffer_kwargs = dict(alpha=prioritized_alpha) if prioritized_replay else dict()
+        if replay_buffer_dtype is not None and self.scaler is not None:
+            # The stored states are already scaled (3 stds are +/- 1)
+            buffer_kwargs['quantization_range'] = (-2, 2)
+        self._populate_replay_buffer(
+            self.train_ep_runner,
+            replay_buffer_size,
+            init_buffer_size,
+            batch_size,
+            n_step,
+            self.model.gamma,
+            prioritized_replay=prioritized_replay,
+            memmap_replay_buffer=memmap_replay_buffer,
+            replay_buffer_dir=replay_buffer_dir,
+            compression=replay_buffer_compression,
+            storage_dtype=replay_buffer_dtype,
+            **buffer_kwargs)
+        # From now on the steps are counted by the monitored envs
+        self.i_step = self.train_ep_runner.get_number_steps()
+        self.last_i_step = self.i_step - self.num_envs
+
+        if prefetch_batches > 0:
+            self.prefetcher = BatchPrefetcher(
+                self._sample_batch, self.replay_lock, depth=prefetch_batches)
+        if graph_replay:
+            # The last chunk is only uploaded when full
+            self.replay_buffer.flush()
+            min_len = batch_size + (n_step + self.history_length) * self.num_envs
+            assert self.replay_buffer.uploaded_len >= min_len, \
+                'Sampling needs at least {} transitions, increase ' \
+                'init_buffer_size'.format(min_len)
+            # The batches are sampled by the training steps
+            batch = {'randomize_n_step': self.randomize_n_step}
 
         print('Started training')
-        reward_sum = 0
+        reward_sum = np.zeros(self.num_envs)
         # TODO: soft updating here, need to hard copy weights
         self.model.update_target_net(self.sess)
-        while True:
-            trajectory = self._play_and_add_to_buffer(self.train_ep_runner)
-            reward_sum += trajectory['reward']
-
-            if trajectory['done']:
-                self.logger.add_log('Reward/Life', reward_sum)
-                reward_sum = 0
-
-            # Perform gradient descent
-            if self.i_step % learning_freq == 0:
-                batch = self._get_batch()
-                lr = self._calculate_schedule(self.learning_rate)
-                self.model.fit(self.sess, batch, lr)
-
-            # Update target network
-            if self.i_step % self.target_update_freq == 0:
-                self.model.update_target_net(self.sess)
-
-            # Write logs
-            if self.i_step % log_steps == 0:
-                self.model.increase_global_step(self.sess, log_steps)
-                self.write_logs(batch)
-                self.save()
-
-            if self._step_and_check_termination():
-                break
+        # The prefetcher thread is stopped even if training fails
+        try:
+            while True:
+                # Envs running on subprocesses step while the network is trained
+                self._start_playing(self.train_ep_runner)
+
+                # The summaries are fetched by the last update before writing the logs
+                write_logs = self._crossed_interval(log_steps) > 0
+                if write_logs:
+                    self.model.increase_global_step(self.sess, log_steps)
+
+                # Perform gradient descent (multiple times if using multiple envs)
+                num_updates = self._crossed_interval(learning_freq)
+                if graph_replay and num_updates > 0:
+                    lr = self._calculate_schedule(self.learning_rate)
+                    with self.logger.phase('fit'):
+                        self.model.fit(
+                            self.sess,
+                            batch,
+                            lr,
+                            write_summaries=write_logs,
+                            num_steps=num_updates)
+                    num_updates = 0
+                for i_update in range(num_updates):
+                    with self.logger.phase('sample'):
+                        batch = self._get_batch()
+                    lr = self._calculate_schedule(self.learning_rate)
+                    with self.logger.phase('fit'):
+                        td_errors = self.model.fit(
+                            self.sess,
+                            batch,
+                            lr,
+                            write_summaries=write_logs and i_update == num_updates - 1)
+                    if self.prioritized_replay:
+                        with self.logger.phase('update_priorities'), self.replay_lock:
+                            self.replay_buffer.update_priorities(batch['idxs'], td_errors)
+
+                # Update target network
+                if self._crossed_interval(self.target_update_freq):
+                    self.model.update_target_net(self.sess)
+
+                trajectory = self._finish_playing_and_add_to_buffer(self.train_ep_runner)
+                reward_sum += trajectory['reward']
+
+                for i_env in np.flatnonzero(trajectory['done']):
+                    self.logger.add_log('Reward/Life', reward_sum[i_env])
+                    reward_sum[i_env] = 0
+
+                # Write logs
+                if write_logs:
+                    with self.logger.phase('write_logs'):
+                        self.write_logs(batch)
+                    with self.logger.phase('save'):
+                        self.save()
+
+                if self._step_and_check_termination():
+                    break
+        finally:
+            if self.prefetcher is not None:
+                self.prefetcher.close()
+                self.prefetcher = None
+        self.logger.flush()
 
     def play(self, exploration_rate=0.05, **kwargs):
         self.exploration_rate = exploration_rate
@@ -1,37 +1,120 @@
+import os
+import threading
+
+import numpy as np
+
 from gymmeforce.agents.base_agent import BaseAgent
-from gymmeforce.common.utils import ReplayBuffer, RingBuffer
+from gymmeforce.common.runner import VecEpisodeRunner
+from gymmeforce.common.utils import PrioritizedReplayBuffer, ReplayBuffer, RingBuffer
 
 
 class ReplayAgent(BaseAgent):
-    def __init__(self, env_name, history_length=4, **kwargs):
+    '''
+    Args:
+        history_length: Number of sequential states stacked as the model input
+        share_replay_frames: When using multiple envs, stack the states used for
+                             acting with the previous states stored on the replay
+                             buffer, instead of keeping a copy of them for each env
+    '''
+
+    def __init__(self, env_name, history_length=4, share_replay_frames=False, **kwargs):
         super().__init__(env_name, **kwargs)
         self.history_length = history_length
+        self.share_replay_frames = share_replay_frames
         self.replay_buffer = None
+        # Held when modifying the replay buffer (batches can be sampled on another thread)
+        self.replay_lock = threading.Lock()
         # Keep track of past states
-        self.states_history = RingBuffer(self.env_config['state_shape'], history_length)
+        dtype = self.env_config['input_type'].as_numpy_dtype
+        self.states_history = RingBuffer(
+            self.env_config['state_shape'],
+            history_length,
+            dtype=dtype if self.scaler is None else np.float32)
         self.env_config['state_shape'] += (self.history_length, )
 
+    def _create_vec_ep_runner(self, vec_env):
+        if self.share_replay_frames:
+            return VecEpisodeRunner(
+                vec_env,
+                self.scaler,
+                stack_states_fn=self._stack_recent_states,
+                phase_fn=self.logger.phase)
+        # Each env keeps its own history of states
+        return VecEpisodeRunner(
+            vec_env,
+            self.scaler,
+            history_length=self.history_length,
+            phase_fn=self.logger.phase)
+
+    def _select_action_fn(self, ep_runner):
+        if isinstance(ep_runner, VecEpisodeRunner):
+            return self.select_actions
+
+        def select_action(state):
+            # The stacks used for acting never mix episodes (like the sampled ones)
+            if ep_runner.new_episode:
+                self.states_history.reset()
+            return self.select_action(state)
+
+        return select_action
+
+    def _stack_recent_states(self, states):
+        # The replay buffer is only created when training starts, the lock is
+        # needed because reading compressed frames updates their cache
+        with self.replay_lock:
+            return self.replay_buffer.stack_recent_states(states)
+
     def _play_and_add_to_buffer(self, ep_runner):
-        trajectory = ep_runner.run_one_step(self.select_action)
+        self._start_playing(ep_runner)
+        return self._finish_playing_and_add_to_buffer(ep_runner)
+
+    def _start_playing(self, ep_runner):
+        ''' The envs can step in the background (e.g. with SubprocVecEnv) '''
+        ep_runner.step_async(self._select_action_fn(ep_runner))
+
+    def _finish_playing_and_add_to_buffer(self, ep_runner):
+        # The env steps are timed by the ep_runner
+        trajectory = ep_runner.step_wait()
         # Store experience
-        self.replay_buffer.add(trajectory['state'], trajectory['action'],
-                               trajectory['reward'], trajectory['done'])
+        with self.logger.phase('replay_add'), self.replay_lock:
+            self.replay_buffer.add(trajectory['state'], trajectory['action'],
+                                   trajectory['reward'], trajectory['done'])
 
         return trajectory
 
+    def _create_replay_buffer(self,
+                              maxlen,
+                              prioritized_replay=False,
+                              memmap_replay_buffer=False,
+                              replay_buffer_dir=None,
+                              **kwargs):
+        buffer_cls = PrioritizedReplayBuffer if prioritized_replay else ReplayBuffer
+        if not memmap_replay_buffer:
+            return buffer_cls(maxlen, **kwargs)
+
+        # Reopen the buffer of a previous run (if exists)
+        if replay_buffer_dir is None:
+            replay_buffer_dir = os.path.join(self.log_dir, 'replay_buffer')
+        return buffer_cls.initialize_or_load(
+            maxlen, storage_dir=replay_buffer_dir, **kwargs)
+
     def _populate_replay_buffer(self, ep_runner, replay_buffer_size, init_buffer_size,
-                                batch_size, n_step):
+                                batch_size, n_step, gamma, **kwargs):
         # Create replay buffer
         if self.replay_buffer is None:
             print('Creating replay buffer')
-            self.replay_buffer = ReplayBuffer(
-                int(replay_buffer_size),
+            self.replay_buffer = self._create_replay_buffer(
+                int(replay_buffer_size) // self.num_envs * self.num_envs,
                 history_length=self.history_length,
                 batch_size=batch_size,
-                n_step=n_step)
+                n_step=n_step,
+                gamma=gamma,
+                num_envs=self.num_envs,
+                **kwargs)
 
-            # Populate replay buffer with random agent
-            num_init_replays = replay_buffer_size * init_buffer_size
+            # Populate replay buffer with random agent (a reloaded buffer may be full)
+            num_init_replays = max(0, replay_buffer_size * init_buffer_size -
+                                   self.replay_buffer.current_len) / self.num_envs
             self.epsilon = 1
             for i in range(int(num_init_replays)):
                 self._play_and_add_to_buffer(ep_runner)
@@ -44,3 +127,9 @@ class ReplayAgent(BaseAgent):
                         flush=True)
 
             print('\rPopulating replay buffer: DONE!')
+
+    def save(self):
+        super().save()
+        if self.replay_buffer is not None and self.replay_buffer.storage_dir is not None:
+            with self.replay_lock:
+                self.replay_buffer.save()
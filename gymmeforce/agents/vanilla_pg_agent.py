@@ -1,7 +1,7 @@
 import numpy as np
 
 from gymmeforce.agents import BatchAgent
-from gymmeforce.common.utils import discounted_sum_rewards, explained_variance
+from gymmeforce.common.utils import discounted_sum_episodes, explained_variance
 from gymmeforce.models import VanillaPGModel
 
 
@@ -22,30 +22,40 @@ class VanillaPGAgent(BatchAgent):
         value_graph: Function returning a tensorflow graph representing the value function
             (default None)
         log_dir: Directory used for writing logs (default 'logs/examples')
+        baseline_batch_size: Maximum number of states evaluated at once when
+            computing the baseline (default 4096)
     '''
 
-    def __init__(self, env_name, normalize_advantages=False, **kwargs):
+    def __init__(self,
+                 env_name,
+                 normalize_advantages=False,
+                 baseline_batch_size=4096,
+                 **kwargs):
         super(VanillaPGAgent, self).__init__(env_name, **kwargs)
         self.model = self._create_model(**kwargs)
         self.normalize_advantages = normalize_advantages
+        self.baseline_batch_size = baseline_batch_size
 
     def _create_model(self, **kwargs):
         return VanillaPGModel(self.env_config, **kwargs)
 
-    def _add_discounted_returns(self, trajectory):
-        discounted_returns = discounted_sum_rewards(trajectory['rewards'], self.gamma)
-        trajectory['returns'] = discounted_returns
+    def _compute_baseline(self, states):
+        return self.model.compute_baseline(
+            self.sess, states, batch_size=self.baseline_batch_size)
 
-    def _add_advantages_and_vtarget(self, trajectory):
+    def _add_discounted_returns(self, batch, episode_lengths):
+        batch['returns'] = discounted_sum_episodes(batch['rewards'], episode_lengths,
+                                                   self.gamma)
+
+    def _add_advantages_and_vtarget(self, batch, episode_lengths):
         if self.model.use_baseline:
             # This is the classical way to fit vtarget (directly by the return)
             # TODO: Should a option to bootstrap be added?
-            trajectory['baseline_target'] = trajectory['returns']
-            trajectory['baseline'] = self.model.compute_baseline(
-                self.sess, trajectory['states'])
-            trajectory['advantages'] = trajectory['returns'] - trajectory['baseline']
+            batch['baseline_targets'] = batch['returns']
+            batch['baseline'] = self._compute_baseline(batch['states'])
+            batch['advantages'] = batch['returns'] - batch['baseline']
         else:
-            trajectory['advantages'] = trajectory['returns']
+            batch['advantages'] = batch['returns']
 
     def _normalize_advantages(self, batch):
         mean_adv = np.mean(batch['advantages'])
@@ -53,35 +63,31 @@ class VanillaPGAgent(BatchAgent):
         batch['advantages'] = (batch['advantages'] - mean_adv) / (std_adv + 1e-7)
 
     def select_action(self, state):
-        action = self.model.select_action(self.sess, state)
+        with self.logger.phase('select_action'):
+            action = self.model.select_action(self.sess, state)
         if self.env_config['action_space'] == 'continuous':
             action = action[0]
 
         return action
 
+    def select_actions(self, states):
+        with self.logger.phase('select_action'):
+            actions = self.model.select_actions(self.sess, states)
+        if self.env_config['action_space'] == 'continuous':
+            return np.reshape(actions, (len(states), -1))
+
+        return np.reshape(actions, (len(states), ))
+
     def generate_batch(self, **kwargs):
+        ''' Concatenates all trajectories and computes the targets for all at once '''
         trajectories = self.generate_trajectories(**kwargs)
-        for trajectory in trajectories:
-            self._add_discounted_returns(trajectory)
-            self._add_advantages_and_vtarget(trajectory)
-
+        episode_lengths = [len(traj['rewards']) for traj in trajectories]
         self.batch = {
-            'states':
-            np.concatenate([traj['states'] for traj in trajectories]),
-            'actions':
-            np.concatenate([traj['actions'] for traj in trajectories]),
-            'rewards':
-            np.concatenate([traj['rewards'] for traj in trajectories]),
-            'returns':
-            np.concatenate([traj['returns'] for traj in trajectories]),
-            'advantages':
-            np.concatenate([traj['advantages'] for traj in trajectories]),
-            # Change to vtarg
-            'baseline':
-            np.concatenate([traj['baseline'] for traj in trajectories]),
-            'baseline_targets':
-            np.concatenate([traj['baseline_target'] for traj in trajectories])
+            key: np.concatenate([traj[key] for traj in trajectories])
+            for key in ['states', 'actions', 'rewards']
         }
+        self._add_discounted_returns(self.batch, episode_lengths)
+        self._add_advantages_and_vtarget(self.batch, episode_lengths)
 
         if self.normalize_advantages:
             self._normalize_advantages(self.batch)
@@ -103,15 +109,25 @@ class VanillaPGAgent(BatchAgent):
 
         while True:
             # Generate policy rollouts
-            self.generate_batch(ep_runner=self.train_ep_runner, **kwargs)
+            with self.logger.phase('generate_batch'):
+                self.generate_batch(ep_runner=self.train_ep_runner, **kwargs)
 
             lr = self._calculate_schedule(self.learning_rate)
-            self.model.fit(sess=self.sess, batch=self.batch, learning_rate=lr, **kwargs)
+            with self.logger.phase('fit'):
+                self.model.fit(
+                    sess=self.sess,
+                    batch=self.batch,
+                    learning_rate=lr,
+                    write_summaries=True,
+                    **kwargs)
 
-            self.write_logs(self.batch)
+            with self.logger.phase('write_logs'):
+                self.write_logs(self.batch)
 
             if self._step_and_check_termination():
                 break
 
         # Save
-        self.save()
+        with self.logger.phase('save'):
+            self.save()
+        self.logger.flush()
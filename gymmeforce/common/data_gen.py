@@ -1,14 +1,41 @@
 import numpy as np
-from sklearn.utils import shuffle
+
+
+def minibatch_slices(data_size, batch_size, keep_remainder=False):
+    '''
+    Returns the (start, size) of each mini-batch of an epoch over <data_size>
+    shuffled samples, every sample is in exactly one mini-batch (the remaining
+    samples are dropped unless <keep_remainder>)
+    '''
+    assert batch_size <= data_size, 'Batch size is larger than dataset'
+    num_batches = data_size // batch_size
+    slices = [(i_batch * batch_size, batch_size) for i_batch in range(num_batches)]
+    remainder = data_size - num_batches * batch_size
+    if keep_remainder and remainder > 0:
+        slices.append((num_batches * batch_size, remainder))
+
+    return slices
 
 
 class DataGenerator:
+    '''
+    Generates shuffled mini-batches from a dataset, without copying the dataset.
+    Each epoch uses a random permutation of the indexes, the mini-batches are
+    gathered into arrays allocated only once and the same dict is yielded for
+    all mini-batches (only the content of its arrays changes), so the
+    yielded dict must not be kept between iterations.
+
+    Args:
+        placeholders_and_data_dict: Dict mapping keys (e.g. placeholders) to the data,
+                                    scalar values are included in every mini-batch
+    '''
+
     def __init__(self, placeholders_and_data_dict):
         assert isinstance(placeholders_and_data_dict, dict)
         self.placeholders_and_data = placeholders_and_data_dict
 
         self.data_to_shuffle = {
-            key: value
+            key: np.asarray(value)
             for key, value in self.placeholders_and_data.items() if not np.isscalar(value)
         }
         self.data_scalar = {
@@ -17,25 +44,37 @@ class DataGenerator:
         }
 
         self.data_size = len(next(iter(self.data_to_shuffle.values())))
+        # Output dicts, one for each batch size
+        self.batch_dicts = {}
 
-    def fetch_batch_dict(self, batch_size):
-        assert batch_size <= self.data_size, 'Batch size is larger than dataset'
-        num_batches = self.data_size // batch_size
-
-        shuffled_data = {
-            key: value
-            for key, value in zip(self.data_to_shuffle.keys(),
-                                  shuffle(*self.data_to_shuffle.values()))
-        }
-
-        for i_batch in range(num_batches):
-            start = i_batch * batch_size
-            end = start + batch_size
-
+    def _get_batch_dict(self, batch_size):
+        if batch_size not in self.batch_dicts:
             batch = {
-                placeholder: data[start:end]
-                for placeholder, data in shuffled_data.items()
+                key: np.empty((batch_size, ) + data.shape[1:], dtype=data.dtype)
+                for key, data in self.data_to_shuffle.items()
             }
             batch.update(self.data_scalar)
+            self.batch_dicts[batch_size] = batch
+
+        return self.batch_dicts[batch_size]
+
+    def _gather(self, batch, idxs):
+        for key, data in self.data_to_shuffle.items():
+            np.take(data, idxs, axis=0, out=batch[key])
+
+        return batch
+
+    def fetch_batch_dict(self, batch_size, keep_remainder=False):
+        '''
+        Yields the mini-batches of one epoch, every mini-batch of the same size
+        is the same dict with its arrays overwritten, so it's only valid until
+        the next one is fetched (copy it to keep it)
 
-            yield batch
+        Args:
+            batch_size: Number of samples on each mini-batch
+            keep_remainder: Also yield a smaller mini-batch with the remaining samples
+        '''
+        idxs = np.random.permutation(self.data_size)
+        for start, size in minibatch_slices(self.data_size, batch_size, keep_remainder):
+            batch = self._get_batch_dict(size)
+            yield self._gather(batch, idxs[start:start + size])
@@ -0,0 +1,186 @@
+'''
+Exports a trained model as a frozen inference graph: only the ops needed for
+computing the outputs (q values, sampled actions, baseline) are kept and the
+variables are converted to constants, so loading it does not need to rebuild
+the training graph (target net, optimizer slots, summaries, ...) nor restore
+a checkpoint.
+
+Usage:
+    python -m gymmeforce.common.inference_graph <log_dir> <output_path> [--compare]
+'''
+import argparse
+import json
+import multiprocessing as mp
+import resource
+import time
+
+import numpy as np
+import tensorflow as tf
+
+# Maps the name of each output to the collection holding its tensor
+INFERENCE_COLLECTIONS = {
+    'q_values': 'q_online_t',
+    'actions': 'sample_action',
+    'baseline': 'baseline'
+}
+
+
+def _get_inference_tensors(graph):
+    state_input = graph.get_collection('state_input')[0]
+    outputs = {
+        name: graph.get_collection(collection)[0]
+        for name, collection in INFERENCE_COLLECTIONS.items()
+        if len(graph.get_collection(collection)) > 0
+    }
+    return state_input, outputs
+
+
+def freeze_inference_graph(sess, path):
+    '''
+    Writes the frozen inference graph of the model on <sess> to <path>
+    and its signature (input and output tensor names) to <path>.json
+    '''
+    state_input, outputs = _get_inference_tensors(sess.graph)
+    output_node_names = [tensor.op.name for tensor in outputs.values()]
+
+    graph_def = sess.graph.as_graph_def()
+    # The states input may have a default value (e.g. graph_rollout),
+    # turning it into a placeholder prunes everything feeding the default
+    for node in graph_def.node:
+        if node.name == state_input.op.name and node.op == 'PlaceholderWithDefault':
+            node.op = 'Placeholder'
+            del node.input[:]
+
+    frozen = tf.graph_util.convert_variables_to_constants(sess, graph_def,
+                                                          output_node_names)
+    frozen = tf.graph_util.remove_training_nodes(
+        frozen, protected_nodes=output_node_names + [state_input.op.name])
+    try:
+        from tensorflow.tools.graph_transforms import TransformGraph
+        transforms = ['fold_constants(ignore_errors=true)', 'fold_batch_norms']
+        frozen = TransformGraph(frozen, [state_input.op.name], output_node_names,
+                                transforms)
+    except ImportError:
+        # Constants will still be folded by grappler when the graph is run
+        pass
+
+    with tf.gfile.GFile(path, 'wb') as f:
+        f.write(frozen.SerializeToString())
+    signature = {
+        'state_input': state_input.name,
+        'state_shape': state_input.shape.as_list()[1:],
+        'state_dtype': state_input.dtype.as_numpy_dtype.__name__,
+        'outputs': {name: tensor.name
+                    for name, tensor in outputs.items()}
+    }
+    with open(path + '.json', 'w') as f:
+        json.dump(signature, f)
+    print('Exported {} nodes to {}'.format(len(frozen.node), path))
+
+
+def export_checkpoint(log_dir, path, save_path=None):
+    '''
+    Exports the latest checkpoint in <log_dir> (or <save_path> if defined),
+    only the checkpoint is needed, not the code that built the model
+    '''
+    with tf.Graph().as_default():
+        with tf.Session() as sess:
+            _load_checkpoint(sess, log_dir, save_path)
+            freeze_inference_graph(sess, path)
+
+
+def _load_checkpoint(sess, log_dir, save_path=None):
+    if save_path is None:
+        save_path = tf.train.latest_checkpoint(log_dir)
+    saver = tf.train.import_meta_graph(save_path + '.meta')
+    saver.restore(sess, save_path)
+
+
+def load_inference_graph(path, output=None):
+    '''
+    Returns a function that computes the outputs of the exported graph for a
+    batch of states, a dict with all outputs or only <output> (e.g. 'q_values')
+    '''
+    with open(path + '.json') as f:
+        signature = json.load(f)
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name='')
+    sess = tf.Session(graph=graph)
+    state_input = graph.get_tensor_by_name(signature['state_input'])
+    if output is None:
+        fetches = {
+            name: graph.get_tensor_by_name(tensor_name)
+            for name, tensor_name in signature['outputs'].items()
+        }
+    else:
+        fetches = graph.get_tensor_by_name(signature['outputs'][output])
+
+    def compute_outputs(states):
+        return sess.run(fetches, feed_dict={state_input: states})
+
+    return compute_outputs
+
+
+def _measure_load(load_fn, args, results_queue):
+    ''' Runs on a new process, so the measures do not include previous loads '''
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start_time = time.perf_counter()
+    load_fn(*args)
+    load_time = time.perf_counter() - start_time
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss
+    results_queue.put((load_time, rss / 1024))
+
+
+def _load_checkpoint_fn(log_dir):
+    sess = tf.Session()
+    _load_checkpoint(sess, log_dir)
+    state_input, outputs = _get_inference_tensors(sess.graph)
+    # Include the first run, for a fair comparison with the frozen graph
+    states = np.zeros([1] + state_input.shape.as_list()[1:],
+                      dtype=state_input.dtype.as_numpy_dtype)
+    sess.run(outputs, feed_dict={state_input: states})
+
+
+def _load_frozen_fn(path):
+    compute_outputs = load_inference_graph(path)
+    with open(path + '.json') as f:
+        signature = json.load(f)
+    compute_outputs(
+        np.zeros([1] + signature['state_shape'], dtype=signature['state_dtype']))
+
+
+def compare_load(log_dir, path):
+    ''' Prints the time and memory used for loading the checkpoint and the export '''
+    ctx = mp.get_context('spawn')
+    for name, load_fn, args in [('checkpoint', _load_checkpoint_fn, (log_dir, )),
+                                ('frozen graph', _load_frozen_fn, (path, ))]:
+        results_queue = ctx.Queue()
+        process = ctx.Process(target=_measure_load, args=(load_fn, args, results_queue))
+        process.start()
+        load_time, rss = results_queue.get()
+        process.join()
+        print('{}: {:.3f}s, {:.1f}MB'.format(name, load_time, rss))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export a frozen inference graph')
+    parser.add_argument('log_dir', help='Directory with the checkpoints of the model')
+    parser.add_argument('path', help='Output path of the frozen graph')
+    parser.add_argument(
+        '--compare',
+        action='store_true',
+        help='Compare the loading time and memory with loading the checkpoint')
+    args = parser.parse_args()
+
+    export_checkpoint(args.log_dir, args.path)
+    if args.compare:
+        compare_load(args.log_dir, args.path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+import queue
+import threading
+import time
+from collections import deque
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+
+class InferenceServer:
+    '''
+    Serves a trained model to many local clients. Requests sent at the same time
+    (by threads calling predict or by processes connected with an InferenceClient)
+    are coalesced into a single batched call to the model.
+
+    A batch is run as soon as <max_batch_size> requests are waiting or <max_latency>
+    seconds after its first request arrived, whatever happens first.
+
+    Args:
+        model: A model with the graph already built (e.g. DQNModel or VanillaPGModel)
+        method: Name of the model method called with (sess, states), e.g. 'predict'
+                for DQNModel or 'select_actions' for VanillaPGModel (default 'predict')
+        save_path: Checkpoint loaded when <sess> is None (default None, the latest
+                   checkpoint in the model log_dir, raises if there is none)
+        sess: Session used for running the model, if None a new session is created
+              and the model variables are loaded (default None)
+        max_batch_size: Maximum number of requests on each batch (default 64)
+        max_latency: Maximum number of seconds a request waits for others
+                     to arrive (default 0.002)
+        socket_path: If defined, also listen for InferenceClient connections on
+                     this UNIX socket (default None)
+        stats_window: Number of recent requests used for the stats (default 10000)
+    '''
+
+    def __init__(self,
+                 model,
+                 method='predict',
+                 save_path=None,
+                 sess=None,
+                 max_batch_size=64,
+                 max_latency=0.002,
+                 socket_path=None,
+                 stats_window=10000):
+        self.model = model
+        self.method = getattr(model, method)
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.requests = queue.Queue()
+        self.latencies = deque(maxlen=stats_window)
+        self.batch_sizes = deque(maxlen=stats_window)
+        self.stop_event = threading.Event()
+        # Requests are not added after closing
+        self.close_lock = threading.Lock()
+
+        if sess is None:
+            import tensorflow as tf
+            if save_path is None:
+                save_path = tf.train.latest_checkpoint(model.log_dir)
+            # Never serve the randomly initialized weights
+            if save_path is None:
+                raise FileNotFoundError('No checkpoint found on {}'.format(model.log_dir))
+            sess = tf.Session()
+            model.load_or_initialize(sess, save_path)
+        self.sess = sess
+
+        self.threads = [threading.Thread(target=self._serve, daemon=True)]
+        self.listener = None
+        if socket_path is not None:
+            self.listener = Listener(socket_path, family='AF_UNIX')
+            self.threads.append(threading.Thread(target=self._accept, daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def predict(self, state):
+        ''' Returns the output of the model for a single <state>, thread safe '''
+        request = _Request(state)
+        with self.close_lock:
+            if self.stop_event.is_set():
+                raise RuntimeError('InferenceServer is closed')
+            self.requests.put(request)
+        return request.wait()
+
+    def _next_batch(self):
+        ''' Blocks for the first request, then waits for others until the deadline '''
+        while not self.stop_event.is_set():
+            try:
+                batch = [self.requests.get(timeout=0.1)]
+                break
+            except queue.Empty:
+                pass
+        else:
+            return []
+
+        deadline = batch[0].start_time + self.max_latency
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                if timeout > 0:
+                    batch.append(self.requests.get(timeout=timeout))
+                else:
+                    # Still take the requests that are already waiting
+                    batch.append(self.requests.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _serve(self):
+        while True:
+            batch = self._next_batch()
+            if len(batch) == 0:
+                return
+
+            try:
+                states = np.stack([request.state for request in batch])
+                outputs = self.method(self.sess, states)
+            except Exception as e:
+                for request in batch:
+                    request.set_error(e)
+                continue
+
+            for request, output in zip(batch, outputs):
+                request.set_result(output)
+
+            end_time = time.perf_counter()
+            self.latencies.extend(end_time - request.start_time for request in batch)
+            self.batch_sizes.append(len(batch))
+
+    def _accept(self):
+        while not self.stop_event.is_set():
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                # Listener closed
+                return
+            thread = threading.Thread(
+                target=self._handle_client, args=(conn, ), daemon=True)
+            thread.start()
+
+    def _handle_client(self, conn):
+        ''' Each client sends one state at a time and waits for the result '''
+        with conn:
+            while not self.stop_event.is_set():
+                try:
+                    state = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    conn.send((True, self.predict(state)))
+                except Exception as e:
+                    conn.send((False, e))
+
+    def get_stats(self):
+        '''
+        Returns a dict with the median and 99th percentile latency (in milliseconds)
+        and the mean batch size of the recent requests
+        '''
+        if len(self.latencies) == 0:
+            return {}
+        latencies = 1000 * np.array(self.latencies)
+        return {
+            'latency_p50_ms': float(np.percentile(latencies, 50)),
+            'latency_p99_ms': float(np.percentile(latencies, 99)),
+            'mean_batch_size': float(np.mean(self.batch_sizes))
+        }
+
+    def write_logs(self, logger):
+        for key, value in self.get_stats().items():
+            logger.add_log('Inference/{}'.format(key), value)
+
+    def close(self):
+        ''' Stops serving, the requests still waiting fail with a RuntimeError '''
+        with self.close_lock:
+            self.stop_event.set()
+        if self.listener is not None:
+            self.listener.close()
+        self.threads[0].join()
+
+        while True:
+            try:
+                request = self.requests.get_nowait()
+            except queue.Empty:
+                break
+            request.set_error(RuntimeError('InferenceServer closed before serving'))
+
+
+class InferenceClient:
+    '''
+    Sends requests to an InferenceServer running on another process
+
+    Args:
+        socket_path: UNIX socket the server is listening on
+    '''
+
+    def __init__(self, socket_path):
+        self.conn = Client(socket_path, family='AF_UNIX')
+
+    def predict(self, state):
+        self.conn.send(state)
+        success, result = self.conn.recv()
+        if not success:
+            raise result
+        return result
+
+    def close(self):
+        self.conn.close()
+
+
+class _Request:
+    def __init__(self, state):
+        self.state = state
+        self.start_time = time.perf_counter()
+        self.result = None
+        self.error = None
+        self.done_event = threading.Event()
+
+    def set_result(self, result):
+        self.result = result
+        self.done_event.set()
+
+    def set_error(self, error):
+        self.error = error
+        self.done_event.set()
+
+    def wait(self):
+        self.done_event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
@@ -0,0 +1,204 @@
+import atexit
+import csv
+import json
+import os
+import queue
+import threading
+
+
+class LogSink:
+    '''
+    Receives the values written by each Logger.log. The records are written by
+    a background thread (see AsyncSinkWriter), so writing never blocks training.
+    '''
+
+    def write(self, records):
+        ''' <records> is a list of (step, dict mapping the log name to its value) '''
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class JSONLSink(LogSink):
+    ''' Writes each record as a line with a json object (including the step) '''
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.file = open(path, 'a')
+
+    def write(self, records):
+        self.file.write(''.join(
+            json.dumps(dict(values, step=step)) + '\n' for step, values in records))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class CSVSink(LogSink):
+    '''
+    Writes each record as a row, the columns are all the keys seen so far.
+    When a record has new keys the file is rewritten with the new columns
+    (empty on the previous rows), this only happens while the logged keys
+    are changing, e.g. values only logged after the first episode ends.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.fieldnames = None
+        # Continue a file written before
+        if os.path.exists(path):
+            with open(path, newline='') as f:
+                self.fieldnames = next(csv.reader(f), None)
+        self.file = open(path, 'a', newline='')
+
+    def write(self, records):
+        keys = set().union(*(values for _, values in records))
+        if self.fieldnames is None:
+            self.fieldnames = ['step'] + sorted(keys)
+            csv.DictWriter(self.file, self.fieldnames).writeheader()
+        else:
+            new_keys = keys.difference(self.fieldnames)
+            if new_keys:
+                self._rewrite(self.fieldnames + sorted(new_keys))
+
+        writer = csv.DictWriter(self.file, self.fieldnames)
+        writer.writerows(dict(values, step=step) for step, values in records)
+
+    def _rewrite(self, fieldnames):
+        ''' Rewrites the file with the columns <fieldnames> '''
+        self.file.close()
+        with open(self.path, newline='') as f:
+            rows = list(csv.DictReader(f))
+        # Replace the old file only after the new one is completely written
+        with open(self.path + '.tmp', 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames)
+            writer.writeheader()
+            writer.writerows(rows)
+        os.replace(self.path + '.tmp', self.path)
+        self.fieldnames = fieldnames
+        self.file = open(self.path, 'a', newline='')
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class TensorBoardSink(LogSink):
+    '''
+    Writes all the values of a record as a single tf.Summary
+
+    Args:
+        log_dir: Directory of the event files, when <writer> is not defined
+        writer: A tf.summary.FileWriter shared with the model (e.g. from
+                BaseModel.get_summary_writer), it's only flushed when closing
+    '''
+
+    def __init__(self, log_dir=None, writer=None):
+        # Deferred, importing tensorflow is slow
+        import tensorflow as tf
+        self.tf = tf
+        self.owns_writer = writer is None
+        self.writer = writer if writer is not None else tf.summary.FileWriter(log_dir)
+
+    def write(self, records):
+        for step, values in records:
+            summary = self.tf.Summary(value=[
+                self.tf.Summary.Value(tag=name, simple_value=value)
+                for name, value in values.items()
+            ])
+            self.writer.add_summary(summary, step)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        if self.owns_writer:
+            self.writer.close()
+        else:
+            self.writer.flush()
+
+
+class AsyncSinkWriter:
+    '''
+    Writes records to the sinks on a background thread, the records waiting
+    are written together. At most <maxsize> records wait to be written, new
+    records are dropped when the sinks can not keep up (e.g. a slow network
+    file system), so the memory used is bounded and logging never blocks.
+    The records left are written when the process exits.
+
+    Args:
+        sinks: List of LogSink
+        maxsize: Maximum number of records waiting to be written
+    '''
+
+    def __init__(self, sinks, maxsize=1000):
+        self.sinks = list(sinks)
+        self.records = queue.Queue(maxsize=maxsize)
+        self.num_dropped = 0
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def put(self, step, values):
+        try:
+            self.records.put_nowait((step, values))
+        except queue.Full:
+            self.num_dropped += 1
+
+    def _write_loop(self):
+        while True:
+            records = [self.records.get()]
+            # Write all the records waiting together
+            while True:
+                try:
+                    records.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = None in records
+            self._write([record for record in records if record is not None])
+            for _ in records:
+                self.records.task_done()
+            if stop:
+                return
+
+    def _write(self, records):
+        if len(records) == 0:
+            return
+        for sink in self.sinks:
+            try:
+                sink.write(records)
+                sink.flush()
+            except Exception as e:
+                # A failing sink should not stop the others nor the training
+                print('Error writing logs to {}: {}'.format(type(sink).__name__, e))
+
+    def flush(self):
+        ''' Blocks until all the records queued are written '''
+        if self.thread.is_alive():
+            self.records.join()
+
+    def close(self):
+        ''' Writes the records left and closes the sinks '''
+        if not self.thread.is_alive():
+            return
+        # Blocks until there is space for the stop signal
+        self.records.put(None)
+        self.thread.join()
+        for sink in self.sinks:
+            sink.close()
+        if self.num_dropped > 0:
+            print('{} log records were dropped'.format(self.num_dropped))
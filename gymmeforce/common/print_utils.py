@@ -1,25 +1,64 @@
+import json
+import os
+import threading
 import time
 from collections import defaultdict
+from contextlib import nullcontext
 from datetime import timedelta
 
 import numpy as np
 
+from gymmeforce.common.log_sinks import AsyncSinkWriter
+
+
+# Returned by Logger.phase when profiling is disabled
+_NULL_PHASE = nullcontext()
+
+
+def null_phase(name):
+    ''' Same interface as Logger.phase, but times nothing '''
+    return _NULL_PHASE
+
 
 class Logger:
-    def __init__(self, debug=False):
+    '''
+    Args:
+        debug: Also log the values added with add_debug
+        profile: Time the phases of the training loop (see phase)
+        trace_path: If defined (and profiling), also write each phase as a Chrome
+                    trace event to this file (open it on chrome://tracing)
+        sinks: List of LogSink, written on a background thread (see add_sink)
+        max_queued_logs: Maximum number of logs waiting to be written to the sinks,
+                         more logs are dropped (default 1000)
+        step_fn: Function returning the step of the values written to the sinks
+                 (default None, the step of the last timeit call)
+    '''
+
+    def __init__(self,
+                 debug=False,
+                 profile=False,
+                 trace_path=None,
+                 sinks=None,
+                 max_queued_logs=1000,
+                 step_fn=None):
         self.debug = debug
+        self.phase_timer = PhaseTimer(trace_path) if profile else None
+        self.sinks = list(sinks or [])
+        self.max_queued_logs = max_queued_logs
+        self.step_fn = step_fn
+        self.sink_writer = None
         self.logs = defaultdict(list)
         self.precision = dict()
         self.time = time.time()
-        self.tf_scalar_summary_writer = None
-        self.sess = None
         self.steps_sum = 0
         self.eta = None
         self.i_step = 0
 
-    def add_tf_writer(self, sess, tf_scalar_summary_writer):
-        self.sess = sess
-        self.tf_scalar_summary_writer = tf_scalar_summary_writer
+    def add_sink(self, sink):
+        ''' The values of each log are also written to <sink> (e.g. TensorBoardSink) '''
+        self.sinks.append(sink)
+        if self.sink_writer is not None:
+            self.sink_writer.add_sink(sink)
 
     def add_log(self, name, value, precision=2):
         self.logs[name].append(value)
@@ -29,8 +68,49 @@ class Logger:
         if self.debug:
             self.add_log(name, value, precision)
 
-    def log(self, header=None):
-        ''' Write the mean of the values added to each key and clear previous values '''
+    def phase(self, name):
+        '''
+        Context manager timing a phase of the training loop, e.g.:
+            with logger.phase('fit'):
+                model.fit(...)
+        Does nothing when profiling is disabled
+        '''
+        if self.phase_timer is None:
+            return _NULL_PHASE
+        return self.phase_timer.phase(name)
+
+    def flush(self):
+        ''' Blocks until the logs and trace events are written (the sinks stay open) '''
+        if self.sink_writer is not None:
+            self.sink_writer.flush()
+        self.flush_trace()
+
+    def close(self):
+        ''' Writes the logs waiting to be written and closes the sinks and trace file '''
+        if self.sink_writer is not None:
+            self.sink_writer.close()
+            self.sink_writer = None
+        self.sinks = []
+        if self.phase_timer is not None:
+            self.phase_timer.close()
+
+    def flush_trace(self):
+        ''' Writes the trace events not written yet (done on every log) '''
+        if self.phase_timer is not None:
+            self.phase_timer.flush_trace()
+
+    def log(self, header=None, step=None):
+        '''
+        Write the mean of the values added to each key and clear previous values
+
+        Args:
+            step: Step of the values written to the sinks (default the value
+                  returned by step_fn, or the step of the last timeit call)
+        '''
+        if self.phase_timer is not None:
+            for name, value in self.phase_timer.get_stats().items():
+                self.add_log(name, value, precision=3)
+
         # Take the mean of the values
         self.logs = {key: np.mean(value) for key, value in self.logs.items()}
         # Convert values to string, with defined precision
@@ -44,10 +124,14 @@ class Logger:
             header += ' | ETA: {}'.format(self.eta)
         print_table(avg_dict, header)
 
-        # Write tensorflow summary
-        if self.tf_scalar_summary_writer is not None:
-            for key, value in self.logs.items():
-                self.tf_scalar_summary_writer(self.sess, key, value)
+        # Queue the values, the sinks are written on a background thread
+        if len(self.sinks) > 0:
+            if self.sink_writer is None:
+                self.sink_writer = AsyncSinkWriter(self.sinks, self.max_queued_logs)
+            if step is None:
+                step = self.i_step if self.step_fn is None else self.step_fn()
+            values = {key: float(value) for key, value in self.logs.items()}
+            self.sink_writer.put(step, values)
 
         # Reset dict
         self.logs = defaultdict(list)
@@ -66,6 +150,93 @@ class Logger:
             self.eta = str(timedelta(seconds=eta_seconds)).split('.')[0]
 
 
+class PhaseTimer:
+    '''
+    Accumulates the durations of named phases, get_stats returns the total time
+    and the p50/p99 latency of each phase since the last call
+
+    Args:
+        trace_path: If defined, write each phase as a Chrome trace event to this file
+    '''
+
+    def __init__(self, trace_path=None):
+        self.durations = defaultdict(list)
+        self.phases = {}
+        self.trace_events = [] if trace_path is not None else None
+        self.trace_file = None
+        if trace_path is not None:
+            # The closing bracket is optional on the trace event format,
+            # so the events can be appended to the file as they are flushed
+            self.trace_file = open(trace_path, 'w')
+            self.trace_file.write('[\n')
+
+    def phase(self, name):
+        # Only one object per phase, created on its first use
+        try:
+            return self.phases[name]
+        except KeyError:
+            self.phases[name] = _Phase(name, self)
+            return self.phases[name]
+
+    def add(self, name, start, end):
+        self.durations[name].append(end - start)
+        if self.trace_events is not None:
+            self.trace_events.append((name, start, end, threading.get_ident()))
+
+    def get_stats(self):
+        stats = {}
+        for name, durations in self.durations.items():
+            durations = np.array(durations)
+            stats['Phase/{} total (s)'.format(name)] = np.sum(durations)
+            p50, p99 = 1000 * np.percentile(durations, [50, 99])
+            stats['Phase/{} p50 (ms)'.format(name)] = p50
+            stats['Phase/{} p99 (ms)'.format(name)] = p99
+        self.durations = defaultdict(list)
+        self.flush_trace()
+
+        return stats
+
+    def flush_trace(self):
+        if self.trace_file is None:
+            return
+        pid = os.getpid()
+        for name, start, end, tid in self.trace_events:
+            event = {
+                'name': name,
+                'ph': 'X',
+                'ts': 1e6 * start,
+                'dur': 1e6 * (end - start),
+                'pid': pid,
+                'tid': tid
+            }
+            self.trace_file.write(json.dumps(event) + ',\n')
+        self.trace_file.flush()
+        self.trace_events = []
+
+    def close(self):
+        ''' Writes the trace events and closes the file, later phases are not traced '''
+        if self.trace_file is not None:
+            self.flush_trace()
+            self.trace_file.close()
+            self.trace_file = None
+            self.trace_events = None
+
+
+class _Phase:
+    ''' Reused for every run of the phase, so the phases of a name can not nest '''
+
+    def __init__(self, name, phase_timer):
+        self.name = name
+        self.phase_timer = phase_timer
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        self.phase_timer.add(self.name, self.start, time.perf_counter())
+
+
 def print_table(tags_and_values_dict, header=None, width=42):
     '''
     Print a pretty table =)
@@ -1,14 +1,111 @@
+from collections import deque
+
 import numpy as np
 
+from gymmeforce.common.print_utils import null_phase
+from gymmeforce.common.utils import RingBuffer
+
+
+class TrajectoryBuilder:
+    '''
+    Stores the transitions of a trajectory on numpy columns, preallocated and
+    grown by doubling when full. Each state is stored only once, next_states is a
+    view of the states shifted by one (the last next_state is stored on an extra row)
+    and the scaled states are only stored when using a scaler.
+
+    Args:
+        scaled: Also store the scaled states (else states are the unscaled states)
+        initial_size: Number of transitions preallocated
+    '''
+
+    def __init__(self, scaled=False, initial_size=256):
+        self.scaled = scaled
+        self.capacity = initial_size
+        self.size = 0
+        self.columns = None
+
+    def _allocate(self, unscaled_state, action, state):
+        columns_values = {'unscaled_states': unscaled_state, 'actions': action}
+        if self.scaled:
+            columns_values['states'] = state
+
+        self.columns = {
+            key: np.empty((self.capacity, ) + np.shape(value), np.asarray(value).dtype)
+            for key, value in columns_values.items()
+        }
+        # Fixed dtypes, the first reward can be an int (e.g. 0) followed by floats
+        self.columns['rewards'] = np.empty(self.capacity, np.float32)
+        self.columns['dones'] = np.empty(self.capacity, np.bool_)
+        # Extra row for the last next_state
+        self.columns['unscaled_states'] = np.empty(
+            (self.capacity + 1, ) + np.shape(unscaled_state),
+            np.asarray(unscaled_state).dtype)
+
+    def _grow(self):
+        for key, column in self.columns.items():
+            extra_rows = len(column) - self.capacity
+            new_column = np.empty((2 * self.capacity + extra_rows, ) + column.shape[1:],
+                                  column.dtype)
+            new_column[:self.size] = column[:self.size]
+            self.columns[key] = new_column
+        self.capacity *= 2
+
+    def add(self, unscaled_state, action, reward, done, state=None):
+        if self.columns is None:
+            self._allocate(unscaled_state, action, state)
+        elif self.size == self.capacity:
+            self._grow()
+
+        i = self.size
+        columns = self.columns
+        columns['unscaled_states'][i] = unscaled_state
+        columns['actions'][i] = action
+        columns['rewards'][i] = reward
+        columns['dones'][i] = done
+        if self.scaled:
+            columns['states'][i] = state
+        self.size += 1
+
+    def finish(self, next_state):
+        '''
+        Returns the trajectory, <next_state> is the next state of the last transition
+        the returned arrays are views of the columns, so the builder can't be reused
+        '''
+        size = self.size
+        unscaled_states = self.columns['unscaled_states']
+        unscaled_states[size] = next_state
+
+        trajectory = {
+            key: column[:size]
+            for key, column in self.columns.items()
+        }
+        if not self.scaled:
+            trajectory['states'] = trajectory['unscaled_states']
+        trajectory['next_states'] = unscaled_states[1:size + 1]
+
+        return trajectory
+
 
 class EpisodeRunner:
-    def __init__(self, env, monitored_env=None, scaler=None):
+    '''
+    Steps a single env, <new_episode> tells if the current state is the
+    first of an episode (e.g. for resetting the stacked states used for acting)
+
+    Args:
+        phase_fn: Context manager factory timing the env steps, e.g. Logger.phase
+                  (default None, not timed)
+    '''
+
+    def __init__(self, env, monitored_env=None, scaler=None, phase_fn=None):
         self.env = env
         self.monitored_env = monitored_env
         self.scaler = scaler
+        self.phase_fn = phase_fn or null_phase
         self.state = env.reset()
+        self.new_episode = True
 
-    def run_one_step(self, select_action_fn, render=False):
+    def _step(self, select_action_fn, render=False):
+        ''' Returns (unscaled_state, state, action, reward, done, next_state) '''
         if render:
             self.env.render()
 
@@ -16,40 +113,80 @@ class EpisodeRunner:
         if self.scaler is not None:
             self.state = self.scaler.scale_state(self.state)
         # Select and execute action
-        action = select_action_fn(self.state)
-        next_state, reward, done, _ = self.env.step(action)
+        state = self.state
+        action = select_action_fn(state)
+        with self.phase_fn('env_step'):
+            next_state, reward, done, _ = self.env.step(action)
+            if done:
+                self.state = self.env.reset()
+            else:
+                self.state = next_state
+        self.new_episode = done
+
+        return unscaled_state, state, action, reward, done, next_state
+
+    def run_one_step(self, select_action_fn, render=False):
+        unscaled_state, state, action, reward, done, next_state = self._step(
+            select_action_fn, render)
 
         transition = {
             'unscaled_state': unscaled_state,
-            'state': self.state,
+            'state': state,
             'next_state': next_state,
             'action': action,
             'reward': reward,
             'done': done
         }
 
-        if done:
-            self.state = self.env.reset()
-        else:
-            self.state = next_state
-
         return transition
 
-    def run_one_episode(self, **kwargs):
+    def step_async(self, select_action_fn, render=False):
+        ''' Same interface as VecEpisodeRunner, the step only runs on step_wait '''
+        self.step_args = (select_action_fn, render)
+
+    def step_wait(self):
+        return self.run_one_step(*self.step_args)
+
+    def run_one_episode(self, select_action_fn, render=False):
+        builder = TrajectoryBuilder(scaled=self.scaler is not None)
         done = False
-        transitions = []
 
         while not done:
-            transition = self.run_one_step(**kwargs)
-            transitions.append(transition)
-            done = transition['done']
+            unscaled_state, state, action, reward, done, next_state = self._step(
+                select_action_fn, render)
+            builder.add(unscaled_state, action, reward, done, state)
 
-        trajectory = {
-            key + 's': np.array([t[key] for t in transitions])
-            for key in transitions[0]
-        }
+        return builder.finish(next_state)
 
-        return trajectory
+    def discard_unfinished(self):
+        ''' Same interface as VecEpisodeRunner, episodes are always run until the end '''
+        pass
+
+    def run_chunks(self, chunk_size, select_action_fn, render=False):
+        '''
+        Generator of trajectories with <chunk_size> steps each, episodes are
+        continued on the next chunk (check the dones). The next_states of
+        transitions that ended an episode are the terminal states, so
+        chunks containing them return a copy of next_states
+        '''
+        while True:
+            builder = TrajectoryBuilder(
+                scaled=self.scaler is not None, initial_size=chunk_size)
+            terminal_states = []
+            for i_step in range(chunk_size):
+                unscaled_state, state, action, reward, done, next_state = self._step(
+                    select_action_fn, render)
+                builder.add(unscaled_state, action, reward, done, state)
+                if done and i_step < chunk_size - 1:
+                    terminal_states.append((i_step, next_state))
+
+            chunk = builder.finish(next_state)
+            if terminal_states:
+                chunk['next_states'] = chunk['next_states'].copy()
+                for i_step, terminal_state in terminal_states:
+                    chunk['next_states'][i_step] = terminal_state
+
+            yield chunk
 
     def get_number_steps(self):
         return self.monitored_env.get_total_steps()
@@ -59,3 +196,143 @@ class EpisodeRunner:
 
     def get_episode_rewards(self):
         return self.monitored_env.get_episode_rewards()
+
+
+class VecEpisodeRunner:
+    '''
+    Steps multiple envs in lockstep, the actions for all envs are
+    selected with a single call to <select_action_fn> (with a batch of states)
+
+    Args:
+        vec_env: A VecEnv or a SubprocVecEnv
+        scaler: Scaler shared by all envs
+        history_length: If not None, keeps a RingBuffer for each env and
+                        <select_action_fn> receives the stacked states
+        stack_states_fn: Function that stacks the states of all envs with their
+                         previous states, used instead of the RingBuffers
+                         (e.g. ReplayBuffer.stack_recent_states)
+        phase_fn: Same as EpisodeRunner, times waiting for the envs to step
+    '''
+
+    def __init__(self,
+                 vec_env,
+                 scaler=None,
+                 history_length=None,
+                 stack_states_fn=None,
+                 phase_fn=None):
+        self.vec_env = vec_env
+        self.scaler = scaler
+        self.phase_fn = phase_fn or null_phase
+        self.num_envs = vec_env.num_envs
+        self.states = vec_env.reset()
+        self.stack_states_fn = stack_states_fn
+        self.states_history = None
+        if history_length is not None and stack_states_fn is None:
+            state_shape = np.squeeze(self.states[0]).shape
+            # Scaled states are always float
+            dtype = self.states.dtype if scaler is None else np.float32
+            self.states_history = [
+                RingBuffer(state_shape, history_length, dtype=dtype)
+                for _ in range(self.num_envs)
+            ]
+        # Trajectory of the episode currently running on each env
+        self.builders = [self._create_builder() for _ in range(self.num_envs)]
+        self.finished_trajectories = deque()
+
+    def _create_builder(self):
+        return TrajectoryBuilder(scaled=self.scaler is not None)
+
+    def _stack_states(self, states):
+        for states_history, state in zip(self.states_history, states):
+            states_history.append(state)
+
+        return np.array([history.get_data() for history in self.states_history])
+
+    def run_one_step(self, select_action_fn, render=False):
+        '''
+        Returns a transition dict where each value has one entry per env,
+        transition['done'] marks which envs finished an episode on this step
+        '''
+        self.step_async(select_action_fn, render)
+        return self.step_wait()
+
+    def step_async(self, select_action_fn, render=False):
+        ''' Selects the actions and starts stepping the envs, finish with step_wait '''
+        if render:
+            self.vec_env.render()
+
+        self.unscaled_states = self.states
+        if self.scaler is not None:
+            self.states = self.scaler.scale_state(self.states)
+        # Select and execute actions
+        if self.stack_states_fn is not None:
+            self.actions = select_action_fn(self.stack_states_fn(self.states))
+        elif self.states_history is not None:
+            self.actions = select_action_fn(self._stack_states(self.states))
+        else:
+            self.actions = select_action_fn(self.states)
+        self.vec_env.step_async(self.actions)
+
+    def step_wait(self):
+        ''' Waits for the envs to finish stepping and returns the transition '''
+        with self.phase_fn('env_step'):
+            new_states, rewards, dones, infos = self.vec_env.step_wait()
+
+        # Envs that finished are already reseted
+        next_states = new_states.copy()
+        for i_env in np.flatnonzero(dones):
+            next_states[i_env] = np.reshape(infos[i_env]['terminal_state'],
+                                            next_states.shape[1:])
+            if self.states_history is not None:
+                self.states_history[i_env].reset()
+
+        transition = {
+            'unscaled_state': self.unscaled_states,
+            'state': self.states,
+            'next_state': next_states,
+            'action': self.actions,
+            'reward': rewards,
+            'done': dones
+        }
+        self.states = new_states
+
+        return transition
+
+    def run_one_episode(self, **kwargs):
+        '''
+        Steps all envs until one of them finishes an episode and returns it, other
+        episodes that finish on the same step are returned by the next calls.
+        Unfinished episodes are continued on the next call, use discard_unfinished
+        after a policy update
+        '''
+        while not self.finished_trajectories:
+            transition = self.run_one_step(**kwargs)
+            for i_env, builder in enumerate(self.builders):
+                builder.add(transition['unscaled_state'][i_env],
+                            transition['action'][i_env], transition['reward'][i_env],
+                            transition['done'][i_env], transition['state'][i_env])
+                if transition['done'][i_env]:
+                    self.finished_trajectories.append(
+                        builder.finish(transition['next_state'][i_env]))
+                    self.builders[i_env] = self._create_builder()
+
+        return self.finished_trajectories.popleft()
+
+    def discard_unfinished(self):
+        '''
+        Drops the transitions not returned yet, so the next trajectories only
+        contain actions of the current policy (call it after a policy update).
+        The envs are not reseted, the next trajectory of each env starts on its
+        current state (the returns only use the rewards from there on)
+        '''
+        self.finished_trajectories.clear()
+        self.builders = [self._create_builder() for _ in range(self.num_envs)]
+
+    def get_number_steps(self):
+        return self.vec_env.get_total_steps()
+
+    def get_number_episodes(self):
+        return self.vec_env.get_number_episodes()
+
+    def get_episode_rewards(self):
+        return self.vec_env.get_episode_rewards()
@@ -0,0 +1,309 @@
+import numpy as np
+import tensorflow as tf
+
+
+class TFReplayBuffer:
+    '''
+    Replay buffer stored on (local) TF variables, with the same add and sample
+    as ReplayBuffer. The transitions are uploaded in chunks of <chunk_size>,
+    sampling the idxs, stacking the states and calculating the n-step returns
+    all happen in-graph, so a model can train directly on <sample_tensors>
+    (see DQNModel graph_replay_buffer) without feeding any batch.
+
+    The graph is built by the constructor (together with the model), its size
+    and the sampling parameters are only defined by allocate, when training starts.
+    Transitions not uploaded yet (at most <chunk_size>) are not sampled.
+    The buffer is not saved with the model checkpoints. Meant for small
+    networks on non-image envs, where feeding the batches is a large part of
+    the time of each training step.
+
+    Args:
+        state_shape: Shape of each state, without the history (tuple)
+        state_dtype: Type of the stored states
+        history_length: Number of sequential states stacked when sampling
+        chunk_size: Number of transitions uploaded at once
+    '''
+
+    def __init__(self, state_shape, state_dtype, history_length=1, chunk_size=256):
+        self.state_shape = tuple(state_shape)
+        self.state_dtype = np.dtype(state_dtype)
+        self.history_length = history_length
+        self.chunk_size = chunk_size
+        self.storage_dir = None
+        self.sess = None
+        self.initialized = False
+
+        with tf.variable_scope('replay_buffer'):
+            self._create_storage()
+            self._create_insert_op()
+            self._create_sample_tensors()
+
+    def _create_storage(self):
+        ''' Variables with the shape only known on allocate (validate_shape=False) '''
+        local = [tf.GraphKeys.LOCAL_VARIABLES]
+        self.maxlen_ph = tf.placeholder(tf.int32, [], 'maxlen')
+        config = {
+            'states': (self.state_shape, self.state_dtype),
+            'actions': ((), np.int32),
+            'rewards': ((), np.float32),
+            'dones': ((), np.float32),
+            # Number of previous frames of the same episode (up to history_length)
+            'frames_since_done': ((), np.int32)
+        }
+        self.storage_vars = {}
+        allocate_ops = []
+        for name, (shape, dtype) in config.items():
+            var = tf.Variable(
+                tf.zeros((0, ) + shape, dtype),
+                trainable=False,
+                validate_shape=False,
+                collections=local,
+                name=name)
+            self.storage_vars[name] = var
+            allocate_ops.append(
+                tf.assign(
+                    var,
+                    tf.zeros([self.maxlen_ph] + list(shape), dtype),
+                    validate_shape=False))
+
+        # Sampling parameters, fed once by allocate
+        self.config_phs = {
+            'num_envs': tf.placeholder(tf.int32, [], 'num_envs'),
+            'batch_size': tf.placeholder(tf.int32, [], 'batch_size'),
+            'n_step': tf.placeholder(tf.int32, [], 'n_step'),
+            'gamma': tf.placeholder(tf.float32, [], 'gamma')
+        }
+        self.config_vars = {}
+        for name, ph in self.config_phs.items():
+            var = tf.Variable(
+                tf.zeros([], ph.dtype), trainable=False, collections=local, name=name)
+            self.config_vars[name] = var
+            allocate_ops.append(tf.assign(var, ph))
+
+        self.current_idx_var = tf.Variable(0, trainable=False, collections=local,
+                                           name='current_idx')
+        self.current_len_var = tf.Variable(0, trainable=False, collections=local,
+                                           name='current_len')
+        self.allocate_op = tf.group(
+            *allocate_ops,
+            tf.assign(self.current_idx_var, 0),
+            tf.assign(self.current_len_var, 0))
+
+    def _create_insert_op(self):
+        self.insert_phs = {
+            name: tf.placeholder(var.dtype.base_dtype, name=name + '_chunk')
+            for name, var in self.storage_vars.items()
+        }
+        self.slots_ph = tf.placeholder(tf.int32, [None], 'slots')
+        self.new_idx_ph = tf.placeholder(tf.int32, [], 'new_idx')
+        self.new_len_ph = tf.placeholder(tf.int32, [], 'new_len')
+
+        insert_ops = [
+            tf.scatter_update(var, self.slots_ph, self.insert_phs[name])
+            for name, var in self.storage_vars.items()
+        ]
+        # The new transitions can only be sampled after they are written
+        with tf.control_dependencies(insert_ops):
+            self.insert_op = tf.group(
+                tf.assign(self.current_idx_var, self.new_idx_ph),
+                tf.assign(self.current_len_var, self.new_len_ph))
+
+    def _create_sample_tensors(self):
+        '''
+        Same sampling as ReplayBuffer: uniform starts skipping the ones that
+        overlap the write position, frames of previous episodes zeroed and the
+        n-step returns stopping at the first done
+        '''
+        history_length = self.history_length
+        num_envs = self.config_vars['num_envs']
+        self.sample_phs = {
+            'batch_size': tf.placeholder_with_default(
+                self.config_vars['batch_size'].read_value(), [], 'sample_batch_size'),
+            'n_step': tf.placeholder_with_default(
+                self.config_vars['n_step'].read_value(), [], 'sample_n_step'),
+            'randomize_n_step': tf.placeholder_with_default(
+                False, [], 'randomize_n_step')
+        }
+        batch_size = self.sample_phs['batch_size']
+        max_n_step = self.sample_phs['n_step']
+
+        # Sample the start of the transitions
+        window = (history_length + max_n_step - 1) * num_envs
+        current_idx = self.current_idx_var.read_value()
+        high = self.current_len_var.read_value() - window
+        low_invalid = tf.maximum(0, current_idx - window)
+        num_invalid = tf.maximum(0, tf.minimum(current_idx, high) - low_invalid)
+        idxs = tf.random_uniform([batch_size], 0, high - num_invalid, dtype=tf.int32)
+        start_idxs = idxs + num_invalid * tf.cast(idxs >= low_invalid, tf.int32)
+        n_step = tf.cond(
+            self.sample_phs['randomize_n_step'],
+            lambda: tf.random_uniform([batch_size], 1, max_n_step + 1, dtype=tf.int32),
+            lambda: tf.fill([batch_size], max_n_step))
+
+        # Get states (states_t and states_tp1 with a single gather)
+        b_start_idxs = tf.concat([start_idxs, start_idxs + n_step * num_envs], axis=0)
+        history_offsets = tf.range(history_length) * num_envs
+        b_states = tf.gather(self.storage_vars['states'],
+                             b_start_idxs[:, None] + history_offsets)
+        b_states.set_shape([None, history_length] + list(self.state_shape))
+        # Zero the frames that belong to a previous episode
+        frames_since_done = tf.gather(self.storage_vars['frames_since_done'],
+                                      b_start_idxs + history_offsets[-1])
+        same_episode = (tf.range(history_length)[::-1][None] <=
+                        frames_since_done[:, None])
+        same_episode = same_episode[(Ellipsis, ) + (tf.newaxis, ) * len(self.state_shape)]
+        b_states *= tf.cast(same_episode, b_states.dtype)
+        # Stack the history on the last axis (like ReplayBuffer, swapping the axes)
+        perm = list(range(b_states.shape.ndims))
+        perm[1], perm[-1] = perm[-1], perm[1]
+        b_states_t, b_states_tp1 = tf.split(tf.transpose(b_states, perm), 2)
+
+        # Calculate the n-step returns
+        last_idxs = start_idxs + history_offsets[-1]
+        n_step_idxs = last_idxs[:, None] + tf.range(max_n_step) * num_envs
+        rewards = tf.gather(self.storage_vars['rewards'], n_step_idxs)
+        in_window = tf.range(max_n_step)[None] < n_step[:, None]
+        dones = tf.logical_and(
+            tf.gather(self.storage_vars['dones'], n_step_idxs) > 0, in_window)
+        # Rewards after the first done belong to the next episode
+        in_episode = tf.equal(
+            tf.cumsum(tf.cast(dones, tf.int32), axis=1, exclusive=True), 0)
+        mask = tf.cast(tf.logical_and(in_window, in_episode), tf.float32)
+        gamma_powers = self.config_vars['gamma']**tf.cast(
+            tf.range(max_n_step), tf.float32)
+
+        self.sample_tensors = {
+            'states_t': b_states_t,
+            'states_tp1': b_states_tp1,
+            'actions': tf.gather(self.storage_vars['actions'], last_idxs),
+            'rewards': tf.reduce_sum(rewards * mask * gamma_powers, axis=1),
+            'dones': tf.cast(tf.reduce_any(dones, axis=1), tf.float32),
+            'n_step': tf.cast(n_step, tf.float32)
+        }
+
+    def allocate(self, sess, maxlen, batch_size=32, n_step=1, gamma=0.99, num_envs=1):
+        '''
+        Allocates the storage (discarding everything stored) and sets the
+        default sampling parameters, must be called before adding transitions
+
+        Args:
+            sess: Session used for uploading and sampling
+            maxlen: Maximum number of transitions stored
+            batch_size: Mini-batch size created by sample
+            n_step: Maximum number of rewards used before bootstraping
+            gamma: Discount factor used for calculating the n-step returns
+            num_envs: Number of envs adding transitions in lockstep
+        '''
+        assert maxlen % num_envs == 0, 'maxlen must be a multiple of num_envs'
+        self.sess = sess
+        self.maxlen = maxlen
+        self.batch_size = batch_size
+        self.n_step = n_step
+        self.gamma = gamma
+        self.num_envs = num_envs
+        feed_dict = {self.maxlen_ph: maxlen}
+        feed_dict.update({
+            self.config_phs[name]: value
+            for name, value in [('num_envs', num_envs), ('batch_size', batch_size),
+                                ('n_step', n_step), ('gamma', gamma)]
+        })
+        sess.run(self.allocate_op, feed_dict=feed_dict)
+
+        self.current_idx = 0
+        self.current_len = 0
+        # Number of transitions that can be sampled
+        self.uploaded_len = 0
+        # Transitions waiting to be uploaded, from slot <chunk_idx>
+        chunk_size = min(-(-self.chunk_size // num_envs) * num_envs, maxlen)
+        self.chunk = {
+            'states': np.empty((chunk_size, ) + self.state_shape, self.state_dtype),
+            'actions': np.empty(chunk_size, np.int32),
+            'rewards': np.empty(chunk_size, np.float32),
+            'dones': np.empty(chunk_size, np.float32),
+            'frames_since_done': np.empty(chunk_size, np.int32)
+        }
+        self.chunk_idx = 0
+        self.num_pending = 0
+        self.initialized = True
+
+    def add(self, state, action, reward, done):
+        '''
+        Stores a transition, when using multiple envs each argument
+        must contain one value per env (always in the same env order)
+        '''
+        assert self.initialized, 'allocate must be called before adding transitions'
+        # Count frames since the episode started (from the previous step of each env)
+        if self.current_len == 0:
+            frames_since_done = 0
+        else:
+            prev = slice(self.num_pending - self.num_envs, self.num_pending)
+            if self.num_pending == 0:
+                prev = slice(len(self.chunk['dones']) - self.num_envs, None)
+            frames_since_done = np.where(
+                self.chunk['dones'][prev], 0,
+                np.minimum(self.chunk['frames_since_done'][prev] + 1,
+                           self.history_length))
+
+        idxs = slice(self.num_pending, self.num_pending + self.num_envs)
+        self.chunk['states'][idxs] = np.reshape(state,
+                                                (self.num_envs, ) + self.state_shape)
+        self.chunk['actions'][idxs] = action
+        self.chunk['rewards'][idxs] = reward
+        self.chunk['dones'][idxs] = done
+        self.chunk['frames_since_done'][idxs] = frames_since_done
+        self.num_pending += self.num_envs
+
+        # Update current position
+        self.current_idx = (self.current_idx + self.num_envs) % self.maxlen
+        self.current_len = min(self.current_len + self.num_envs, self.maxlen)
+        if self.num_pending == len(self.chunk['dones']):
+            self.flush()
+
+    def flush(self):
+        ''' Uploads the transitions waiting on the current chunk '''
+        if self.num_pending == 0:
+            return
+        slots = (self.chunk_idx + np.arange(self.num_pending)) % self.maxlen
+        feed_dict = {
+            self.insert_phs[name]: values[:self.num_pending]
+            for name, values in self.chunk.items()
+        }
+        feed_dict.update({
+            self.slots_ph: slots,
+            self.new_idx_ph: self.current_idx,
+            self.new_len_ph: self.current_len
+        })
+        self.sess.run(self.insert_op, feed_dict=feed_dict)
+        self.chunk_idx = self.current_idx
+        self.uploaded_len = self.current_len
+        # The last transitions are kept for counting the frames since done
+        if self.num_pending < len(self.chunk['dones']):
+            for values in self.chunk.values():
+                values[-self.num_envs:] = values[self.num_pending - self.num_envs:
+                                                 self.num_pending]
+        self.num_pending = 0
+
+    def get_sample_feed_dict(self, n_step=None, randomize_n_step=False, batch_size=None):
+        ''' Feeds the sampling parameters different from the ones given to allocate '''
+        feed_dict = {self.sample_phs['randomize_n_step']: randomize_n_step}
+        if n_step is not None:
+            feed_dict[self.sample_phs['n_step']] = n_step
+        if batch_size is not None:
+            feed_dict[self.sample_phs['batch_size']] = batch_size
+        return feed_dict
+
+    def sample(self, n_step=None, randomize_n_step=False, batch_size=None):
+        '''
+        Samples a mini-batch of the uploaded transitions
+
+        Args:
+            n_step: Number of rewards used before bootstraping (default self.n_step)
+            randomize_n_step: Choose a random n_step (from 1 to n_step) for each sample
+            batch_size: Number of transitions sampled (default self.batch_size)
+        '''
+        return self.sess.run(
+            self.sample_tensors,
+            feed_dict=self.get_sample_feed_dict(n_step, randomize_n_step, batch_size))
+
+    def get_stats(self):
+        return {'pending_transitions': self.num_pending} if self.initialized else dict()
@@ -1,11 +1,21 @@
+import operator
 import os
 import pickle
+import queue
 import random
-from collections import deque
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
 
 import numpy as np
-import tensorflow as tf
-from scipy.signal import lfilter
+
+# tensorflow and scipy are imported by the functions that use them, so the
+# replay buffers and the Scaler can be used without paying for their import
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
 
 
 class RingBuffer:
@@ -13,26 +23,39 @@ class RingBuffer:
     Similar function of a deque, but returns a numpy array directly
     Used for building an array with <maxlen> sequential states
 
+    Each state is written twice (at idx and idx + maxlen) on a buffer with space
+    for 2 * maxlen states, so the last <maxlen> states are always a contiguous slice,
+    appending copies a single state and get_data doesn't allocate memory
+
     Args:
         state_shape: Shape of state (tuple)
         maxlen: How many states to stack
+        dtype: Type of the stored states (default np.float32)
     '''
 
-    def __init__(self, state_shape, maxlen):
-        self.state_shape = state_shape
+    def __init__(self, state_shape, maxlen, dtype=np.float32):
+        self.state_shape = tuple(state_shape)
         self.maxlen = maxlen
-        self.current_idx = 0
+        self.data = np.zeros((2 * self.maxlen, ) + self.state_shape, dtype=dtype)
         self.reset()
 
     def reset(self):
-        self.data = np.zeros(((self.maxlen, ) + self.state_shape))
+        self.data.fill(0)
+        self.current_idx = 0
 
     def append(self, data):
-        self.data = np.roll(self.data, -1, axis=0)
-        self.data[self.maxlen - 1] = np.squeeze(data)
+        state = np.reshape(data, self.state_shape)
+        self.data[self.current_idx] = state
+        self.data[self.current_idx + self.maxlen] = state
+        self.current_idx = (self.current_idx + 1) % self.maxlen
 
     def get_data(self):
-        return self.data.swapaxes(0, -1)
+        '''
+        Returns a view of the stacked states (oldest first) on the last axis,
+        only valid until the next append (or reset) which overwrites it,
+        copy it to keep the states
+        '''
+        return self.data[self.current_idx:self.current_idx + self.maxlen].swapaxes(0, -1)
 
 
 class ReplayBuffer:
@@ -42,102 +65,927 @@ class ReplayBuffer:
              image (uint8), storing 1M frames should use about 7GiB of RAM
              (8 * 64 * 64 * 1M bits)
 
+    The n-step returns are calculated when sampling, the sampled batch
+    already contains the discounted rewards and the bootstrap mask (dones)
+
+    Transitions from multiple envs are stored interleaved (slot = t * num_envs + i_env),
+    so consecutive states of the same env are <num_envs> slots apart
+
+    When <storage_dir> is defined the transitions are stored on memory-mapped
+    .npy files inside it (only the accessed pages are kept in RAM by the OS),
+    use save and initialize_or_load for resuming from a previous run
+
+    When <compression> is defined each state is stored compressed
+    (see CompressedFrameStore), trading sampling speed for memory
+
+    When <storage_dtype> is defined each state is stored with fewer bytes
+    (see StateQuantizer), meant for the float states of non-image envs.
+    Without <quantization_range> the range of the features is calibrated with
+    the first <quantization_warmup> states (kept unquantized until then).
+    Sampled states are dequantized to float32
+
+    Stacked states never mix episodes, frames from a previous episode are
+    zeroed (like the stacks seen when acting), and transitions overlapping the
+    write position (old and new data) are never sampled
+
     Args:
         maxlen: Maximum number of transitions stored
         history_length: Number of sequential states stacked when sampling
         batch_size: Mini-batch size created by sample
+        n_step: Maximum number of rewards used before bootstraping
+        gamma: Discount factor used for calculating the n-step returns
+        num_envs: Number of envs adding transitions in lockstep
+        storage_dir: Directory for the memory-mapped files (default None, keeps
+                     everything in RAM)
+        compression: 'lz4' or 'zlib' (default None, stores the raw states)
+        storage_dtype: 'float16', 'uint8' or 'uint16' (default None, stores the
+                       states with their own dtype)
+        quantization_warmup: Number of states used for calibrating the quantization
+        quantization_range: (low, high) or Scaler, range of the quantized states
+                            (default None, calibrated from the warmup states)
     '''
 
-    def __init__(self, maxlen, history_length=1, batch_size=32, n_step=1):
+    def __init__(self,
+                 maxlen,
+                 history_length=1,
+                 batch_size=32,
+                 n_step=1,
+                 gamma=0.99,
+                 num_envs=1,
+                 storage_dir=None,
+                 compression=None,
+                 storage_dtype=None,
+                 quantization_warmup=1000,
+                 quantization_range=None):
+        assert maxlen % num_envs == 0, 'maxlen must be a multiple of num_envs'
+        assert storage_dir is None or compression is None, \
+            'Compressed states can not be memory-mapped'
+        assert storage_dtype is None or compression is None, \
+            'Compressed states can not be quantized'
         self.maxlen = maxlen
         self.history_length = history_length
         self.batch_size = batch_size
         self.n_step = n_step
+        self.gamma = gamma
+        self.num_envs = num_envs
+        self.storage_dir = storage_dir
+        self.compression = compression
+        self.storage_dtype = storage_dtype
+        self.quantization_range = quantization_range
+        # Rounded up to whole steps of all envs
+        self.quantization_warmup = min(-(-quantization_warmup // num_envs) * num_envs,
+                                       maxlen)
+        self.quantizer = None
+        self.warmup_states = None
         self.initialized = False
         self.current_idx = 0
         self.current_len = 0
+        # Discount applied to each reward of the n-step window
+        self.gamma_powers = (gamma**np.arange(n_step)).astype(np.float32)
 
     def add(self, state, action, reward, done):
+        '''
+        Stores a transition, when using multiple envs each argument
+        must contain one value per env (always in the same env order)
+        '''
         if not self.initialized:
-            self.initialized = True
-            state_shape = np.squeeze(state).shape
-            # Allocate memory
-            self.states = np.empty((self.maxlen, ) + state_shape, dtype=state.dtype)
-            self.actions = np.empty(self.maxlen, dtype=np.int32)
-            self.rewards = np.empty(self.maxlen, dtype=np.float32)
-            self.dones = np.empty(self.maxlen, dtype=np.bool)
-
-            # Function for selecting multiple slices
-            self.states_stride_history = strided_axis0(self.states, self.history_length)
-            self.rewards_stride_nstep = strided_axis0(self.rewards, self.n_step)
-            self.dones_stride_nstep = strided_axis0(self.dones, self.n_step)
+            self._allocate(self._get_state_shape(state), np.asarray(state).dtype)
+
+        # Count frames since the episode started (from the previous slot of each env)
+        prev_idxs = np.arange(self.current_idx - self.num_envs, self.current_idx)
+        if self.current_len == 0:
+            frames_since_done = 0
+        else:
+            frames_since_done = np.where(
+                self.dones[prev_idxs], 0,
+                np.minimum(self.frames_since_done[prev_idxs] + 1, self.history_length))
 
         # Store transition
-        self.states[self.current_idx] = np.squeeze(state)
-        self.actions[self.current_idx] = action
-        self.rewards[self.current_idx] = reward
-        self.dones[self.current_idx] = done
+        idxs = slice(self.current_idx, self.current_idx + self.num_envs)
+        self.frames_since_done[idxs] = frames_since_done
+        self._store_states(idxs, state)
+        self.actions[idxs] = action
+        self.rewards[idxs] = reward
+        self.dones[idxs] = done
 
         # Update current position
-        self.current_idx = (self.current_idx + 1) % self.maxlen
-        self.current_len = min(self.current_len + 1, self.maxlen)
+        self.current_idx = (self.current_idx + self.num_envs) % self.maxlen
+        self.current_len = min(self.current_len + self.num_envs, self.maxlen)
+
+    def add_sequence(self, states, actions, rewards, dones):
+        '''
+        Stores many consecutive steps at once (e.g. a chunk of transitions),
+        same as calling add for each step. When using multiple envs the steps
+        are flattened in the order they are stored (all envs of a step, then the
+        next step)
+        '''
+        num_transitions = len(dones)
+        assert num_transitions % self.num_envs == 0, \
+            'Each step must contain all the envs'
+        if not self.initialized:
+            self._allocate(
+                self._get_state_shape(states[:self.num_envs]), np.asarray(states).dtype)
+
+        start = 0
+        while start < num_transitions:
+            # Each part is stored on contiguous slots (the writes wrap around)
+            size = min(num_transitions - start, self.maxlen - self.current_idx)
+            # The quantizer is calibrated once the warmup states are complete
+            warmup_left = self.quantization_warmup - self.current_idx
+            if self.warmup_states is not None and warmup_left > 0:
+                size = min(size, warmup_left)
+            part = slice(start, start + size)
+            self._add_contiguous(states[part], actions[part], rewards[part], dones[part])
+            start += size
+
+    def _add_contiguous(self, states, actions, rewards, dones):
+        idxs = slice(self.current_idx, self.current_idx + len(dones))
+        # Same frame counting as add, for all steps at once
+        dones = np.reshape(dones, (-1, self.num_envs))
+        prev_idxs = np.arange(self.current_idx - self.num_envs, self.current_idx)
+        if self.current_len == 0:
+            prev_frames = np.full(self.num_envs, -1)
+            prev_dones = np.zeros(self.num_envs, dtype=np.bool_)
+        else:
+            prev_frames = self.frames_since_done[prev_idxs]
+            prev_dones = self.dones[prev_idxs]
+        # The episode starts after a done
+        episode_starts = np.concatenate([prev_dones[None], dones[:-1]])
+        steps = np.arange(len(dones))[:, None]
+        last_starts = np.maximum.accumulate(np.where(episode_starts, steps, -1), axis=0)
+        frames_since_done = np.where(last_starts >= 0, steps - last_starts,
+                                     prev_frames + 1 + steps)
+
+        self.frames_since_done[idxs] = np.minimum(frames_since_done,
+                                                  self.history_length).ravel()
+        self._store_states(idxs, states)
+        self.actions[idxs] = actions
+        self.rewards[idxs] = rewards
+        self.dones[idxs] = dones.ravel()
+
+        self.current_idx = idxs.stop % self.maxlen
+        self.current_len = min(self.current_len + dones.size, self.maxlen)
+
+    def _store_states(self, idxs, states):
+        states = np.reshape(states, (-1, ) + self.states.shape[1:])
+        if self.quantizer is None:
+            self.states[idxs] = states
+            return
+
+        if not self.quantizer.calibrated:
+            if idxs.stop <= self.quantization_warmup:
+                self.warmup_states[idxs] = states
+                return
+            self._calibrate()
+        self.states[idxs] = self.quantizer.encode(states)
+
+    def _calibrate(self):
+        ''' Calibrates the quantizer with the warmup states and quantizes them '''
+        if self.quantizer is None or self.quantizer.calibrated:
+            return
+        warmup_states = self.warmup_states[:self.current_len]
+        self.quantizer.calibrate(warmup_states)
+        if self.current_len > 0:
+            self.states[:self.current_len] = self.quantizer.encode(warmup_states)
+        self.warmup_states = None
+
+    def _read_states(self, idxs):
+        ''' Returns the states stored on <idxs> with their original values '''
+        if self.quantizer is None:
+            return self.states[idxs]
+        if not self.quantizer.calibrated:
+            return self.warmup_states[idxs]
+        return self.quantizer.decode(self.states[idxs])
+
+    def _get_state_shape(self, state):
+        if self.initialized:
+            return self.states.shape[1:]
+        state_shape = np.squeeze(state).shape
+        if self.num_envs > 1:
+            state_shape = state_shape[1:]
+        return state_shape
+
+    def _allocate(self, state_shape, state_dtype, mode='w+'):
+        self.initialized = True
+        if self.storage_dtype is not None:
+            self.quantizer = StateQuantizer(
+                self.storage_dtype,
+                state_shape,
+                state_dtype,
+                value_range=self.quantization_range)
+            if not self.quantizer.calibrated:
+                self.warmup_states = np.empty(
+                    (self.quantization_warmup, ) + tuple(state_shape), dtype=np.float32)
+            state_dtype = self.quantizer.dtype
+        if self.compression is None:
+            self.states = self._create_array(
+                'states', (self.maxlen, ) + tuple(state_shape), state_dtype, mode)
+        else:
+            self.states = CompressedFrameStore(
+                self.maxlen, state_shape, state_dtype, compression=self.compression)
+        self.actions = self._create_array('actions', (self.maxlen, ), np.int32, mode)
+        self.rewards = self._create_array('rewards', (self.maxlen, ), np.float32, mode)
+        self.dones = self._create_array('dones', (self.maxlen, ), np.bool_, mode)
+        # Number of previous frames of the same episode (up to history_length)
+        self.frames_since_done = self._create_array('frames_since_done', (self.maxlen, ),
+                                                    np.int32, mode)
+
+        # Function for selecting multiple slices (also works on top of memmaps)
+        if self.compression is None:
+            self.states_stride_history = strided_axis0(
+                self.states, self.history_length, step=self.num_envs)
+        self.rewards_stride_nstep = strided_axis0(
+            self.rewards, self.n_step, step=self.num_envs)
+        self.dones_stride_nstep = strided_axis0(
+            self.dones, self.n_step, step=self.num_envs)
+
+    def _create_array(self, name, shape, dtype, mode='w+'):
+        '''
+        Allocates an array in RAM or a memory-mapped file on <storage_dir>,
+        mode 'r+' opens an existing file
+        '''
+        if self.storage_dir is None:
+            return np.empty(shape, dtype=dtype)
+
+        os.makedirs(self.storage_dir, exist_ok=True)
+        path = os.path.join(self.storage_dir, name + '.npy')
+        array = np.lib.format.open_memmap(path, mode=mode, dtype=dtype, shape=shape)
+        assert array.shape == shape, 'Stored {} have shape {}, expected {}'.format(
+            name, array.shape, shape)
+
+        return array
+
+    def _get_metadata(self):
+        ''' Everything needed for reopening the buffer, besides the stored arrays '''
+        metadata = {
+            'maxlen': self.maxlen,
+            'num_envs': self.num_envs,
+            'state_shape': self.states.shape[1:],
+            'state_dtype': self.states.dtype,
+            'current_idx': self.current_idx,
+            'current_len': self.current_len
+        }
+        if self.quantizer is not None:
+            metadata['state_dtype'] = self.quantizer.input_dtype
+            metadata['quantizer'] = self.quantizer.get_params()
+
+        return metadata
+
+    def _set_metadata(self, metadata):
+        self.current_idx = metadata['current_idx']
+        self.current_len = metadata['current_len']
+        if self.quantizer is not None:
+            assert 'quantizer' in metadata, 'Stored buffer is not quantized'
+            self.quantizer.set_params(metadata['quantizer'])
+            self.warmup_states = None
+
+    def save(self):
+        '''
+        Flushes the memory-mapped arrays to disk and saves the buffer position,
+        the transitions added after the last save are not guaranteed to be reloaded
+        '''
+        assert self.storage_dir is not None, 'Only memory-mapped buffers can be saved'
+        if not self.initialized:
+            return
+        # The warmup states are only kept in RAM
+        self._calibrate()
+        arrays = [self.states, self.actions, self.rewards, self.dones]
+        for array in arrays + [self.frames_since_done]:
+            array.flush()
+
+        # Replace the old metadata only after it's completely written
+        path = os.path.join(self.storage_dir, 'metadata.pkl')
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(self._get_metadata(), f)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def initialize_or_load(cls, maxlen, storage_dir=None, **kwargs):
+        ''' Reopens the buffer saved on <storage_dir> (if exists) '''
+        replay_buffer = cls(maxlen, storage_dir=storage_dir, **kwargs)
+        if storage_dir is None:
+            return replay_buffer
 
-    def sample(self, n_step=None):
+        path = os.path.join(storage_dir, 'metadata.pkl')
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                metadata = pickle.load(f)
+            assert metadata['maxlen'] == maxlen, 'Stored buffer has maxlen {}'.format(
+                metadata['maxlen'])
+            assert metadata['num_envs'] == replay_buffer.num_envs, \
+                'Stored buffer has num_envs {}'.format(metadata['num_envs'])
+            print('Loading replay buffer from {}'.format(storage_dir))
+            replay_buffer._allocate(
+                metadata['state_shape'], metadata['state_dtype'], mode='r+')
+            replay_buffer._set_metadata(metadata)
+
+        return replay_buffer
+
+    def sample(self, n_step=None, randomize_n_step=False, batch_size=None):
+        '''
+        Samples a mini-batch of transitions
+
+        Args:
+            n_step: Number of rewards used before bootstraping, can be an int or an
+                    array with one value per sample (default self.n_step)
+            randomize_n_step: Choose a random n_step (from 1 to n_step) for each sample
+            batch_size: Number of transitions sampled (default self.batch_size)
+        '''
+        start_idxs, end_idxs = self._generate_idxs(batch_size or self.batch_size)
+        return self._create_batch(start_idxs, end_idxs, n_step, randomize_n_step)
+
+    def _create_batch(self, start_idxs, end_idxs, n_step=None, randomize_n_step=False):
+        # Sampling is only done after enough states for calibrating
+        self._calibrate()
+        batch_size = len(start_idxs)
         if n_step is None:
             n_step = self.n_step
-        start_idxs, end_idxs = self._generate_idxs()
-        # Get states
-        b_states_t = self.states_stride_history[start_idxs]
-        b_states_tp1 = self.states_stride_history[start_idxs + n_step]
-        rewards = self.rewards_stride_nstep[end_idxs - 1]
-        dones = self.dones_stride_nstep[end_idxs - 1]
+        if randomize_n_step:
+            n_step = np.random.randint(1, n_step + 1, size=batch_size)
+        n_step = np.broadcast_to(n_step, (batch_size, ))
+        # Get states (with a single read, so shared frames are decoded only once)
+        b_start_idxs = np.concatenate([start_idxs, start_idxs + n_step * self.num_envs])
+        b_states = self._get_stacked_states(b_start_idxs)
+        # Zero the frames that belong to a previous episode
+        frames_since_done = self.frames_since_done[b_start_idxs + (
+            self.history_length - 1) * self.num_envs]
+        previous_episode = (np.arange(self.history_length)[::-1] >
+                            frames_since_done[:, None])
+        b_states[previous_episode] = 0
+        b_states_t, b_states_tp1 = np.split(b_states, 2)
         # Remember that when slicing the end_idx is not included
-        actions = self.actions[end_idxs - 1]
+        last_idxs = end_idxs - self.num_envs
+        actions = self.actions[last_idxs]
+        rewards, dones = self._calculate_n_step_return(last_idxs, n_step)
 
         batch = {
             'states_t': b_states_t.swapaxes(1, -1),
             'states_tp1': b_states_tp1.swapaxes(1, -1),
             'actions': actions,
-            'rewards': rewards[:, :n_step],
-            'dones': dones[:, :n_step]
+            'rewards': rewards,
+            'dones': dones,
+            'n_step': n_step.astype(np.float32)
         }
 
         return batch
 
-    def _generate_idxs(self):
-        start_idxs = np.random.randint(
-            self.current_len - self.history_length - self.n_step, size=self.batch_size)
-        end_idxs = start_idxs + self.history_length
-        # start_idxs = []
-        # end_idxs = []
-        # while len(start_idxs) < self.batch_size:
-        #     start_idx = np.random.randint(0, self.current_len
-        #                                   - self.history_length
-        #                                   - self.n_step)
-        #     end_idx = start_idx + self.history_length
+    def _get_stacked_states(self, start_idxs):
+        ''' Returns <history_length> sequential states for each start idx '''
+        if self.quantizer is not None:
+            # Dequantized with a single operation for the whole batch
+            return self.quantizer.decode(self.states_stride_history[start_idxs])
+        if self.compression is None:
+            return self.states_stride_history[start_idxs]
+
+        idxs = start_idxs[:, None] + np.arange(self.history_length) * self.num_envs
+        return self.states[idxs]
+
+    def get_stats(self):
+        ''' Dictionary with statistics of the stored states '''
+        if self.initialized and self.compression is not None:
+            return self.states.get_stats()
+        if self.quantizer is not None:
+            return self.quantizer.get_stats()
+        return dict()
+
+    def stack_recent_states(self, states):
+        '''
+        Stacks <states> (one per env, not added yet) with the previous states of
+        each env already stored, the same stacks built by a RingBuffer for each
+        env, but without keeping a copy of the frames
+
+        Returns:
+            Array of shape (num_envs, ) + state_shape + (history_length, )
+        '''
+        states = np.reshape(states, (self.num_envs, ) + self._get_state_shape(states))
+        stacked = np.zeros((self.num_envs, self.history_length) + states.shape[1:],
+                           dtype=states.dtype)
+        stacked[:, -1] = states
+
+        if self.current_len > 0 and self.history_length > 1:
+            # Slots of the previous states of each env (oldest first)
+            idxs = (self.current_idx + self.num_envs * np.arange(
+                1 - self.history_length, 0) + np.arange(self.num_envs)[:, None])
+            idxs %= self.maxlen
+            # Previous states from the same episode
+            last_idxs = idxs[:, -1]
+            num_frames = np.where(self.dones[last_idxs], 0,
+                                  self.frames_since_done[last_idxs] + 1)
+            in_episode = np.arange(self.history_length - 1)[::-1] < num_frames[:, None]
+            stacked[:, :-1][in_episode] = self._read_states(idxs[in_episode])
+
+        return stacked.swapaxes(1, -1)
+
+    def _calculate_n_step_return(self, idxs, n_step):
+        '''
+        Vectorized version of calculate_n_step_return, computes the discounted
+        return of the first <n_step> rewards (stopping at the first done) and
+        if the episode ended inside this window, for all <idxs> at once
+        '''
+        rewards = self.rewards_stride_nstep[idxs]
+        dones = self.dones_stride_nstep[idxs]
+        # Only the first <n_step> rewards of each sample are used
+        in_window = np.arange(self.n_step) < n_step[:, None]
+        dones = dones & in_window
+        # Rewards after the first done belong to the next episode
+        in_episode = (np.cumsum(dones, axis=1) - dones) == 0
+        mask = in_window & in_episode
+
+        returns = np.dot(rewards * mask, self.gamma_powers)
+        return returns, np.any(dones, axis=1).astype(np.float32)
+
+    def _generate_idxs(self, batch_size):
+        '''
+        Uniformly samples the start of valid transitions, a transition spans
+        <window> slots and can't overlap the write position (mixing the newest
+        and the oldest data), the invalid starts are skipped without rejection
+        '''
+        window = (self.history_length + self.n_step - 1) * self.num_envs
+        # The strided views don't wrap around the end of the buffer
+        high = self.current_len - window
+        # Starts that would overlap the write position
+        low_invalid = max(0, self.current_idx - window)
+        num_invalid = max(0, min(self.current_idx, high) - low_invalid)
+
+        idxs = np.random.randint(high - num_invalid, size=batch_size)
+        start_idxs = idxs + num_invalid * (idxs >= low_invalid)
+        end_idxs = start_idxs + self.history_length * self.num_envs
+
+        return start_idxs, end_idxs
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    '''
+    Prioritized experience replay (https://arxiv.org/pdf/1511.05952.pdf)
+    Transitions are sampled proportionally to their priorities (stored on a SumTree),
+    the sampled batch also contains the importance sampling weights and the
+    index of each transition (used by update_priorities)
+
+    New transitions receive the maximum priority seen so far, transitions
+    which states are being overwritten receive zero priority
+
+    Args:
+        maxlen: Maximum number of transitions stored
+        alpha: How much prioritization is used (0 corresponds to uniform sampling)
+        epsilon: Added to the absolute td errors, so all transitions can be sampled
+
+    Kwargs:
+        Same as ReplayBuffer
+    '''
+
+    def __init__(self, maxlen, alpha=0.6, epsilon=1e-6, **kwargs):
+        super().__init__(maxlen, **kwargs)
+        self.alpha = alpha
+        self.epsilon = epsilon
+        self.max_priority = 1.
+        self.sum_tree = SumTree(maxlen)
+        self.min_tree = MinTree(maxlen)
+        # Transitions (indexed by start idx) span <window> slots
+        self.window = (self.history_length + self.n_step - 1) * self.num_envs
+
+    def add(self, state, action, reward, done):
+        new_idxs = np.arange(self.current_idx, self.current_idx + self.num_envs)
+        super().add(state, action, reward, done)
+
+        # Transitions starting on the new states mix new and old data, transitions
+        # starting between them and the new states were invalidated on previous adds
+        self._set_priorities(new_idxs, 0)
+        # Transitions ending on the new states can be sampled
+        complete_idxs = new_idxs - self.window
+        complete_idxs = complete_idxs[complete_idxs >= 0]
+        self._set_priorities(complete_idxs, self.max_priority**self.alpha)
+
+    def add_sequence(self, states, actions, rewards, dones):
+        new_idxs = (self.current_idx + np.arange(len(dones))) % self.maxlen
+        super().add_sequence(states, actions, rewards, dones)
+
+        # Same as add for each transition: zero the new idx, then complete the one
+        # <window> slots before. Only the last change of each idx is kept, as a
+        # long sequence can overwrite the transitions it completed
+        idxs = np.stack([new_idxs, new_idxs - self.window], axis=1).ravel()
+        complete = np.tile([False, True], len(new_idxs))
+        idxs, complete = idxs[idxs >= 0], complete[idxs >= 0]
+        _, last = np.unique(idxs[::-1], return_index=True)
+        idxs, complete = idxs[::-1][last], complete[::-1][last]
+        self._set_priorities(idxs[~complete], 0)
+        self._set_priorities(idxs[complete], self.max_priority**self.alpha)
+
+    def sample(self, n_step=None, randomize_n_step=False, batch_size=None, beta=0.4):
+        '''
+        Args:
+            beta: Amount of importance sampling correction (1 fully compensates
+                  for the non-uniform probabilities)
+        '''
+        start_idxs = self._generate_prioritized_idxs(batch_size or self.batch_size)
+        end_idxs = start_idxs + self.history_length * self.num_envs
+        batch = self._create_batch(start_idxs, end_idxs, n_step, randomize_n_step)
+
+        # Importance sampling weights, normalized by the maximum weight
+        total = self.sum_tree.reduce()
+        probs = self.sum_tree[start_idxs] / total
+        min_prob = self.min_tree.reduce() / total
+        weights = (probs / min_prob)**(-beta)
+        batch['weights'] = weights.astype(np.float32)
+        batch['idxs'] = start_idxs
+
+        return batch
+
+    def update_priorities(self, idxs, td_errors):
+        priorities = np.abs(td_errors) + self.epsilon
+        self.max_priority = max(self.max_priority, np.max(priorities))
+        # Transitions overwritten after being sampled stay invalid
+        valid = self.sum_tree[idxs] > 0
+        self._set_priorities(idxs[valid], priorities[valid]**self.alpha)
+
+    def _get_metadata(self):
+        metadata = super()._get_metadata()
+        metadata['max_priority'] = self.max_priority
+        metadata['sum_tree'] = self.sum_tree.tree
+        metadata['min_tree'] = self.min_tree.tree
+
+        return metadata
 
-        #     # Check if idx was already picked
-        #     if start_idx in start_idxs:
-        #         continue
+    def _set_metadata(self, metadata):
+        super()._set_metadata(metadata)
+        self.max_priority = metadata['max_priority']
+        self.sum_tree.tree[:] = metadata['sum_tree']
+        self.min_tree.tree[:] = metadata['min_tree']
 
-        #     # Check if state contains frames only from a single episode
-        #     if np.any(self.dones[start_idx : end_idx - 1]):
-        #         continue
+    def _set_priorities(self, idxs, priorities):
+        self.sum_tree[idxs] = priorities
+        self.min_tree[idxs] = np.where(priorities > 0, priorities, np.inf)
 
-        #     # Valid idx!!
-        #     start_idxs.append(start_idx)
-        #     end_idxs.append(end_idx)
+    def _generate_prioritized_idxs(self, batch_size):
+        # Stratified sampling, one sample from each segment of the total priority
+        segment = self.sum_tree.reduce() / batch_size
+        prefixsums = (np.arange(batch_size) + np.random.random(batch_size))
+        return self.sum_tree.find_prefixsum_idx(prefixsums * segment)
 
-        return np.array(start_idxs), np.array(end_idxs)
+
+class BatchPrefetcher:
+    '''
+    Samples mini-batches on a background thread, keeping up to <depth> batches
+    ready, so sampling overlaps with the training step (both release the GIL
+    on the heavy parts). The batches are made contiguous on the background
+    thread, so feeding them is a plain copy.
+
+    Everything that modifies the replay buffer must hold <lock>
+
+    Args:
+        sample_fn: Function that returns a mini-batch (dict of arrays)
+        lock: Lock shared with the code adding to the replay buffer
+        depth: Maximum number of batches kept ready
+    '''
+
+    def __init__(self, sample_fn, lock, depth=2):
+        self.sample_fn = sample_fn
+        self.lock = lock
+        self.queue = queue.Queue(depth)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            while not self.stop_event.is_set():
+                with self.lock:
+                    batch = self.sample_fn()
+                batch = {key: np.ascontiguousarray(value) for key, value in batch.items()}
+                self._put(batch)
+        except Exception as e:
+            # Raised on the main thread by get
+            self._put(e)
+
+    def _put(self, item):
+        ''' Waits for space on the queue, checking for stop from time to time '''
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def get(self):
+        batch = self.queue.get()
+        if isinstance(batch, Exception):
+            raise batch
+        return batch
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+
+
+class CompressedFrameStore:
+    '''
+    Stores each frame as a compressed blob, indexing with an array of idxs
+    decodes all the requested frames at once (each unique frame only once),
+    recently decoded frames are kept on a small LRU cache.
+    Atari frames (84x84 uint8) usually compress 3-5x
+
+    Args:
+        maxlen: Maximum number of frames stored
+        frame_shape: Shape of each frame (tuple)
+        dtype: Type of the frames
+        compression: 'lz4' (faster, falls back to 'zlib' if not installed) or 'zlib'
+        cache_size: Maximum number of decoded frames kept on cache
+    '''
+
+    def __init__(self, maxlen, frame_shape, dtype, compression='lz4', cache_size=1024):
+        if compression == 'lz4' and lz4 is None:
+            print('lz4 not installed, using zlib compression')
+            compression = 'zlib'
+        if compression == 'lz4':
+            self._compress = lz4.block.compress
+            self._decompress = lz4.block.decompress
+        elif compression == 'zlib':
+            # Fastest compression level, ratio is very similar for frames
+            self._compress = lambda data: zlib.compress(data, 1)
+            self._decompress = zlib.decompress
+        else:
+            raise ValueError('Unknown compression {}'.format(compression))
+
+        self.frame_shape = tuple(frame_shape)
+        self.shape = (maxlen, ) + self.frame_shape
+        self.dtype = np.dtype(dtype)
+        self.cache_size = cache_size
+        self.blobs = [None] * maxlen
+        self.cache = OrderedDict()
+        # Stats
+        self.num_stored = 0
+        self.compressed_bytes = 0
+        self.num_decoded = 0
+        self.num_requested = 0
+        self.decode_time = 0.
+
+    def __len__(self):
+        return len(self.blobs)
+
+    def __setitem__(self, idxs, frames):
+        frames = np.asarray(frames, dtype=self.dtype)
+        for idx, frame in zip(range(*idxs.indices(len(self))), frames):
+            old_blob = self.blobs[idx]
+            if old_blob is None:
+                self.num_stored += 1
+            else:
+                self.compressed_bytes -= len(old_blob)
+                self.cache.pop(idx, None)
+
+            blob = self._compress(np.ascontiguousarray(frame).tobytes())
+            self.blobs[idx] = blob
+            self.compressed_bytes += len(blob)
+
+    def __getitem__(self, idxs):
+        start_time = time.time()
+        idxs = np.asarray(idxs)
+        unique_idxs, inverse = np.unique(idxs.ravel(), return_inverse=True)
+        frames = np.empty((len(unique_idxs), ) + self.frame_shape, dtype=self.dtype)
+        for i, idx in enumerate(unique_idxs.tolist()):
+            frame = self.cache.get(idx)
+            if frame is None:
+                frame = np.frombuffer(
+                    self._decompress(self.blobs[idx]),
+                    dtype=self.dtype).reshape(self.frame_shape)
+                self.cache[idx] = frame
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+                self.num_decoded += 1
+            else:
+                self.cache.move_to_end(idx)
+            frames[i] = frame
+
+        self.num_requested += len(unique_idxs)
+        self.decode_time += time.time() - start_time
+        return frames[inverse].reshape(idxs.shape + self.frame_shape)
+
+    def get_stats(self):
+        raw_bytes = self.num_stored * int(np.prod(self.frame_shape)) * self.dtype.itemsize
+        return {
+            'compression_ratio': raw_bytes / max(self.compressed_bytes, 1),
+            'decode_time_per_frame': self.decode_time / max(self.num_requested, 1),
+            'cache_hit_rate': 1 - self.num_decoded / max(self.num_requested, 1)
+        }
+
+
+class StateQuantizer:
+    '''
+    Stores states with fewer bytes than they are generated with (e.g. float32
+    states of non-image envs), useful for large replay buffers.
+    'float16' just casts the states, 'uint8' and 'uint16' use an affine
+    quantization with a scale and offset per feature:
+        stored = round((state - offset) / scale), state ~= stored * scale + offset
+
+    The range of each feature is learned from the first states (see calibrate),
+    or given by <value_range>: a (low, high) tuple or a Scaler, using
+    <num_stds> standard deviations around the mean. Values outside the range
+    are clipped.
+
+    Args:
+        dtype: Type of the stored states, 'float16', 'uint8' or 'uint16'
+        state_shape: Shape of each state (tuple)
+        input_dtype: Type of the states before quantizing
+        value_range: (low, high) or Scaler (default None, calibrate from the data)
+        num_stds: Number of standard deviations kept when using a Scaler
+        margin: Fraction of the calibrated range added to each side,
+                for values a bit outside the ones seen
+        error_freq: Number of encodes between each measure of the error
+                    (the clipped values are always counted)
+    '''
+
+    def __init__(self,
+                 dtype,
+                 state_shape,
+                 input_dtype=np.float32,
+                 value_range=None,
+                 num_stds=4,
+                 margin=0.1,
+                 error_freq=100):
+        self.dtype = np.dtype(dtype)
+        assert self.dtype in [np.float16, np.uint8, np.uint16], \
+            'Unknown storage dtype {}'.format(dtype)
+        self.state_shape = tuple(state_shape)
+        self.input_dtype = np.dtype(input_dtype)
+        self.margin = margin
+        self.error_freq = error_freq
+        self.scale = None
+        self.offset = None
+        # float16 is used without calibration
+        self.calibrated = self.dtype == np.float16
+        # Stats
+        self.num_encoded = 0
+        self.error_sum = 0.
+        self.error_max = 0.
+        self.num_clipped = 0
+        self.num_values = 0
+        self.num_measured = 0
+
+        if value_range is not None and not self.calibrated:
+            if isinstance(value_range, Scaler):
+                std = np.sqrt(value_range.vars)
+                value_range = (value_range.means - num_stds * std,
+                               value_range.means + num_stds * std)
+            self.set_range(*value_range)
+
+    @property
+    def levels(self):
+        return np.iinfo(self.dtype).max
+
+    def set_range(self, low, high):
+        low = np.broadcast_to(np.asarray(low, dtype=np.float32), self.state_shape)
+        high = np.broadcast_to(np.asarray(high, dtype=np.float32), self.state_shape)
+        # Constant features would have zero scale
+        self.scale = np.maximum(high - low, 1e-6) / self.levels
+        self.offset = low.copy()
+        self.calibrated = True
+
+    def calibrate(self, states):
+        ''' Uses the range of each feature on <states> (plus the margin) '''
+        if self.calibrated:
+            return
+        low = np.min(states, axis=0)
+        high = np.max(states, axis=0)
+        margin = self.margin * (high - low)
+        self.set_range(low - margin, high + margin)
+
+    def encode(self, states):
+        states = np.asarray(states, dtype=np.float32)
+        if self.dtype == np.float16:
+            stored = states.astype(np.float16)
+        else:
+            quantized = np.rint((states - self.offset) / self.scale)
+            clipped = (quantized < 0) | (quantized > self.levels)
+            self.num_clipped += np.count_nonzero(clipped)
+            stored = np.clip(quantized, 0, self.levels, out=quantized).astype(self.dtype)
+
+        self.num_values += states.size
+        if self.num_encoded % self.error_freq == 0:
+            error = np.abs(self.decode(stored) - states)
+            self.error_sum += float(np.sum(error))
+            self.error_max = max(self.error_max, float(np.max(error)))
+            self.num_measured += error.size
+        self.num_encoded += 1
+
+        return stored
+
+    def decode(self, stored):
+        ''' Dequantizes to float32, <stored> can have any leading dimensions '''
+        if self.dtype == np.float16:
+            return stored.astype(np.float32)
+        decoded = stored.astype(np.float32)
+        decoded *= self.scale
+        decoded += self.offset
+        return decoded
+
+    def get_params(self):
+        return {'scale': self.scale, 'offset': self.offset}
+
+    def set_params(self, params):
+        self.scale = params['scale']
+        self.offset = params['offset']
+        self.calibrated = True
+
+    def get_stats(self):
+        return {
+            'memory_saving': self.input_dtype.itemsize / self.dtype.itemsize,
+            'quantization_error_mean': self.error_sum / max(self.num_measured, 1),
+            'quantization_error_max': self.error_max,
+            'clipped_fraction': self.num_clipped / max(self.num_values, 1)
+        }
+
+
+class SegmentTree:
+    '''
+    Array-backed binary tree where each node stores the result of
+    <operation> applied to its children, the leafs store the values.
+    Updates and queries are vectorized over batches of indexes.
+
+    Args:
+        capacity: Number of values stored (rounded up to a power of 2)
+        operation: Numpy function combining two nodes (e.g. np.add)
+        scalar_operation: Python equivalent of operation (e.g. operator.add)
+        neutral_value: Value of empty leafs (e.g. 0 for np.add)
+    '''
+
+    def __init__(self, capacity, operation, scalar_operation, neutral_value):
+        self.capacity = 1
+        while self.capacity < capacity:
+            self.capacity *= 2
+        self.operation = operation
+        self.scalar_operation = scalar_operation
+        self.tree = np.full(2 * self.capacity, neutral_value, dtype=np.float64)
+
+    def __setitem__(self, idxs, values):
+        idxs = np.asarray(idxs).ravel() + self.capacity
+        self.tree[idxs] = values
+        # A python loop is faster for updating a few values (e.g. when adding)
+        if idxs.size <= 4:
+            for idx in idxs.tolist():
+                self._update_parents(idx)
+        else:
+            # Update parents, one level at a time (repeated parents write the same value)
+            idxs = idxs // 2
+            while idxs[0] >= 1:
+                self.tree[idxs] = self.operation(self.tree[2 * idxs],
+                                                 self.tree[2 * idxs + 1])
+                idxs //= 2
+
+    def __getitem__(self, idxs):
+        return self.tree[np.asarray(idxs) + self.capacity]
+
+    def _update_parents(self, idx):
+        tree = self.tree
+        idx //= 2
+        while idx >= 1:
+            value = self.scalar_operation(tree.item(2 * idx), tree.item(2 * idx + 1))
+            # The ancestors don't change either
+            if value == tree.item(idx):
+                break
+            tree[idx] = value
+            idx //= 2
+
+    def reduce(self):
+        ''' Result of the operation applied to all values '''
+        return self.tree[1]
+
+
+class SumTree(SegmentTree):
+    def __init__(self, capacity):
+        super().__init__(capacity, np.add, operator.add, 0.)
+
+    def find_prefixsum_idx(self, prefixsums):
+        ''' Finds the highest indexes i such that sum(values[:i]) <= prefixsum '''
+        prefixsums = np.array(prefixsums, dtype=np.float64)
+        idxs = np.ones(len(prefixsums), dtype=np.int64)
+        # All leafs are at the same depth
+        while idxs[0] < self.capacity:
+            left = 2 * idxs
+            left_sums = self.tree[left]
+            # Never go to empty subtrees (can happen due to float precision)
+            go_right = (prefixsums > left_sums) & (self.tree[left + 1] > 0)
+            prefixsums -= left_sums * go_right
+            idxs = left + go_right
+
+        return idxs - self.capacity
+
+
+class MinTree(SegmentTree):
+    def __init__(self, capacity):
+        super().__init__(capacity, np.minimum, min, np.inf)
 
 
 class Scaler(object):
     """
-    From: https://github.com/pat-coady/trpo/blob/master/src/utils.py#L13
+    Based on: https://github.com/pat-coady/trpo/blob/master/src/utils.py#L13
     Generate scale and offset based on running mean and stddev along axis=0
     offset = running mean
     scale = 1 / (stddev + 0.1) / 3 (i.e. 3x stddev = +/- 1.0)
+
+    The statistics are accumulated with the parallel algorithm of Chan et al.
+    (https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance), so each
+    update only costs O(new data) and scalers from different workers can be merged.
+    Saved as a versioned .npz file (scalers pickled by older versions can be loaded)
     """
+    VERSION = 1
 
     def __init__(self, obs_dim, path=None):
         """
@@ -145,36 +993,39 @@ class Scaler(object):
             obs_dim: dimension of axis=1
         """
         self.path = path
-        self.vars = np.zeros(obs_dim)
         self.means = np.zeros(obs_dim)
-        self.m = 0
-        self.n = 0
-        self.first_pass = True
+        # Sum of the squared differences from the mean
+        self.m2 = np.zeros(obs_dim)
+        self.count = 0
+
+    @property
+    def vars(self):
+        return self.m2 / max(self.count, 1)
 
     def update(self, x):
         """ Update running mean and variance (this is an exact method)
         Args:
-            x: NumPy array, shape = (N, obs_dim)
-        see: https://stats.stackexchange.com/questions/43159/how-to-calculate-pooled-
-               variance-of-two-groups-given-known-group-variances-mean
+            x: NumPy array, shape = (N, obs_dim) or a single state (obs_dim)
         """
-        if self.first_pass:
-            self.means = np.mean(x, axis=0)
-            self.vars = np.var(x, axis=0)
-            self.m = x.shape[0]
-            self.first_pass = False
-        else:
-            n = x.shape[0]
-            new_data_var = np.var(x, axis=0)
-            new_data_mean = np.mean(x, axis=0)
-            new_data_mean_sq = np.square(new_data_mean)
-            new_means = ((self.means * self.m) + (new_data_mean * n)) / (self.m + n)
-            self.vars = (((self.m * (self.vars + np.square(self.means))) +
-                          (n * (new_data_var + new_data_mean_sq))) /
-                         (self.m + n) - np.square(new_means))
-            self.vars = np.maximum(0.0, self.vars)  # occasionally goes negative, clip
-            self.means = new_means
-            self.m += n
+        x = np.asarray(x)
+        if x.ndim == self.means.ndim:
+            x = x[np.newaxis]
+        if len(x) == 0:
+            return
+        self._merge_stats(len(x), np.mean(x, axis=0), np.var(x, axis=0) * len(x))
+
+    def merge(self, other):
+        """ Adds the statistics accumulated by <other> (e.g. from another worker) """
+        self._merge_stats(other.count, other.means, other.m2)
+
+    def _merge_stats(self, count, means, m2):
+        if count == 0:
+            return
+        total_count = self.count + count
+        delta = means - self.means
+        self.means = self.means + delta * count / total_count
+        self.m2 = self.m2 + m2 + np.square(delta) * self.count * count / total_count
+        self.count = total_count
 
     def get(self):
         """ returns 2-tuple: (scale, offset) """
@@ -186,40 +1037,66 @@ class Scaler(object):
 
     def save(self):
         assert self.path is not None, 'You must define a path when creating this object'
-        with open(self.path, 'wb') as f:
-            pickle.dump(self.__dict__, f)
+        # Replace the old file only after it's completely written
+        with open(self.path + '.tmp', 'wb') as f:
+            np.savez(
+                f, version=self.VERSION, means=self.means, m2=self.m2, count=self.count)
+        os.replace(self.path + '.tmp', self.path)
+
+    def _load(self, path):
+        if path.endswith('.pkl'):
+            # Attributes pickled by the previous version
+            with open(path, 'rb') as f:
+                attributes = pickle.load(f)
+            self.means = attributes['means']
+            self.count = attributes['m']
+            self.m2 = attributes['vars'] * attributes['m']
+            return
+
+        with np.load(path) as data:
+            assert data['version'] <= self.VERSION, \
+                'Scaler saved by a newer version ({})'.format(data['version'])
+            self.means = data['means']
+            self.m2 = data['m2']
+            self.count = int(data['count'])
 
     @classmethod
     def initialize_or_load(cls, obs_dim, path=None):
         scaler = cls(obs_dim, path)
-        if path is not None and os.path.exists(path):
-            with open(path, 'rb') as f:
-                attributes = pickle.load(f)
-                scaler.__dict__.update(attributes)
+        if path is None:
+            return scaler
+
+        legacy_path = os.path.splitext(path)[0] + '.pkl'
+        if os.path.exists(path):
+            scaler._load(path)
+        elif os.path.exists(legacy_path):
+            scaler._load(legacy_path)
 
         return scaler
 
 
-def strided_axis0(a, L):
+def strided_axis0(a, L, step=1):
     '''
     https://stackoverflow.com/questions/43413582/selecting-multiple-slices-from-a-numpy-array-at-once/43413801#43413801
+    Each slice contains <L> elements, each <step> elements apart
     '''
     # Store the shape and strides info
     shp = a.shape
     s = a.strides
 
     # Compute length of output array along the first axis
-    nd0 = shp[0] - L + 1
+    nd0 = shp[0] - (L - 1) * step
 
     # Setup shape and strides for use with np.lib.stride_tricks.as_strided
     # and get (n+1) dim output array
     shp_in = (nd0, L) + shp[1:]
-    strd_in = (s[0], ) + s
+    strd_in = (s[0], step * s[0]) + s[1:]
     return np.lib.stride_tricks.as_strided(a, shape=shp_in, strides=strd_in)
 
 
 def load_q_func(sess, log_dir):
     ''' Returns a function that computes the q_values '''
+    import tensorflow as tf
     # Import model from metagraph
     model_path = tf.train.latest_checkpoint(log_dir)
     print('Loading model from: {}'.format(model_path))
@@ -247,9 +1124,31 @@ def egreedy_police(Q_values, epsilon):
 
 
 def discounted_sum_rewards(rewards, gamma=0.99):
+    from scipy.signal import lfilter
     return lfilter([1.0], [1.0, -gamma], rewards[::-1])[::-1]
 
 
+def discounted_sum_episodes(values, episode_lengths, gamma=0.99):
+    '''
+    Same as calling discounted_sum_rewards on each episode and concatenating
+    the results, but for all episodes at once (<values> are the concatenated
+    values of all episodes). The concatenated values are filtered once, then
+    the part of each sum that crosses the end of its episode is removed
+    (it's the sum at the start of the next episode, discounted by the steps
+    left in the episode).
+    '''
+    episode_lengths = np.asarray(episode_lengths)
+    from scipy.signal import lfilter
+    discounted = lfilter([1.0], [1.0, -gamma],
+                         np.asarray(values, dtype=np.float64)[::-1])[::-1]
+
+    episode_ends = np.repeat(np.cumsum(episode_lengths), episode_lengths)
+    steps_left = episode_ends - np.arange(len(discounted))
+    next_sums = np.append(discounted, 0.)[episode_ends]
+    discounted -= gamma ** steps_left * next_sums
+    return discounted.astype(np.result_type(values, np.float32), copy=False)
+
+
 def calculate_n_step_return(rewards, dones, gamma=0.99):
     done_idx = np.where(dones == 1)[0]
     done = False
@@ -261,6 +1160,7 @@ def calculate_n_step_return(rewards, dones, gamma=0.99):
 
 
 def tf_copy_params_op(from_scope, to_scope, soft_update=1.):
+    import tensorflow as tf
     # Get variables within defined scope
     from_scope_vars = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, from_scope)
     to_scope_vars = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, to_scope)
@@ -0,0 +1,200 @@
+import multiprocessing as mp
+
+import numpy as np
+
+
+class VecEnv:
+    '''
+    Steps a list of environments in lockstep on the current process,
+    automatically resetting the environments that finished an episode
+
+    Args:
+        envs: List of (wrapped) environments
+        monitored_envs: List with the monitored version of each env
+    '''
+
+    def __init__(self, envs, monitored_envs):
+        self.envs = envs
+        self.monitored_envs = monitored_envs
+        self.num_envs = len(envs)
+
+    def reset(self):
+        return np.array([env.reset() for env in self.envs])
+
+    def step(self, actions):
+        '''
+        Returns (states, rewards, dones, infos), the state of an env that finished
+        an episode is already the first state of the next episode, the last state
+        of the episode is stored on infos[i_env]['terminal_state']
+        '''
+        self.step_async(actions)
+        return self.step_wait()
+
+    def step_async(self, actions):
+        self.actions = actions
+
+    def step_wait(self):
+        states, rewards, dones, infos = [], [], [], []
+        for env, action in zip(self.envs, self.actions):
+            state, reward, done, info = env.step(action)
+            if done:
+                info = dict(info, terminal_state=state)
+                state = env.reset()
+
+            states.append(state)
+            rewards.append(reward)
+            dones.append(done)
+            infos.append(info)
+
+        return np.array(states), np.array(rewards), np.array(dones), infos
+
+    def render(self):
+        self.envs[0].render()
+
+    def close(self):
+        for env in self.envs:
+            env.close()
+
+    def get_total_steps(self):
+        return sum(env.get_total_steps() for env in self.monitored_envs)
+
+    def get_number_episodes(self):
+        return sum(env.episode_id for env in self.monitored_envs)
+
+    def get_episode_rewards(self):
+        return [
+            reward for env in self.monitored_envs for reward in env.get_episode_rewards()
+        ]
+
+
+class SubprocVecEnv:
+    '''
+    Same interface as VecEnv, but each env runs on its own process.
+    The workers write the states directly into a shared memory array,
+    actions, rewards and dones are sent through pipes.
+
+    An env that finishes an episode is reseted by the worker right away,
+    so the reset runs in the background (together with the other workers).
+    Use step_async and step_wait to do other work while the envs are stepping.
+
+    Args:
+        env_fns: List of functions returning (monitored_env, env), called
+                 on the worker processes
+        state_shape: Shape of the states returned by the envs
+        state_dtype: np.uint8 or np.float32, type of the shared memory array
+        start_method: Multiprocessing start method, the default ('fork') does not
+                      require <env_fns> to be picklable
+    '''
+
+    def __init__(self, env_fns, state_shape, state_dtype=np.float32,
+                 start_method='fork'):
+        self.num_envs = len(env_fns)
+        self.waiting = False
+        ctx = mp.get_context(start_method)
+
+        # Allocate shared memory for the states of all envs
+        state_dtype = np.dtype(state_dtype)
+        typecode = {np.dtype(np.uint8): 'B', np.dtype(np.float32): 'f'}[state_dtype]
+        shape = (self.num_envs, ) + tuple(state_shape)
+        self.states_buffer = ctx.RawArray(typecode, int(np.prod(shape)))
+        self.states = np.frombuffer(self.states_buffer, dtype=state_dtype).reshape(shape)
+
+        self.remotes, work_remotes = zip(*[ctx.Pipe() for _ in range(self.num_envs)])
+        self.processes = [
+            ctx.Process(
+                target=_worker,
+                args=(work_remote, remote, env_fn, self.states_buffer, shape, state_dtype,
+                      i_env),
+                daemon=True)
+            for i_env, (work_remote, remote, env_fn) in enumerate(
+                zip(work_remotes, self.remotes, env_fns))
+        ]
+        # Monitor stats of each env, updated on every step
+        self.total_steps = np.zeros(self.num_envs, dtype=np.int64)
+        self.episode_ids = np.zeros(self.num_envs, dtype=np.int64)
+        for process in self.processes:
+            process.start()
+        for work_remote in work_remotes:
+            work_remote.close()
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(('reset', None))
+        for i_env, remote in enumerate(self.remotes):
+            self.total_steps[i_env], self.episode_ids[i_env] = remote.recv()
+
+        return self.states.copy()
+
+    def step(self, actions):
+        ''' See VecEnv.step '''
+        self.step_async(actions)
+        return self.step_wait()
+
+    def step_async(self, actions):
+        for remote, action in zip(self.remotes, actions):
+            remote.send(('step', action))
+        self.waiting = True
+
+    def step_wait(self):
+        rewards, dones, infos, total_steps, episode_ids = zip(
+            *[remote.recv() for remote in self.remotes])
+        self.total_steps[:] = total_steps
+        self.episode_ids[:] = episode_ids
+        self.waiting = False
+        # The workers will overwrite the shared states on the next step
+        return self.states.copy(), np.array(rewards), np.array(dones), list(infos)
+
+    def render(self):
+        self.remotes[0].send(('render', None))
+        self.remotes[0].recv()
+
+    def close(self):
+        if self.waiting:
+            self.step_wait()
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for process in self.processes:
+            process.join()
+
+    def get_total_steps(self):
+        return int(np.sum(self.total_steps))
+
+    def get_number_episodes(self):
+        return int(np.sum(self.episode_ids))
+
+    def get_episode_rewards(self):
+        for remote in self.remotes:
+            remote.send(('episode_rewards', None))
+        return [reward for remote in self.remotes for reward in remote.recv()]
+
+
+def _worker(remote, parent_remote, env_fn, states_buffer, shape, state_dtype, i_env):
+    parent_remote.close()
+    states = np.frombuffer(states_buffer, dtype=state_dtype).reshape(shape)
+    monitored_env, env = env_fn()
+
+    while True:
+        cmd, data = remote.recv()
+        if cmd == 'step':
+            state, reward, done, info = env.step(data)
+            if done:
+                # Reset right away, the next episode is ready before it's needed
+                info = dict(info, terminal_state=state)
+                state = env.reset()
+            states[i_env] = np.reshape(state, shape[1:])
+            remote.send((reward, done, info, monitored_env.get_total_steps(),
+                         monitored_env.episode_id))
+        elif cmd == 'reset':
+            states[i_env] = np.reshape(env.reset(), shape[1:])
+            remote.send((monitored_env.get_total_steps(), monitored_env.episode_id))
+        elif cmd == 'render':
+            env.render()
+            remote.send(None)
+        elif cmd == 'episode_rewards':
+            remote.send(monitored_env.get_episode_rewards())
+        elif cmd == 'close':
+            env.close()
+            remote.close()
+            break
+        else:
+            raise NotImplementedError('Unknown command {}'.format(cmd))
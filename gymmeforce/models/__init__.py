@@ -1,4 +1,23 @@
-from gymmeforce.models.base_model import BaseModel
-from gymmeforce.models.dqn_model import DQNModel
-from gymmeforce.models.vanilla_pg_model import VanillaPGModel
-from gymmeforce.models.ppo_model import PPOModel
+import importlib
+
+# The models are only imported when first accessed (PEP 562)
+_MODEL_MODULES = {
+    'BaseModel': 'gymmeforce.models.base_model',
+    'DQNModel': 'gymmeforce.models.dqn_model',
+    'VanillaPGModel': 'gymmeforce.models.vanilla_pg_model',
+    'PPOModel': 'gymmeforce.models.ppo_model',
+}
+
+__all__ = list(_MODEL_MODULES)
+
+
+def __getattr__(name):
+    if name not in _MODEL_MODULES:
+        raise AttributeError('module {} has no attribute {}'.format(__name__, name))
+    value = getattr(importlib.import_module(_MODEL_MODULES[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -6,14 +6,34 @@ from gymmeforce.models.q_graphs import deepmind_graph, simple_graph
 
 
 class BaseModel:
-    def __init__(self, env_config, grad_clip_norm=None, log_dir='logs/examples',
+    '''
+    Args:
+        histogram_freq: The histograms are only written on every <histogram_freq>
+                        summary writes (default 1, 0 never writes them)
+        summary_flush_secs: Seconds between each flush of the summaries to disk,
+                            done by the writer on a background thread (default 120)
+    '''
+
+    def __init__(self,
+                 env_config,
+                 grad_clip_norm=None,
+                 log_dir='logs/examples',
+                 histogram_freq=1,
+                 summary_flush_secs=120,
                  **kwargs):
         self.env_config = env_config
         self.grad_clip_norm = grad_clip_norm
         self.log_dir = log_dir
+        self.histogram_freq = histogram_freq
+        self.summary_flush_secs = summary_flush_secs
         self.placeholders = {}
         self.training_op = None
-        self.merged = None
+        self.merged_scalars = None
+        self.merged_histograms = None
+        self.log_tensors = None
+        self.num_summaries = 0
+        # Values fetched together with the last summaries, see _write_summaries
+        self.summary_logs = None
         self._saver = None
         self._writer = None
         self.callbacks = []
@@ -34,7 +54,14 @@ class BaseModel:
         if self._writer is None:
             print('Writing logs to: {}'.format(self.log_dir))
             self._writer = tf.summary.FileWriter(
-                self.log_dir, graph=tf.get_default_graph())
+                self.log_dir,
+                graph=tf.get_default_graph(),
+                flush_secs=self.summary_flush_secs)
+
+    def get_summary_writer(self):
+        ''' The FileWriter of the model summaries (created on the first call) '''
+        self._maybe_create_writer()
+        return self._writer
 
     def _maybe_create_saver(self):
         if self._saver is None:
@@ -65,13 +92,65 @@ class BaseModel:
             name = '/'.join(['losses'] + tensor.name.split('/')[:-1])
             tf.summary.scalar(name, tensor)
 
-    def _write_summaries(self, sess, feed_dict):
-        if self.merged is None:
-            self._create_summaries_op()
-            self.merged = tf.summary.merge_all()
+    def _create_log_tensors(self):
+        '''
+        Scalars fetched together with the summaries and added to the logger,
+        returns a dict mapping the log name to (tensor, precision)
+        '''
+        return {}
+
+    def _maybe_create_summaries(self):
+        if self.merged_scalars is not None:
+            return
+        self._create_summaries_op()
+        # Histograms are merged apart, so they can be fetched less often
+        summaries = tf.get_collection(tf.GraphKeys.SUMMARIES)
+        histograms = [s for s in summaries if s.op.type == 'HistogramSummary']
+        scalars = [s for s in summaries if s.op.type != 'HistogramSummary']
+        self.merged_scalars = tf.summary.merge(scalars)
+        if len(histograms) > 0:
+            self.merged_histograms = tf.summary.merge(histograms)
+        self.log_tensors = self._create_log_tensors()
+
+    def _summary_fetches(self):
+        '''
+        Returns the fetches for the next summary write, to be run together with a
+        training step (see _add_summaries)
+        '''
+        self._maybe_create_summaries()
+        self.num_summaries += 1
+        fetches = {
+            'scalars': self.merged_scalars,
+            'global_step': self.global_step_sy,
+            'logs': {name: tensor
+                     for name, (tensor, _) in self.log_tensors.items()}
+        }
+        if (self.merged_histograms is not None and self.histogram_freq > 0
+                and self.num_summaries % self.histogram_freq == 0):
+            fetches['histograms'] = self.merged_histograms
+
+        return fetches
+
+    def _add_summaries(self, results):
+        ''' <results> are the values of the fetches returned by _summary_fetches '''
+        # The writer only queues the events, they are written on its own thread
+        self._writer.add_summary(results['scalars'], results['global_step'])
+        if 'histograms' in results:
+            self._writer.add_summary(results['histograms'], results['global_step'])
+        self.summary_logs = results['logs']
+
+    def _write_summaries(self, sess, feed_dict, logger=None):
+        '''
+        Writes the summaries fetched on the last training step, only runs
+        the summaries if they were not fetched since the last call
+        '''
+        if self.summary_logs is None:
+            self._add_summaries(sess.run(self._summary_fetches(), feed_dict=feed_dict))
 
-        summary = sess.run(self.merged, feed_dict=feed_dict)
-        self._writer.add_summary(summary, self.get_global_step(sess))
+        if logger is not None:
+            for name, value in self.summary_logs.items():
+                logger.add_log(name, value, precision=self.log_tensors[name][1])
+        self.summary_logs = None
 
     def _fetch_placeholders_data_dict(self, batch):
         '''
@@ -1,12 +1,22 @@
 import numpy as np
 import tensorflow as tf
 
+from gymmeforce.common.tf_replay_buffer import TFReplayBuffer
 from gymmeforce.common.utils import tf_copy_params_op
 from gymmeforce.models.base_model import BaseModel
 from gymmeforce.models.q_graphs import deepmind_graph, simple_graph
 
 
 class DQNModel(BaseModel):
+    '''
+    Args:
+        graph_replay_buffer: Store the replay buffer on the graph (see TFReplayBuffer),
+                             the batch placeholders default to batches sampled
+                             in-graph and only scalars are fed on each training step
+        replay_chunk_size: Number of transitions uploaded at once to the graph
+                           replay buffer
+    '''
+
     def __init__(self,
                  env_config,
                  graph=None,
@@ -15,6 +25,8 @@ class DQNModel(BaseModel):
                  gamma=0.99,
                  target_soft_update=1.,
                  grad_clip_norm=10,
+                 graph_replay_buffer=False,
+                 replay_chunk_size=256,
                  **kwargs):
         super().__init__(env_config, grad_clip_norm=grad_clip_norm, **kwargs)
         self.double = double
@@ -35,12 +47,21 @@ class DQNModel(BaseModel):
             print('Using custom graph')
 
         self._set_placeholders_config()
-        self._create_placeholders(self.placeholders_config)
+        self.replay_buffer = None
+        if graph_replay_buffer:
+            self._create_replay_placeholders(self.placeholders_config,
+                                             replay_chunk_size)
+        else:
+            self._create_placeholders(self.placeholders_config)
+        # Importance sampling weights, only fed when using prioritized replay
+        self.placeholders['weights'] = tf.placeholder_with_default(
+            tf.ones_like(self.placeholders['rewards']), shape=[None], name='weights')
 
         self._create_graphs()
 
         self._build_optimization()
         self._build_target_update_op()
+        self._build_set_weights_op()
 
         # Create collections for loading later
         tf.add_to_collection('state_input', self.placeholders['states_t'])
@@ -55,10 +76,32 @@ class DQNModel(BaseModel):
             'actions': [[None], tf.int32],
             'rewards': [[None], tf.float32],
             'dones': [[None], tf.float32],
-            'n_step': [[], tf.float32],
+            'n_step': [[None], tf.float32],
             'learning_rate': [[], tf.float32]
         }
 
+    def _create_replay_placeholders(self, config, chunk_size):
+        '''
+        The placeholders of the sampled data default to a batch sampled from the
+        graph replay buffer, feeding them works as usual (e.g. when predicting)
+        '''
+        # The last dimension of the states is the history
+        state_shape = self.env_config['state_shape']
+        self.replay_buffer = TFReplayBuffer(
+            state_shape[:-1],
+            self.env_config['input_type'].as_numpy_dtype,
+            history_length=state_shape[-1],
+            chunk_size=chunk_size)
+
+        for name, (shape, dtype) in config.items():
+            if name in self.replay_buffer.sample_tensors:
+                self.placeholders[name] = tf.placeholder_with_default(
+                    tf.cast(self.replay_buffer.sample_tensors[name], dtype), shape, name)
+            else:
+                self.placeholders[name] = tf.placeholder(dtype, shape, name)
+        self.placeholders['randomize_n_step'] = \
+            self.replay_buffer.sample_phs['randomize_n_step']
+
     def _create_graphs(self):
         if tf.uint8 == self.env_config['input_type']:
             # Convert to float on GPU
@@ -96,7 +139,9 @@ class DQNModel(BaseModel):
 
         td_target = (self.placeholders['rewards'] + (1 - self.placeholders['dones']) *
                      (self.gamma**self.placeholders['n_step']) * q_tp1)
-        tf.losses.huber_loss(labels=td_target, predictions=q_t)
+        self.td_error = td_target - q_t
+        tf.losses.huber_loss(
+            labels=td_target, predictions=q_t, weights=self.placeholders['weights'])
 
         # Create training operation
         opt_config = dict(epsilon=1e-4)
@@ -110,6 +155,17 @@ class DQNModel(BaseModel):
         self.update_target_op = tf_copy_params_op('online', 'target',
                                                   self.target_soft_update)
 
+    def _build_set_weights_op(self):
+        self.online_vars = tf.get_collection(
+            tf.GraphKeys.GLOBAL_VARIABLES, scope='online')
+        self.weights_placeholders = [
+            tf.placeholder(var.dtype.base_dtype, var.shape) for var in self.online_vars
+        ]
+        self.set_weights_op = tf.group(*[
+            tf.assign(var, ph)
+            for var, ph in zip(self.online_vars, self.weights_placeholders)
+        ])
+
     def _create_summaries_op(self):
         super()._create_summaries_op()
         tf.summary.scalar('network/Q_mean', tf.reduce_mean(self.q_online_t))
@@ -128,13 +184,50 @@ class DQNModel(BaseModel):
                 self.placeholders['states_tp1']: states
             })
 
+    def get_weights(self, sess):
+        ''' Returns a list with the values of the online network variables '''
+        return sess.run(self.online_vars)
+
+    def set_weights(self, sess, weights):
+        ''' Sets the online network variables (<weights> as returned by get_weights) '''
+        sess.run(
+            self.set_weights_op,
+            feed_dict={ph: value
+                       for ph, value in zip(self.weights_placeholders, weights)})
+
     def update_target_net(self, sess):
         sess.run(self.update_target_op)
 
-    def fit(self, sess, batch, learning_rate):
+    def fit(self, sess, batch, learning_rate, write_summaries=False, num_steps=1):
+        '''
+        Returns the td error of each sample (calculated before the last update)
+
+        Args:
+            batch: Dict with the mini-batch, when using the graph replay buffer
+                   only the sampling options (e.g. randomize_n_step)
+            write_summaries: Fetch the summaries together with the last training
+                             step, they are written by the next write_logs
+            num_steps: Number of training steps, each one with a new batch sampled
+                       in-graph (only with the graph replay buffer). Each step is
+                       still a session run (without any feed), a tf.while_loop
+                       would need the optimizer and the sampling built inside it
+        '''
+        assert num_steps == 1 or self.replay_buffer is not None, \
+            'Multiple steps need the graph replay buffer'
         batch['learning_rate'] = learning_rate
         self._fetch_placeholders_data_dict(batch)
-        sess.run(self.training_op, feed_dict=self.placeholders_and_data)
+        for _ in range(num_steps - 1):
+            # Only scalars are fed
+            sess.run(self.training_op, feed_dict=self.placeholders_and_data)
+
+        fetches = [self.training_op, self.td_error]
+        if write_summaries:
+            fetches.append(self._summary_fetches())
+        results = sess.run(fetches, feed_dict=self.placeholders_and_data)
+        if write_summaries:
+            self._add_summaries(results[2])
+
+        return results[1]
 
     def write_logs(self, sess, logger=None):
-        self._write_summaries(sess, self.placeholders_and_data)
+        self._write_summaries(sess, self.placeholders_and_data, logger)
@@ -124,19 +124,19 @@ class PPOModel(VanillaPGModel):
     def _create_summaries_op(self):
         super()._create_summaries_op()
 
-    def write_logs(self, sess, logger):
-        entropy, kl = sess.run(
-            [self.policy.entropy_sy, self.kl_divergence_sy],
-            feed_dict=self.placeholders_and_data)
-        logger.add_log('policy/Entropy', entropy)
-        logger.add_log('policy/KL Divergence', np.mean(kl), precision=4)
+    def _create_log_tensors(self):
+        log_tensors = super()._create_log_tensors()
+        log_tensors['policy/KL Divergence'] = (tf.reduce_mean(self.kl_divergence_sy), 4)
         if self.ppo_adaptive_kl:
-            logger.add_log('policy/KL Coefficient', sess.run(self.kl_coef))
+            log_tensors['policy/KL Coefficient'] = (tf.identity(self.kl_coef), 2)
 
-        self._write_summaries(sess, self.placeholders_and_data)
+        return log_tensors
 
-    def fit(self, sess, *args, **kwargs):
+    def fit(self, sess, *args, write_summaries=False, **kwargs):
         self._update_old_policy(sess)
         super().fit(sess, *args, **kwargs)
         if self.ppo_adaptive_kl:
             self._update_kl_coef(sess)
+        # The KL of the whole rollout after fitting (and the updated coefficient)
+        if write_summaries:
+            self._summarize_rollout(sess)
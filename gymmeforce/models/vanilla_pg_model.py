@@ -1,7 +1,7 @@
 import numpy as np
 import tensorflow as tf
 
-from gymmeforce.common.data_gen import DataGenerator
+from gymmeforce.common.data_gen import DataGenerator, minibatch_slices
 from gymmeforce.common.policy import Policy
 from gymmeforce.models.base_model import BaseModel
 from gymmeforce.models.policy_graphs import dense_policy_graph
@@ -9,26 +9,45 @@ from gymmeforce.models.value_graphs import dense_value_graph
 
 
 class VanillaPGModel(BaseModel):
+    '''
+    Args:
+        graph_rollout: Upload the rollout to the graph once per fit, the mini-batches
+                       are sliced in-graph and only scalars are fed on each training
+                       step (see _create_rollout_placeholders). The epoch loop
+                       still runs in python, one sess.run per mini-batch
+    '''
+
     def __init__(self,
                  env_config,
                  use_baseline=True,
                  entropy_coef=0.0,
                  policy_graph=None,
                  value_graph=None,
+                 graph_rollout=False,
                  **kwargs):
         super(VanillaPGModel, self).__init__(env_config, **kwargs)
         self.use_baseline = use_baseline
         self.entropy_coef = entropy_coef
         self.policy_graph = policy_graph or dense_policy_graph
         self.value_graph = value_graph or dense_value_graph
+        self.graph_rollout = graph_rollout
 
         self._set_placeholders_config()
-        self._create_placeholders(self.placeholders_config)
+        if self.graph_rollout:
+            self._create_rollout_placeholders(self.placeholders_config)
+        else:
+            self._create_placeholders(self.placeholders_config)
         self._create_policy()
 
         if self.use_baseline:
             self.baseline_sy = self._create_baseline()
 
+        # Create collections for loading later
+        tf.add_to_collection('state_input', self.placeholders['states'])
+        tf.add_to_collection('sample_action', self.policy.sample_action_sy)
+        if self.use_baseline:
+            tf.add_to_collection('baseline', self.baseline_sy)
+
         self._add_losses()
         self._create_training_op(self.placeholders['learning_rate'], opt_config=dict())
 
@@ -49,6 +68,70 @@ class VanillaPGModel(BaseModel):
             self.placeholders_config['actions'] = [[None, self.env_config['num_actions']],
                                                    tf.float32]
 
+    def _create_rollout_placeholders(self, config):
+        '''
+        The per-sample data (e.g. states) is stored on local variables and the
+        placeholders default to a mini-batch gathered from them, defined by a
+        permutation of the samples (shuffled each epoch), a start and a size.
+        By default the mini-batch is the entire rollout.
+        Feeding the placeholders works as usual (e.g. when selecting actions).
+        '''
+        local = [tf.GraphKeys.LOCAL_VARIABLES]
+        self.rollout_vars = {}
+        self.rollout_upload_phs = {}
+        self.rollout_upload_ops = {}
+        with tf.variable_scope('rollout'):
+            for name, (shape, dtype) in config.items():
+                # Scalars are still fed
+                if len(shape) == 0:
+                    self.placeholders[name] = tf.placeholder(dtype, shape, name)
+                    continue
+                upload_ph = tf.placeholder(dtype, shape, name + '_upload')
+                var = tf.Variable(
+                    tf.zeros([0] + shape[1:], dtype),
+                    trainable=False,
+                    validate_shape=False,
+                    collections=local,
+                    name=name)
+                self.rollout_vars[name] = var
+                self.rollout_upload_phs[name] = upload_ph
+                self.rollout_upload_ops[name] = tf.assign(
+                    var, upload_ph, validate_shape=False)
+
+            perm = tf.Variable(
+                tf.zeros([0], tf.int32),
+                trainable=False,
+                validate_shape=False,
+                collections=local,
+                name='permutation')
+            num_samples = tf.shape(self.rollout_upload_phs['states'])[0]
+            self.reset_rollout_perm_op = tf.assign(
+                perm, tf.range(num_samples), validate_shape=False)
+            self.shuffle_rollout_op = tf.assign(
+                perm, tf.random_shuffle(perm), validate_shape=False)
+            self.rollout_start_ph = tf.placeholder_with_default(0, [], 'start')
+            self.rollout_size_ph = tf.placeholder_with_default(
+                tf.shape(perm)[0], [], 'size')
+            batch_idxs = tf.slice(perm, [self.rollout_start_ph], [self.rollout_size_ph])
+
+        for name, var in self.rollout_vars.items():
+            self.placeholders[name] = tf.placeholder_with_default(
+                tf.gather(var, batch_idxs), config[name][0], name)
+
+    def _upload_rollout(self, sess, batch):
+        ''' Stores the batch on the graph, only the scalars need to be fed after this '''
+        names = [name for name in self.rollout_upload_ops if name in batch]
+        upload_ops = [self.rollout_upload_ops[name] for name in names]
+        sess.run(
+            upload_ops + [self.reset_rollout_perm_op],
+            feed_dict={self.rollout_upload_phs[name]: batch[name]
+                       for name in names})
+        self.placeholders_and_data = {
+            self.placeholders[key]: value
+            for key, value in batch.items()
+            if key in self.placeholders and key not in self.rollout_vars
+        }
+
     def _add_losses(self):
         ''' Modify this method to add new losses e.g. KL penalty '''
         self._pg_loss()
@@ -113,26 +196,96 @@ class VanillaPGModel(BaseModel):
             tf.summary.scalar('policy/means/mean', tf.reduce_mean(means))
             tf.summary.scalar('policy/standard_devs/mean', tf.reduce_mean(stds))
 
-    def write_logs(self, sess, logger):
-        entropy = sess.run(self.policy.entropy_sy, feed_dict=self.placeholders_and_data)
-        logger.add_log('policy/Entropy', entropy)
+    def _create_log_tensors(self):
+        return {'policy/Entropy': (tf.reduce_mean(self.policy.entropy_sy), 2)}
 
-        self._write_summaries(sess, self.placeholders_and_data)
+    def write_logs(self, sess, logger):
+        self._write_summaries(sess, self.placeholders_and_data, logger)
 
     def select_action(self, sess, state):
         return self.policy.sample_action(sess, state[np.newaxis])
 
-    def compute_baseline(self, sess, states):
-        return sess.run(self.baseline_sy, feed_dict={self.placeholders['states']: states})
+    def select_actions(self, sess, states):
+        return self.policy.sample_action(sess, states)
 
-    def fit(self, sess, batch, learning_rate, num_epochs=10, batch_size=64, **kwargs):
+    def compute_baseline(self, sess, states, batch_size=None):
+        '''
+        Args:
+            batch_size: Maximum number of states evaluated by each sess.run,
+                        bounds the memory used (default None, all at once)
+        '''
+        if batch_size is None:
+            batch_size = len(states)
+        return np.concatenate([
+            sess.run(
+                self.baseline_sy,
+                feed_dict={self.placeholders['states']: states[start:start + batch_size]})
+            for start in range(0, len(states), batch_size)
+        ])
+
+    def fit(self,
+            sess,
+            batch,
+            learning_rate,
+            num_epochs=10,
+            batch_size=64,
+            keep_remainder=False,
+            write_summaries=False,
+            **kwargs):
+        '''
+        Args:
+            keep_remainder: Also train on the samples left after splitting
+                            the batch into mini-batches (default False)
+            write_summaries: Compute the summaries (and the logged values, e.g. the
+                             entropy) over the whole rollout after fitting, with a
+                             single run, they are written by the next write_logs
+        '''
+        if self.graph_rollout:
+            self._fit_graph_rollout(sess, batch, learning_rate, num_epochs, batch_size,
+                                    keep_remainder)
+        else:
+            self._fit_mini_batches(sess, batch, learning_rate, num_epochs, batch_size,
+                                   keep_remainder)
+        if write_summaries:
+            self._summarize_rollout(sess)
+
+    def _summarize_rollout(self, sess):
+        '''
+        Computes the summaries over the whole rollout, in graph_rollout mode
+        the rollout is already on the graph and only scalars are fed
+        '''
+        self._add_summaries(
+            sess.run(self._summary_fetches(), feed_dict=self.placeholders_and_data))
+
+    def _fit_mini_batches(self, sess, batch, learning_rate, num_epochs, batch_size,
+                          keep_remainder):
         self._fetch_placeholders_data_dict(batch)
-        data = DataGenerator(self.placeholders_and_data)
+        # The learning rate is fed together with the other scalars
+        data_dict = dict(self.placeholders_and_data)
+        data_dict[self.placeholders['learning_rate']] = learning_rate
+        data = DataGenerator(data_dict)
+
+        for i_epoch in range(num_epochs):
+            for feed_dict in data.fetch_batch_dict(batch_size, keep_remainder):
+                sess.run(self.training_op, feed_dict=feed_dict)
+
+            for callback in self.callbacks:
+                if callback(sess):
+                    return
+
+    def _fit_graph_rollout(self, sess, batch, learning_rate, num_epochs, batch_size,
+                           keep_remainder):
+        self._upload_rollout(sess, batch)
+        slices = minibatch_slices(len(batch['states']), batch_size, keep_remainder)
 
+        feed_dict = dict(self.placeholders_and_data)
+        feed_dict[self.placeholders['learning_rate']] = learning_rate
         for i_epoch in range(num_epochs):
-            for feed_dict in data.fetch_batch_dict(batch_size):
-                feed_dict[self.placeholders['learning_rate']] = learning_rate
-                sess.run([self.training_op], feed_dict=feed_dict)
+            sess.run(self.shuffle_rollout_op)
+            for start, size in slices:
+                feed_dict[self.rollout_start_ph] = start
+                feed_dict[self.rollout_size_ph] = size
+                sess.run(self.training_op, feed_dict=feed_dict)
 
             for callback in self.callbacks:
                 if callback(sess):
@@ -1 +1,20 @@
-from gymmeforce.wrappers.atari_wrapper import AtariWrapper
+import importlib
+
+# Only imported when first accessed (PEP 562), the wrappers import gym
+_WRAPPER_MODULES = {
+    'AtariWrapper': 'gymmeforce.wrappers.atari_wrapper',
+}
+
+__all__ = list(_WRAPPER_MODULES)
+
+
+def __getattr__(name):
+    if name not in _WRAPPER_MODULES:
+        raise AttributeError('module {} has no attribute {}'.format(__name__, name))
+    value = getattr(importlib.import_module(_WRAPPER_MODULES[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
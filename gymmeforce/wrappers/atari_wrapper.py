@@ -5,18 +5,39 @@ https://github.com/openai/baselines/blob/master/baselines/common/atari_wrappers.
 import numpy as np
 import gym
 from gym import spaces
-import cv2
 
 
 class AtariWrapper:
-    def __init__(self, frame_skip=4, noop_max=30):
+    '''
+    Args:
+        fused: Use FusedPreprocessEnv instead of MaxAndSkipEnv, WarpFrame and
+               ClipRewardEnv, same frames but without allocating on every step
+               (default True)
+    '''
+
+    def __init__(self, frame_skip=4, noop_max=30, fused=True):
         self.frame_skip = frame_skip
         self.noop_max = noop_max
+        self.fused = fused
+
+    def get_config(self):
+        ''' The arguments that change the wrapped env, used as its cache key '''
+        return {
+            'frame_skip': self.frame_skip,
+            'noop_max': self.noop_max,
+            'fused': self.fused
+        }
 
     def wrap_env(self, env):
         assert 'NoFrameskip' in env.spec.id
         env = EpisodicLifeEnv(env)
         env = NoopResetEnv(env, noop_max=self.noop_max)
+        if self.fused:
+            env = FusedPreprocessEnv(env, skip=self.frame_skip)
+            if 'FIRE' in env.unwrapped.get_action_meanings():
+                env = FireResetEnv(env)
+            return env
+
         env = MaxAndSkipEnv(env, skip=self.frame_skip)
         if 'FIRE' in env.unwrapped.get_action_meanings():
             env = FireResetEnv(env)
@@ -133,6 +154,66 @@ class MaxAndSkipEnv(gym.Wrapper):
         return max_frame, total_reward, done, info
 
 
+class FusedPreprocessEnv(gym.Wrapper):
+    def __init__(self, env, skip=4, width=84, height=84):
+        """
+        Same as MaxAndSkipEnv, WarpFrame and ClipRewardEnv (in this order), with
+        every intermediate frame written on buffers allocated only once.
+
+        The frames are max pooled before the grayscale conversion (like the
+        original chain), so the output is identical to it. The returned frames
+        alternate between two buffers, each frame is only valid until the
+        second step after it (enough for keeping the state and next state).
+        The terminal frame is returned as a copy, resetting warps more frames
+        (e.g. FireResetEnv) while the terminal frame is still in use.
+        """
+        gym.Wrapper.__init__(self, env)
+        self._skip = skip
+        self.width = width
+        self.height = height
+        shape = env.observation_space.shape
+        self._obs_buffer = np.zeros((2, ) + shape, dtype=np.uint8)
+        self._max_frame = np.zeros(shape, dtype=np.uint8)
+        self._gray_frame = np.zeros(shape[:2], dtype=np.uint8)
+        self._out_frames = np.zeros((2, height, width), dtype=np.uint8)
+        self._i_out = 0
+        self.observation_space = spaces.Box(low=0, high=255, shape=(height, width, 1))
+
+    def _warp(self, frame):
+        # Deferred, importing cv2 is slow
+        import cv2
+        self._i_out = 1 - self._i_out
+        out = self._out_frames[self._i_out]
+        cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY, dst=self._gray_frame)
+        cv2.resize(
+            self._gray_frame, (self.width, self.height),
+            dst=out,
+            interpolation=cv2.INTER_AREA)
+        return out[:, :, None]
+
+    def _step(self, action):
+        total_reward = 0.0
+        done = None
+        for i in range(self._skip):
+            obs, reward, done, info = self.env.step(action)
+            if i == self._skip - 2: self._obs_buffer[0] = obs
+            if i == self._skip - 1: self._obs_buffer[1] = obs
+            total_reward += reward
+            if done:
+                break
+        np.maximum(self._obs_buffer[0], self._obs_buffer[1], out=self._max_frame)
+
+        # Same as np.sign, without creating an array
+        clipped_reward = float((total_reward > 0) - (total_reward < 0))
+        frame = self._warp(self._max_frame)
+        if done:
+            frame = frame.copy()
+        return frame, clipped_reward, done, info
+
+    def _reset(self, **kwargs):
+        return self._warp(self.env.reset(**kwargs))
+
+
 class ClipRewardEnv(gym.RewardWrapper):
     def _reward(self, reward):
         """Bin reward to {+1, 0, -1} by its sign."""
@@ -149,6 +230,8 @@ class WarpFrame(gym.ObservationWrapper):
             low=0, high=255, shape=(self.height, self.width, 1))
 
     def _observation(self, frame):
+        # Deferred, importing cv2 is slow
+        import cv2
         frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
         frame = cv2.resize(frame, (self.width, self.height), interpolation=cv2.INTER_AREA)
         return frame[:, :, None]
@@ -0,0 +1,2 @@
+# Script using an old interface (see its TODO), runs training on import
+collect_ignore = ['test_model_updates.py']
@@ -0,0 +1,59 @@
+import queue
+
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+
+from gymmeforce.agents.apex_agent import (  # noqa: E402
+    ApeXAgent, _set_newest_weights, actor_exploration_rates)
+
+
+class FakeModel:
+    def __init__(self, weights):
+        self.weights = weights
+
+    def get_weights(self, sess):
+        return self.weights
+
+    def set_weights(self, sess, weights):
+        self.weights = weights
+
+
+class FakeAgent:
+    def __init__(self, model):
+        self.model = model
+        self.sess = None
+
+
+def create_learner(num_actors):
+    ''' Only the parts of the learner used for broadcasting the weights '''
+    learner = ApeXAgent.__new__(ApeXAgent)
+    learner.sess = None
+    learner.model = FakeModel([np.zeros(2)])
+    learner.actors = []
+    learner.weights_queues = [queue.Queue(maxsize=1) for _ in range(num_actors)]
+    return learner
+
+
+def test_actors_receive_newest_weights():
+    learner = create_learner(num_actors=2)
+    actors = [FakeAgent(FakeModel(None)) for _ in range(2)]
+    learner._broadcast_weights()
+    # Not received yet, replaced by the newest weights
+    learner.model.weights = [np.ones(2)]
+    learner._broadcast_weights()
+
+    for actor, weights_queue in zip(actors, learner.weights_queues):
+        _set_newest_weights(actor, weights_queue)
+        np.testing.assert_array_equal(actor.model.weights, [np.ones(2)])
+        # Keeps the weights when nothing new was sent
+        _set_newest_weights(actor, weights_queue)
+        np.testing.assert_array_equal(actor.model.weights, [np.ones(2)])
+
+
+def test_actor_exploration_rates():
+    epsilons = actor_exploration_rates(8, 0.4, 7)
+    np.testing.assert_allclose(epsilons[[0, -1]], [0.4, 0.4**8])
+    assert np.all(np.diff(epsilons) < 0)
+    np.testing.assert_allclose(actor_exploration_rates(1, 0.4, 7), [0.4])
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('gym')
+pytest.importorskip('cv2')
+
+from benchmarks.fake_atari_env import FakeAtariEnv  # noqa: E402
+from gymmeforce.wrappers.atari_wrapper import AtariWrapper  # noqa: E402
+
+
+def make_env(fused, seed=0):
+    return AtariWrapper(fused=fused).wrap_env(
+        FakeAtariEnv(episode_length=30, lives=3, seed=seed))
+
+
+def run_episodes(env, num_steps):
+    ''' Returns a copy of every frame and the rewards, resetting on done '''
+    frames = [env.reset().copy()]
+    rewards = []
+    for i_step in range(num_steps):
+        obs, reward, done, _ = env.step(i_step % 4)
+        frames.append(obs.copy())
+        rewards.append(reward)
+        if done:
+            frames.append(env.reset().copy())
+    return frames, rewards
+
+
+def test_fused_matches_wrapper_chain():
+    chain_frames, chain_rewards = run_episodes(make_env(fused=False), 50)
+    fused_frames, fused_rewards = run_episodes(make_env(fused=True), 50)
+
+    assert chain_rewards == fused_rewards
+    assert len(chain_frames) == len(fused_frames)
+    for chain_frame, fused_frame in zip(chain_frames, fused_frames):
+        assert fused_frame.shape == (84, 84, 1)
+        np.testing.assert_array_equal(chain_frame, fused_frame)
+
+
+def test_terminal_frame_survives_reset():
+    env = make_env(fused=True)
+    env.reset()
+    done = False
+    while not done:
+        obs, _, done, _ = env.step(2)
+    terminal_frame = obs.copy()
+
+    # FireResetEnv warps more frames while resetting
+    env.reset()
+    np.testing.assert_array_equal(obs, terminal_frame)
+
+
+def test_frames_valid_until_second_step():
+    env = make_env(fused=True)
+    state = env.reset()
+    for _ in range(5):
+        state_copy = state.copy()
+        next_state, _, done, _ = env.step(2)
+        np.testing.assert_array_equal(state, state_copy)
+        state = env.reset() if done else next_state
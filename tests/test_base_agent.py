@@ -0,0 +1,62 @@
+import pickle
+
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from gymmeforce.agents import base_agent  # noqa: E402
+from gymmeforce.agents.base_agent import BaseAgent  # noqa: E402
+from gymmeforce.wrappers.atari_wrapper import AtariWrapper  # noqa: E402
+
+
+class CountingAgent(BaseAgent):
+    ''' Only the env config part of BaseAgent, counting the envs created '''
+
+    def __init__(self, env_wrapper):
+        self.env_name = 'FakeNoFrameskip-v4'
+        self.env_wrapper = env_wrapper
+        self.env_config = {}
+        self.num_created = 0
+
+    def _create_env_config(self):
+        self.num_created += 1
+        self.env_config.update({
+            'state_shape': (84, 84),
+            'input_type': tf.uint8,
+            'action_space': 'discrete',
+            'num_actions': 4
+        })
+
+
+class UndeclaredWrapper:
+    def __init__(self):
+        self.env = object()
+
+
+def test_env_config_cache_key(monkeypatch, tmpdir):
+    monkeypatch.setattr(base_agent, 'ENV_CONFIG_CACHE_DIR', str(tmpdir))
+    path = CountingAgent(AtariWrapper(frame_skip=4))._env_config_cache_path()
+
+    assert CountingAgent(AtariWrapper(frame_skip=4))._env_config_cache_path() == path
+    assert CountingAgent(AtariWrapper(frame_skip=3))._env_config_cache_path() != path
+    assert CountingAgent(UndeclaredWrapper())._env_config_cache_path() is None
+
+
+def test_unreadable_env_config_cache_is_rebuilt(monkeypatch, tmpdir):
+    monkeypatch.setattr(base_agent, 'ENV_CONFIG_CACHE_DIR', str(tmpdir))
+    agent = CountingAgent(AtariWrapper())
+    path = agent._env_config_cache_path()
+    agent._load_or_create_env_config()
+    assert agent.num_created == 1
+
+    # Refers to a class that no longer exists
+    with open(path, 'wb') as f:
+        f.write(pickle.dumps(UndeclaredWrapper()).replace(b'Undeclared', b'Missing___'))
+    agent = CountingAgent(AtariWrapper())
+    agent._load_or_create_env_config()
+    assert agent.num_created == 1
+
+    agent = CountingAgent(AtariWrapper())
+    agent._load_or_create_env_config()
+    assert agent.num_created == 0
+    assert agent.env_config['input_type'] == tf.uint8
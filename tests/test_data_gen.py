@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+from gymmeforce.common.data_gen import DataGenerator, minibatch_slices
+
+
+@pytest.mark.parametrize('data_size, keep_remainder, sizes', [
+    (12, False, [4, 4, 4]),
+    (12, True, [4, 4, 4]),
+    (14, False, [4, 4, 4]),
+    (14, True, [4, 4, 4, 2]),
+    (4, True, [4]),
+])
+def test_minibatch_slices_cover_permutation_once(data_size, keep_remainder, sizes):
+    idxs = np.random.RandomState(0).permutation(data_size)
+    slices = minibatch_slices(data_size, 4, keep_remainder)
+    assert [size for _, size in slices] == sizes
+
+    # Consecutive slices, so each sample is used at most once
+    sliced = np.concatenate([idxs[start:start + size] for start, size in slices])
+    np.testing.assert_array_equal(sliced, idxs[:sum(sizes)])
+
+
+def test_graph_rollout_minibatches_cover_rollout_once():
+    tf = pytest.importorskip('tensorflow')
+    from gymmeforce.models.vanilla_pg_model import VanillaPGModel
+
+    tf.reset_default_graph()
+    env_config = {
+        'state_shape': (2, ),
+        'input_type': tf.float32,
+        'action_space': 'discrete',
+        'num_actions': 3
+    }
+    model = VanillaPGModel(env_config, graph_rollout=True)
+    states = np.arange(22, dtype=np.float32).reshape(11, 2)
+    batch = {'states': states, 'actions': np.zeros(11, np.int32)}
+
+    with tf.Session() as sess:
+        sess.run(tf.local_variables_initializer())
+        model._upload_rollout(sess, batch)
+        for i_epoch in range(2):
+            sess.run(model.shuffle_rollout_op)
+            minibatches = [
+                sess.run(
+                    model.placeholders['states'],
+                    feed_dict={model.rollout_start_ph: start,
+                               model.rollout_size_ph: size})
+                for start, size in minibatch_slices(11, 4, keep_remainder=True)
+            ]
+            assert [len(minibatch) for minibatch in minibatches] == [4, 4, 3]
+            sampled = np.concatenate(minibatches)
+            np.testing.assert_array_equal(
+                sampled[np.argsort(sampled[:, 0])], states)
+
+
+@pytest.mark.parametrize('keep_remainder', [False, True])
+def test_data_generator_uses_each_sample_once_per_epoch(keep_remainder):
+    states = np.arange(22).reshape(11, 2)
+    data = DataGenerator({'states': states, 'ids': np.arange(11), 'lr': 0.1})
+    np.random.seed(0)
+    for i_epoch in range(3):
+        batches = [{key: np.copy(value) for key, value in batch.items()}
+                   for batch in data.fetch_batch_dict(4, keep_remainder)]
+
+        assert [len(batch['ids']) for batch in batches] == (
+            [4, 4, 3] if keep_remainder else [4, 4])
+        assert all(batch['lr'] == 0.1 for batch in batches)
+        ids = np.concatenate([batch['ids'] for batch in batches])
+        # Samples of each mini-batch are kept together
+        np.testing.assert_array_equal(
+            np.concatenate([batch['states'] for batch in batches]), states[ids])
+        assert len(np.unique(ids)) == len(ids)
+        if keep_remainder:
+            np.testing.assert_array_equal(np.sort(ids), np.arange(11))
@@ -0,0 +1,63 @@
+import threading
+
+import numpy as np
+import pytest
+
+from gymmeforce.common.inference_server import InferenceServer
+
+
+class GatedModel:
+    ''' Doubles the states, each batch waits for <gate> to be set '''
+
+    def __init__(self, log_dir=None):
+        self.log_dir = log_dir
+        self.gate = threading.Event()
+        self.running = threading.Event()
+
+    def predict(self, sess, states):
+        self.running.set()
+        self.gate.wait()
+        return 2 * states
+
+
+def predict_in_thread(server, state, results):
+    def predict():
+        try:
+            results[state] = server.predict(np.array(state))
+        except Exception as e:
+            results[state] = e
+
+    thread = threading.Thread(target=predict, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_close_fails_pending_requests():
+    model = GatedModel()
+    server = InferenceServer(model, sess=object(), max_batch_size=1)
+    results = {}
+    served = predict_in_thread(server, 1, results)
+    model.running.wait(timeout=5)
+    # Waits on the queue while the first batch is running
+    pending = predict_in_thread(server, 2, results)
+    while server.requests.qsize() == 0:
+        pass
+
+    closer = threading.Thread(target=server.close, daemon=True)
+    closer.start()
+    server.stop_event.wait(timeout=5)
+    model.gate.set()
+    for thread in [served, pending, closer]:
+        thread.join(timeout=5)
+        assert not thread.is_alive()
+
+    assert results[1] == 2
+    assert isinstance(results[2], RuntimeError)
+    with pytest.raises(RuntimeError):
+        server.predict(np.array(3))
+
+
+def test_missing_checkpoint_raises(tmpdir):
+    pytest.importorskip('tensorflow')
+    with pytest.raises(FileNotFoundError):
+        InferenceServer(GatedModel(log_dir=str(tmpdir)))
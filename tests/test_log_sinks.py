@@ -0,0 +1,68 @@
+import csv
+import json
+
+from gymmeforce.common.log_sinks import CSVSink, JSONLSink
+from gymmeforce.common.print_utils import Logger
+
+
+def read_csv(path):
+    with open(path, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def test_csv_sink_adds_new_keys(tmpdir):
+    path = str(tmpdir.join('logs.csv'))
+    sink = CSVSink(path)
+    sink.write([(1, {'a': 1.})])
+    sink.write([(2, {'a': 2., 'b': 3.}), (3, {'b': 4.})])
+    sink.close()
+
+    rows = read_csv(path)
+    assert [row['step'] for row in rows] == ['1', '2', '3']
+    assert [row['a'] for row in rows] == ['1.0', '2.0', '']
+    assert [row['b'] for row in rows] == ['', '3.0', '4.0']
+
+
+def test_csv_sink_continues_existing_file(tmpdir):
+    path = str(tmpdir.join('logs.csv'))
+    sink = CSVSink(path)
+    sink.write([(1, {'a': 1.})])
+    sink.close()
+
+    sink = CSVSink(path)
+    sink.write([(2, {'a': 2.})])
+    sink.close()
+
+    rows = read_csv(path)
+    assert [(row['step'], row['a']) for row in rows] == [('1', '1.0'), ('2', '2.0')]
+
+
+def test_logger_writes_mean_with_step_fn(tmpdir):
+    path = str(tmpdir.join('logs.jsonl'))
+    logger = Logger(sinks=[JSONLSink(path)], step_fn=lambda: 42)
+    logger.add_log('loss', 1.)
+    logger.add_log('loss', 3.)
+    logger.log('header')
+    logger.close()
+
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    assert records == [{'loss': 2., 'step': 42}]
+
+
+
+def test_logger_close_closes_trace_file(tmpdir):
+    path = str(tmpdir.join('trace.json'))
+    logger = Logger(profile=True, trace_path=path)
+    with logger.phase('fit'):
+        pass
+    trace_file = logger.phase_timer.trace_file
+    logger.close()
+
+    assert trace_file.closed
+    with open(path) as f:
+        events = json.loads(f.read().rstrip(',\n') + ']')
+    assert [event['name'] for event in events] == ['fit']
+    # Phases after closing are still timed, but not traced
+    with logger.phase('fit'):
+        pass
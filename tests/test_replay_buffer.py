@@ -0,0 +1,244 @@
+import threading
+
+import numpy as np
+import pytest
+
+from gymmeforce.common import utils
+from gymmeforce.common.utils import (BatchPrefetcher, MinTree, PrioritizedReplayBuffer,
+                                     ReplayBuffer, SumTree)
+
+
+def fill_buffer(replay_buffer, num_steps, done_freq=5, seed=0):
+    ''' The state is the slot index plus one (zero is used for the padded frames) '''
+    rng = np.random.RandomState(seed)
+    rewards = rng.randn(num_steps).astype(np.float32)
+    dones = np.arange(num_steps) % done_freq == done_freq - 1
+    for i in range(num_steps):
+        replay_buffer.add(np.array(i + 1.), i % 3, rewards[i], dones[i])
+    return rewards, dones
+
+
+def reference_n_step_return(rewards, dones, gamma):
+    ''' Discounted sum of the rewards until (including) the first done '''
+    ret = 0.
+    for i, (reward, done) in enumerate(zip(rewards, dones)):
+        ret += gamma**i * reward
+        if done:
+            return ret, 1.
+    return ret, 0.
+
+
+def test_n_step_returns_stop_at_done():
+    gamma = 0.9
+    replay_buffer = ReplayBuffer(100, n_step=4, gamma=gamma, batch_size=64)
+    rewards, dones = fill_buffer(replay_buffer, 100, done_freq=3)
+    np.random.seed(0)
+    batch = replay_buffer.sample(randomize_n_step=True)
+
+    idxs = batch['states_t'][:, 0].astype(int) - 1
+    for i, idx in enumerate(idxs):
+        n_step = int(batch['n_step'][i])
+        ret, done = reference_n_step_return(rewards[idx:idx + n_step],
+                                            dones[idx:idx + n_step], gamma)
+        np.testing.assert_allclose(batch['rewards'][i], ret, rtol=1e-5)
+        assert batch['dones'][i] == done
+        assert batch['actions'][i] == idx % 3
+        assert batch['states_tp1'][i, 0] == idx + n_step + 1
+
+
+def test_stacked_frames_zeroed_before_episode_start():
+    history_length = 4
+    replay_buffer = ReplayBuffer(100, history_length=history_length, batch_size=64)
+    _, dones = fill_buffer(replay_buffer, 100, done_freq=5)
+    np.random.seed(0)
+    batch = replay_buffer.sample()
+
+    for states in batch['states_t']:
+        last_idx = int(states[-1]) - 1
+        expected = np.arange(last_idx - history_length + 1, last_idx + 1) + 1.
+        # Frames up to (including) the previous done belong to another episode
+        for i in range(history_length - 2, -1, -1):
+            if dones[int(expected[i]) - 1]:
+                expected[:i + 1] = 0
+                break
+        np.testing.assert_array_equal(states, expected)
+
+
+def test_stack_recent_states_zeroed_before_episode_start():
+    replay_buffer = ReplayBuffer(100, history_length=3)
+    fill_buffer(replay_buffer, 11, done_freq=5)
+    # The last stored state (11) starts a new episode
+    stacked = replay_buffer.stack_recent_states(np.array(12.))
+    np.testing.assert_array_equal(stacked[0], [0., 11., 12.])
+
+
+def test_segment_trees():
+    values = np.random.RandomState(0).random_sample(13)
+    sum_tree = SumTree(13)
+    min_tree = MinTree(13)
+    sum_tree[np.arange(13)] = values
+    min_tree[np.arange(13)] = values
+    sum_tree[2] = 0.
+    min_tree[5] = 0.01
+    values_sum = values.copy()
+    values_sum[2] = 0.
+    values_min = values.copy()
+    values_min[5] = 0.01
+
+    np.testing.assert_allclose(sum_tree.reduce(), values_sum.sum())
+    assert min_tree.reduce() == values_min.min()
+    cumsum = np.cumsum(values_sum)
+    prefixsums = np.linspace(0, cumsum[-1], 50, endpoint=False)
+    np.testing.assert_array_equal(
+        sum_tree.find_prefixsum_idx(prefixsums),
+        np.searchsorted(cumsum, prefixsums, side='right'))
+
+
+def test_prioritized_importance_weights():
+    alpha, beta, epsilon = 0.6, 0.4, 1e-6
+    replay_buffer = PrioritizedReplayBuffer(
+        100, alpha=alpha, epsilon=epsilon, history_length=2, n_step=2, batch_size=32)
+    fill_buffer(replay_buffer, 50)
+    # Only the transitions that end on stored states can be sampled
+    num_valid = 50 - replay_buffer.window
+    td_errors = np.random.RandomState(0).randn(num_valid)
+    replay_buffer.update_priorities(np.arange(num_valid), td_errors)
+    np.random.seed(0)
+    batch = replay_buffer.sample(beta=beta)
+
+    idxs = batch['idxs']
+    assert np.all(idxs < num_valid)
+    np.testing.assert_array_equal(batch['states_t'][:, -1], idxs + 2)
+    priorities = (np.abs(td_errors) + epsilon)**alpha
+    expected = (priorities[idxs] / priorities.min())**(-beta)
+    np.testing.assert_allclose(batch['weights'], expected, rtol=1e-5)
+
+
+def create_failing_prefetcher(num_batches):
+    ''' Prefetcher which sample_fn fails after returning <num_batches> batches '''
+    batches = iter(range(num_batches))
+
+    def sample_fn():
+        return {'value': np.array(next(batches))}
+
+    return BatchPrefetcher(sample_fn, threading.Lock(), depth=1)
+
+
+def test_prefetcher_raises_sampling_errors():
+    prefetcher = create_failing_prefetcher(1)
+    assert prefetcher.get()['value'] == 0
+    with pytest.raises(StopIteration):
+        prefetcher.get()
+    prefetcher.close()
+
+
+def test_prefetcher_closes_with_full_queue_after_error():
+    # The queue is full with the first batch when the error is raised
+    prefetcher = create_failing_prefetcher(1)
+    closer = threading.Thread(target=prefetcher.close, daemon=True)
+    closer.start()
+    closer.join(timeout=5)
+    assert not closer.is_alive()
+    assert not prefetcher.thread.is_alive()
+
+
+def assert_same_buffers(replay_buffer, expected):
+    assert replay_buffer.current_idx == expected.current_idx
+    assert replay_buffer.current_len == expected.current_len
+    idxs = np.arange(expected.current_len)
+    np.testing.assert_array_equal(
+        replay_buffer._read_states(idxs), expected._read_states(idxs))
+    for name in ['actions', 'rewards', 'dones', 'frames_since_done']:
+        np.testing.assert_array_equal(
+            getattr(replay_buffer, name)[idxs], getattr(expected, name)[idxs])
+
+
+def assert_same_samples(replay_buffer, expected, **sample_kwargs):
+    np.random.seed(0)
+    batch = replay_buffer.sample(**sample_kwargs)
+    np.random.seed(0)
+    expected_batch = expected.sample(**sample_kwargs)
+    assert batch.keys() == expected_batch.keys()
+    for key, values in expected_batch.items():
+        np.testing.assert_array_equal(batch[key], values, err_msg=key)
+
+
+@pytest.mark.parametrize('buffer_kwargs', [
+    dict(num_envs=2),
+    dict(storage_dtype='uint8', quantization_warmup=9),
+    dict(compression='zlib'),
+])
+def test_add_sequence_matches_add(buffer_kwargs):
+    num_envs = buffer_kwargs.get('num_envs', 1)
+    rng = np.random.RandomState(0)
+    # Wraps around the end of the buffer
+    num_steps = 23
+    states = rng.randn(num_steps, num_envs, 2).astype(np.float32)
+    actions = rng.randint(3, size=(num_steps, num_envs))
+    rewards = rng.randn(num_steps, num_envs)
+    dones = rng.random_sample((num_steps, num_envs)) < 0.2
+
+    replay_buffer = ReplayBuffer(16, history_length=3, **buffer_kwargs)
+    expected = ReplayBuffer(16, history_length=3, **buffer_kwargs)
+    for step in zip(states, actions, rewards, dones):
+        expected.add(*step)
+    # Chunks of different sizes, the first one fills the buffer more than once
+    for part in [slice(0, 17), slice(17, 18), slice(18, None)]:
+        replay_buffer.add_sequence(*[
+            np.concatenate(values[part]) for values in [states, actions, rewards, dones]
+        ])
+
+    assert_same_buffers(replay_buffer, expected)
+
+
+def test_prioritized_add_sequence_matches_add():
+    replay_buffer = PrioritizedReplayBuffer(16, history_length=2, n_step=2)
+    expected = PrioritizedReplayBuffer(16, history_length=2, n_step=2)
+    expected.max_priority = replay_buffer.max_priority = 3.
+    dones = np.arange(21) % 4 == 3
+    for i in range(21):
+        expected.add(np.array(i + 1.), 0, 1., dones[i])
+    replay_buffer.add_sequence(np.arange(1., 22.), np.zeros(21), np.ones(21), dones)
+
+    assert_same_buffers(replay_buffer, expected)
+    np.testing.assert_array_equal(replay_buffer.sum_tree.tree, expected.sum_tree.tree)
+    np.testing.assert_array_equal(replay_buffer.min_tree.tree, expected.min_tree.tree)
+
+
+def test_memmap_buffer_reloads_after_wrap_around(tmpdir):
+    kwargs = dict(history_length=3, n_step=2, batch_size=32)
+    storage_dir = str(tmpdir.join('buffer'))
+    replay_buffer = ReplayBuffer.initialize_or_load(16, storage_dir=storage_dir, **kwargs)
+    # Wraps around the end of the buffer
+    fill_buffer(replay_buffer, 23, done_freq=4)
+    replay_buffer.save()
+    del replay_buffer
+
+    reloaded = ReplayBuffer.initialize_or_load(16, storage_dir=storage_dir, **kwargs)
+    expected = ReplayBuffer(16, **kwargs)
+    fill_buffer(expected, 23, done_freq=4)
+    assert_same_buffers(reloaded, expected)
+    assert_same_samples(reloaded, expected, randomize_n_step=True)
+
+
+@pytest.mark.parametrize('compression', [
+    'zlib',
+    pytest.param('lz4', marks=pytest.mark.skipif(utils.lz4 is None,
+                                                 reason='lz4 not installed')),
+])
+def test_compressed_buffer_matches_uncompressed(compression):
+    kwargs = dict(history_length=4, n_step=2, batch_size=32, num_envs=2)
+    replay_buffer = ReplayBuffer(20, compression=compression, **kwargs)
+    expected = ReplayBuffer(20, **kwargs)
+    rng = np.random.RandomState(0)
+    frames = rng.randint(0, 256, size=(31, 2, 6, 5), dtype=np.uint8)
+    dones = rng.random_sample((31, 2)) < 0.2
+    for i_step, (frame, done) in enumerate(zip(frames, dones)):
+        # Also compares the stacks of the states before adding them
+        np.testing.assert_array_equal(
+            replay_buffer.stack_recent_states(frame), expected.stack_recent_states(frame))
+        for buffer in [replay_buffer, expected]:
+            buffer.add(frame, [i_step % 3] * 2, [float(i_step)] * 2, done)
+
+    assert_same_buffers(replay_buffer, expected)
+    assert_same_samples(replay_buffer, expected, randomize_n_step=True)
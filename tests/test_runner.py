@@ -0,0 +1,135 @@
+import numpy as np
+
+from gymmeforce.common.print_utils import Logger
+from gymmeforce.common.runner import EpisodeRunner, TrajectoryBuilder, VecEpisodeRunner
+from gymmeforce.common.vec_env import VecEnv
+
+
+class CountingEnv:
+    '''
+    The state is the step of the episode, episodes last <episode_length> steps.
+    The reward is the action, and it keeps the stats of a monitored env
+    '''
+
+    def __init__(self, episode_length=3):
+        self.episode_length = episode_length
+        self.i_step = 0
+        self.total_steps = 0
+        self.episode_id = 0
+
+    def reset(self):
+        self.i_step = 0
+        return np.array([0.])
+
+    def step(self, action):
+        self.i_step += 1
+        self.total_steps += 1
+        done = self.i_step == self.episode_length
+        self.episode_id += done
+        return np.array([float(self.i_step)]), float(action), done, {}
+
+    def get_total_steps(self):
+        return self.total_steps
+
+    def get_episode_rewards(self):
+        return []
+
+    def close(self):
+        pass
+
+
+def create_vec_env(episode_lengths):
+    envs = [CountingEnv(length) for length in episode_lengths]
+    return VecEnv(envs, envs)
+
+
+def test_new_episode_marks_first_states():
+    runner = EpisodeRunner(CountingEnv(episode_length=3))
+    new_episodes = []
+
+    def select_action(state):
+        new_episodes.append((state[0], runner.new_episode))
+        return 0
+
+    for _ in range(7):
+        runner.run_one_step(select_action)
+
+    assert new_episodes == [(0, True), (1, False), (2, False), (0, True), (1, False),
+                            (2, False), (0, True)]
+
+
+def test_run_chunks_keeps_terminal_states():
+    runner = EpisodeRunner(CountingEnv(episode_length=3))
+    chunk = next(runner.run_chunks(5, lambda state: 0))
+
+    np.testing.assert_array_equal(chunk['states'][:, 0], [0, 1, 2, 0, 1])
+    np.testing.assert_array_equal(chunk['next_states'][:, 0], [1, 2, 3, 1, 2])
+    np.testing.assert_array_equal(chunk['dones'], [False, False, True, False, False])
+
+
+def test_builder_keeps_fractional_rewards_after_int():
+    builder = TrajectoryBuilder(initial_size=2)
+    for i_step, reward in enumerate([0, 0.5, -0.1, 1]):
+        builder.add(np.array([float(i_step)]), 0, reward, i_step == 3)
+    trajectory = builder.finish(np.array([4.]))
+
+    assert trajectory['rewards'].dtype == np.float32
+    np.testing.assert_allclose(trajectory['rewards'], [0, 0.5, -0.1, 1], rtol=1e-6)
+    assert trajectory['dones'].dtype == np.bool_
+    np.testing.assert_array_equal(trajectory['next_states'][:, 0], [1, 2, 3, 4])
+
+
+def test_vec_runner_steps_envs_in_lockstep():
+    runner = VecEpisodeRunner(create_vec_env([2, 3]))
+    transitions = [runner.run_one_step(lambda states: np.array([1, 2])) for _ in range(3)]
+
+    np.testing.assert_array_equal(transitions[-1]['reward'], [1, 2])
+    np.testing.assert_array_equal([t['state'][:, 0] for t in transitions],
+                                  [[0, 0], [1, 1], [0, 2]])
+    # Env 0 was reseted after its first episode, the terminal state is kept
+    np.testing.assert_array_equal([t['next_state'][:, 0] for t in transitions],
+                                  [[1, 1], [2, 2], [1, 3]])
+    np.testing.assert_array_equal([t['done'] for t in transitions],
+                                  [[False, False], [True, False], [False, True]])
+
+
+def test_vec_runner_splits_episodes_per_env():
+    runner = VecEpisodeRunner(create_vec_env([2, 3]))
+    episodes = [runner.run_one_episode(select_action_fn=lambda states: np.array([1, 2]))
+                for _ in range(5)]
+
+    # Env 0 finishes on steps 2, 4 and 6, env 1 on steps 3 and 6
+    np.testing.assert_array_equal([ep['rewards'].sum() for ep in episodes],
+                                  [2, 6, 2, 2, 6])
+    for episode in episodes:
+        length = len(episode['rewards'])
+        np.testing.assert_array_equal(episode['states'][:, 0], np.arange(length))
+        np.testing.assert_array_equal(episode['next_states'][:, 0],
+                                      np.arange(1, length + 1))
+        np.testing.assert_array_equal(episode['dones'], np.arange(length) == length - 1)
+
+
+def test_vec_runner_discards_unfinished_episodes():
+    runner = VecEpisodeRunner(create_vec_env([2, 5]))
+    runner.run_one_episode(select_action_fn=lambda states: np.array([1, 1]))
+    runner.discard_unfinished()
+    # Actions of the new policy
+    episodes = [runner.run_one_episode(select_action_fn=lambda states: np.array([2, 2]))
+                for _ in range(2)]
+
+    np.testing.assert_array_equal(episodes[0]['states'][:, 0], [0, 1])
+    # Env 1 continued its episode, but the steps before discarding were dropped
+    np.testing.assert_array_equal(episodes[1]['states'][:, 0], [2, 3, 4])
+    for episode in episodes:
+        assert np.all(episode['actions'] == 2)
+
+
+def test_runners_time_env_steps():
+    logger = Logger(profile=True)
+    runner = EpisodeRunner(CountingEnv(), phase_fn=logger.phase)
+    vec_runner = VecEpisodeRunner(create_vec_env([2, 3]), phase_fn=logger.phase)
+    for _ in range(3):
+        runner.run_one_step(lambda state: 0)
+        vec_runner.run_one_step(lambda states: np.zeros(2))
+
+    assert len(logger.phase_timer.durations['env_step']) == 6
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from gymmeforce.common.tf_replay_buffer import TFReplayBuffer  # noqa: E402
+from gymmeforce.common.utils import ReplayBuffer  # noqa: E402
+
+
+def fill_buffers(replay_buffers, num_steps, done_freq=4):
+    ''' The state is the step plus one, so the slot of each sampled state is known '''
+    rewards = np.random.RandomState(0).randn(num_steps).astype(np.float32)
+    for i in range(num_steps):
+        for replay_buffer in replay_buffers:
+            replay_buffer.add(np.array(i + 1.), i % 3, rewards[i],
+                              i % done_freq == done_freq - 1)
+
+
+def test_tf_buffer_matches_replay_buffer():
+    maxlen, history_length, n_step = 40, 3, 3
+    tf.reset_default_graph()
+    tf_buffer = TFReplayBuffer((), np.float32, history_length=history_length,
+                               chunk_size=8)
+    replay_buffer = ReplayBuffer(
+        maxlen, history_length=history_length, n_step=n_step, gamma=0.9)
+
+    with tf.Session() as sess:
+        sess.run(tf.local_variables_initializer())
+        tf_buffer.allocate(sess, maxlen, batch_size=64, n_step=n_step, gamma=0.9)
+        # Wraps around the end of the buffer, the last chunk is not full
+        fill_buffers([tf_buffer, replay_buffer], 53)
+        tf_buffer.flush()
+        assert tf_buffer.uploaded_len == replay_buffer.current_len
+
+        stored = sess.run(tf_buffer.storage_vars)
+        for name, values in stored.items():
+            np.testing.assert_allclose(values, getattr(replay_buffer, name))
+
+        batch = tf_buffer.sample(randomize_n_step=True)
+
+    # Compare with the ReplayBuffer batch of the same transitions
+    last_idxs = (batch['states_t'][:, -1].astype(int) - 1) % maxlen
+    start_idxs = last_idxs - history_length + 1
+    expected = replay_buffer._create_batch(
+        start_idxs, last_idxs + 1, n_step=batch['n_step'].astype(int))
+    for key, values in expected.items():
+        np.testing.assert_allclose(batch[key], values, rtol=1e-5, err_msg=key)
@@ -0,0 +1,88 @@
+import pickle
+
+import numpy as np
+from scipy.signal import lfilter
+
+from gymmeforce.common.utils import (RingBuffer, Scaler, StateQuantizer,
+                                     discounted_sum_episodes)
+
+
+def test_scaler_merge_equals_single_update():
+    data = np.random.RandomState(0).randn(100, 3) * 5 + 2
+    scaler = Scaler(3)
+    scaler.update(data)
+    worker_a, worker_b = Scaler(3), Scaler(3)
+    for states in np.split(data[:60], 4):
+        worker_a.update(states)
+    worker_b.update(data[60:])
+    worker_a.merge(worker_b)
+
+    assert worker_a.count == 100
+    np.testing.assert_allclose(worker_a.means, data.mean(axis=0))
+    np.testing.assert_allclose(worker_a.vars, data.var(axis=0))
+    np.testing.assert_allclose(worker_a.get(), scaler.get())
+
+
+def test_scaler_save_load(tmpdir):
+    path = str(tmpdir.join('scaler.npz'))
+    scaler = Scaler.initialize_or_load(3, path)
+    scaler.update(np.random.RandomState(0).randn(10, 3))
+    scaler.save()
+
+    loaded = Scaler.initialize_or_load(3, path)
+    assert loaded.count == 10
+    np.testing.assert_array_equal(loaded.means, scaler.means)
+    np.testing.assert_array_equal(loaded.m2, scaler.m2)
+
+
+def test_scaler_loads_legacy_pickle(tmpdir):
+    means, variances = np.array([1., 2.]), np.array([3., 4.])
+    with open(str(tmpdir.join('scaler.pkl')), 'wb') as f:
+        pickle.dump({'means': means, 'vars': variances, 'm': 5}, f)
+
+    scaler = Scaler.initialize_or_load(2, str(tmpdir.join('scaler.npz')))
+    assert scaler.count == 5
+    np.testing.assert_array_equal(scaler.means, means)
+    np.testing.assert_allclose(scaler.vars, variances)
+
+
+def test_discounted_sum_episodes_matches_each_episode():
+    rng = np.random.RandomState(0)
+    episode_lengths = np.array([1, 7, 30, 1, 12])
+    values = rng.randn(episode_lengths.sum()).astype(np.float32)
+    for gamma in [0., 0.9, 0.99, 1.]:
+        expected = np.concatenate([
+            lfilter([1.0], [1.0, -gamma], episode[::-1])[::-1]
+            for episode in np.split(values, np.cumsum(episode_lengths)[:-1])
+        ])
+        result = discounted_sum_episodes(values, episode_lengths, gamma)
+        assert result.dtype == np.float32
+        np.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-5)
+
+
+def test_state_quantizer_round_trip():
+    states = np.random.RandomState(0).uniform(-3, 5, size=(50, 4)).astype(np.float32)
+    for dtype in ['uint8', 'uint16']:
+        quantizer = StateQuantizer(dtype, (4, ), value_range=(-3, 5))
+        stored = quantizer.encode(states)
+        assert stored.dtype == np.dtype(dtype)
+        # Rounding error is at most half a quantization level
+        error = np.abs(quantizer.decode(stored) - states)
+        assert np.all(error <= quantizer.scale / 2 + 1e-6)
+
+    quantizer = StateQuantizer('float16', (4, ))
+    np.testing.assert_allclose(
+        quantizer.decode(quantizer.encode(states)), states, rtol=1e-3)
+
+
+def test_ring_buffer_order_after_wrap_around():
+    ring_buffer = RingBuffer((2, ), maxlen=3)
+    ring_buffer.append([1, -1])
+    # Zeros before the first states
+    np.testing.assert_array_equal(ring_buffer.get_data(), [[0, 0, 1], [0, 0, -1]])
+
+    for i in range(2, 8):
+        ring_buffer.append([i, -i])
+        # The oldest state is the zero padding when i == 2
+        expected = np.arange(i - 2, i + 1)
+        np.testing.assert_array_equal(ring_buffer.get_data(), [expected, -expected])
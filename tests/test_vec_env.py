@@ -0,0 +1,50 @@
+from functools import partial
+
+import numpy as np
+
+from gymmeforce.common.vec_env import SubprocVecEnv
+from tests.test_runner import CountingEnv, create_vec_env
+
+
+def create_env(episode_length):
+    env = CountingEnv(episode_length)
+    return env, env
+
+
+def test_subproc_matches_vec_env():
+    episode_lengths = [2, 3]
+    vec_env = create_vec_env(episode_lengths)
+    env_fns = [partial(create_env, length) for length in episode_lengths]
+    subproc_env = SubprocVecEnv(env_fns, state_shape=(1, ))
+    try:
+        np.testing.assert_array_equal(subproc_env.reset(), vec_env.reset())
+        for i_step in range(7):
+            actions = np.array([i_step, -i_step])
+            states, rewards, dones, infos = vec_env.step(actions)
+            sub_states, sub_rewards, sub_dones, sub_infos = subproc_env.step(actions)
+
+            # The states are read from the shared memory written by the workers
+            np.testing.assert_array_equal(sub_states, states)
+            np.testing.assert_array_equal(sub_rewards, rewards)
+            np.testing.assert_array_equal(sub_dones, dones)
+            for info, sub_info in zip(infos, sub_infos):
+                np.testing.assert_array_equal(
+                    sub_info.get('terminal_state'), info.get('terminal_state'))
+
+        assert subproc_env.get_total_steps() == vec_env.get_total_steps() == 14
+        assert subproc_env.get_number_episodes() == vec_env.get_number_episodes() == 5
+    finally:
+        subproc_env.close()
+
+    for process in subproc_env.processes:
+        assert not process.is_alive()
+
+
+def test_subproc_close_while_stepping():
+    subproc_env = SubprocVecEnv([partial(create_env, 3)] * 2, state_shape=(1, ))
+    subproc_env.reset()
+    subproc_env.step_async([0, 0])
+    subproc_env.close()
+
+    for process in subproc_env.processes:
+        assert not process.is_alive()